@@ -0,0 +1,953 @@
+"""
+Benchmarks for the chatbot's performance-sensitive components.
+
+Run a benchmark with, for example:
+
+    python benchmark.py batching --model microsoft/DialoGPT-medium
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import requests
+
+from main import (
+    AdvancedChatbot, ConversationContext, HashingEmbedder, HttpClient, InferenceScheduler, IntentRouter, JokePool,
+    JokesAPI, LocalWikiIndex, MemoryManager, ModelRegistry, ResponseCache, Telemetry, TransformerEmbedder, UserMemoryStore, VectorMemory,
+    WeatherIntegration, WikipediaService, get_setting, get_telemetry, joke_category_urls
+)
+
+SAMPLE_MESSAGES = [
+    "How are you doing today?",
+    "What do you like to do on weekends?",
+    "Do you have any pets?",
+    "What is your favourite movie?",
+    "I just got back from a long trip.",
+    "Can you recommend a good book?",
+    "It has been raining all week.",
+    "What should I cook for dinner tonight?"
+]
+
+def benchmark_batching(args):
+    """
+    Measures InferenceScheduler throughput for batch sizes 1 to `--max-batch-size`.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        list: One result dictionary per batch size.
+    """
+    registry = ModelRegistry()
+    tokenizer, model = registry.acquire(args.model)
+    prompts = [
+        tokenizer.encode(SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)] + tokenizer.eos_token)
+        for i in range(args.requests)
+    ]
+    results = []
+    for batch_size in range(1, args.max_batch_size + 1):
+        scheduler = InferenceScheduler(
+            tokenizer, model,
+            max_batch_size=batch_size,
+            max_wait_ms=args.max_wait_ms,
+            max_queue_size=args.requests,
+            generate_kwargs={'max_length': None, 'max_new_tokens': args.max_new_tokens}
+        )
+        # Warm up the worker thread and the model's first-call costs.
+        scheduler.submit(prompts[0]).result()
+        start = time.perf_counter()
+        # Submit every request at once, as if many sessions were talking at the same time.
+        futures = [scheduler.submit(prompt) for prompt in prompts]
+        wait(futures)
+        elapsed = time.perf_counter() - start
+        generated = sum(len(future.result()) for future in futures)
+        result = {
+            'batch_size': batch_size,
+            'requests': len(prompts),
+            'seconds': round(elapsed, 4),
+            'requests_per_second': round(len(prompts) / elapsed, 2),
+            'tokens_per_second': round(generated / elapsed, 2),
+            'batches': scheduler.stats['batches'] - 1  # Exclude the warm-up batch.
+        }
+        results.append(result)
+        print(json.dumps(result))
+        scheduler.shutdown()
+    return results
+
+def benchmark_context(args):
+    """
+    Compares per-turn latency of a growing conversation with and without KV-cache reuse.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        list: One result dictionary per turn.
+    """
+    registry = ModelRegistry()
+    tokenizer, model = registry.acquire(args.model)
+    scheduler = InferenceScheduler(
+        tokenizer, model,
+        # Fixed-length replies keep the turns comparable between the two modes.
+        generate_kwargs={'max_length': None, 'max_new_tokens': args.reply_tokens, 'min_new_tokens': args.reply_tokens}
+    )
+    contexts = {
+        mode: ConversationContext(tokenizer.eos_token_id, max_context_tokens=args.max_context_tokens)
+        for mode in ('cached', 'uncached')
+    }
+    results = []
+    for turn in range(args.turns):
+        new_ids = tokenizer.encode(SAMPLE_MESSAGES[turn % len(SAMPLE_MESSAGES)] + tokenizer.eos_token)
+        result = {'turn': turn + 1}
+        for mode, context in contexts.items():
+            if mode == 'uncached':
+                context.drop_cache()  # Re-encode the whole history, as a naive implementation would.
+            start = time.perf_counter()
+            input_ids, cache = context.prepare(new_ids)
+            output_ids, cache = scheduler.submit(input_ids, past_key_values=cache, return_cache=True).result()
+            context.commit(new_ids, output_ids, cache)
+            result[f'{mode}_ms'] = round((time.perf_counter() - start) * 1000, 2)
+            result['prompt_tokens'] = len(input_ids)
+        results.append(result)
+        print(json.dumps(result))
+    scheduler.shutdown()
+    return results
+
+# The chatbot's intent table, as defined in AdvancedChatbot.
+INTENTS = {
+    'greeting': ['hello', 'hi', 'hey', 'greetings'],
+    'weather': ['weather', 'temperature', 'forecast'],
+    'time': ['time', 'current time', 'what time'],
+    'joke': ['joke', 'humor', 'funny'],
+    'help': ['help', 'assist', 'support'],
+    'memory': ['remember', 'recall', 'memory']
+}
+
+MESSAGE_TEMPLATES = [
+    "Hello there, how is it going?",
+    "What's the weather in {city}?",
+    "Tell me a {category} joke please",
+    "What time is it right now?",
+    "remember that my favourite colour is {colour}",
+    "recall {colour}",
+    "my name is {name}",
+    "Can you show my joke history",
+    "I was thinking about {topic} the whole afternoon and wondered what you think about it",
+    "Do you know anything interesting about {topic}?",
+    "Could you help me plan a trip to {city} next summer?",
+    "That was a really funny one, thanks!"
+]
+
+def synthetic_messages(count, seed=0):
+    """
+    Builds a reproducible corpus of chat messages covering every intent path.
+
+    Args:
+        count (int): Number of messages.
+        seed (int): Random seed.
+
+    Returns:
+        list: The messages.
+    """
+    rng = random.Random(seed)
+    fillers = {
+        'city': ['London', 'New York', 'Paris', 'Tokyo', 'Rio de Janeiro'],
+        'category': list(joke_category_urls()),
+        'colour': ['blue', 'green', 'orange'],
+        'name': ['Sam', 'Alex', 'Robin'],
+        'topic': ['black holes', 'the roman empire', 'machine learning', 'sourdough bread', 'chess openings']
+    }
+    return [
+        rng.choice(MESSAGE_TEMPLATES).format(**{key: rng.choice(values) for key, values in fillers.items()})
+        for _ in range(count)
+    ]
+
+def legacy_route(message, intents, categories):
+    """
+    The routing previously done by process_message and recognize_intent, kept as a baseline.
+
+    Args:
+        message (str): The user's message.
+        intents (dict): The intent table.
+        categories (list): Joke categories.
+
+    Returns:
+        str or tuple: The command or intent, with its slot if any.
+    """
+    message_lower = message.lower()
+    for command in ('remember ', 'recall ', 'my name is '):
+        if message_lower.startswith(command):
+            return command.strip()
+    if 'joke history' in message_lower:
+        return 'joke_history'
+    if 'joke' in message_lower:
+        for category in categories:
+            if category in message_lower:
+                return 'joke', category
+        return 'joke'
+    if 'weather' in message_lower or 'temperature' in message_lower:
+        city_match = re.search(r'weather in (\w+)', message_lower)
+        if city_match:
+            return 'weather', city_match.group(1)
+    for intent, keywords in intents.items():
+        if any(keyword in message_lower for keyword in keywords):
+            return intent
+    return 'general'
+
+def benchmark_intents(args):
+    """
+    Compares the compiled IntentRouter with the previous keyword scans on a message corpus.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        dict: Throughput of both implementations.
+    """
+    messages = synthetic_messages(args.messages)
+    categories = list(joke_category_urls())
+    router = IntentRouter(INTENTS, categories)
+    result = {'messages': len(messages)}
+    for name, route in (('legacy', lambda message: legacy_route(message, INTENTS, categories)),
+                        ('router', router.route)):
+        start = time.perf_counter()
+        for message in messages:
+            route(message)
+        elapsed = time.perf_counter() - start
+        result[f'{name}_messages_per_second'] = round(len(messages) / elapsed)
+        result[f'{name}_us_per_message'] = round(elapsed / len(messages) * 1e6, 3)
+    print(json.dumps(result))
+    return result
+
+def benchmark_transcript(args):
+    """
+    Measures the per-rerun cost of reading a conversation's transcript as it grows.
+
+    A rerun reads the most recent window; 'load earlier' reads a page from the middle of the
+    conversation. Memory held by the transcript is compared with keeping every message.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        list: One result dictionary per conversation length.
+    """
+    results = []
+    workdir = tempfile.mkdtemp(prefix='chatbot-transcript-')
+    for size in args.sizes:
+        store = UserMemoryStore(path=os.path.join(workdir, f'{size}.db'), max_cached_exchanges=args.cached)
+        user_id = f'user-{size}'
+        exchanges = [
+            (f"{SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)]} ({i})", f"A reply of moderate length to message number {i}.")
+            for i in range(size)
+        ]
+        start = time.perf_counter()
+        for user_message, bot_response in exchanges:
+            store.add_exchange(user_id, user_message, bot_response)
+        append_seconds = time.perf_counter() - start
+        transcript = store.get(user_id).transcript
+        start = time.perf_counter()
+        for _ in range(args.reruns):
+            transcript.window(args.page_size)
+        window_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.reruns):
+            transcript.window(args.page_size, end=size // 2)
+        page_seconds = time.perf_counter() - start
+        result = {
+            'exchanges': size,
+            'append_us': round(append_seconds / size * 1e6, 2),
+            'window_ms': round(window_seconds / args.reruns * 1000, 4),
+            'earlier_page_ms': round(page_seconds / args.reruns * 1000, 4),
+            'transcript_bytes': transcript.nbytes,
+            'all_messages_bytes': sum(sys.getsizeof(user) + sys.getsizeof(bot) for user, bot in exchanges)
+        }
+        results.append(result)
+        print(json.dumps(result))
+        store.flush()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def synthetic_memories(count, vocabulary_size=5000, words_per_memory=8, seed=0):
+    """
+    Builds reproducible memory texts drawn from a synthetic vocabulary.
+
+    Args:
+        count (int): Number of memories to build.
+        vocabulary_size (int): Number of distinct words.
+        words_per_memory (int): Words in each memory.
+        seed (int): Random seed.
+
+    Returns:
+        tuple: (memories, vocabulary) lists.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(vocabulary_size)]
+    memories = [" ".join(rng.choices(vocabulary, k=words_per_memory)) for _ in range(count)]
+    return memories, vocabulary
+
+def benchmark_memory(args):
+    """
+    Measures MemoryManager insert and lookup latency as the store grows.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        list: One result dictionary per store size.
+    """
+    results = []
+    rng = random.Random(1)
+    for size in args.sizes:
+        # Real vocabularies keep growing with the text (Heaps' law), so scale it with the store.
+        memories, vocabulary = synthetic_memories(size, vocabulary_size=max(1000, size // 2))
+        manager = MemoryManager(max_memory_size=size)
+        start = time.perf_counter()
+        for memory in memories:
+            manager.add_memory(memory, is_long_term=True)
+        insert_seconds = time.perf_counter() - start
+        queries = [" ".join(rng.choices(vocabulary, k=3)) for _ in range(args.queries)]
+        start = time.perf_counter()
+        for query in queries:
+            manager.get_relevant_memories(query, top_k=args.top_k)
+        lookup_seconds = time.perf_counter() - start
+        # Baseline: the previous implementation's substring scan over every memory.
+        start = time.perf_counter()
+        for query in queries[:args.scan_queries]:
+            [memory for memory in memories if any(keyword in memory.lower() for keyword in query.lower().split())]
+        scan_seconds = time.perf_counter() - start
+        result = {
+            'memories': size,
+            'insert_us': round(insert_seconds / size * 1e6, 2),
+            'lookup_ms': round(lookup_seconds / len(queries) * 1000, 4),
+            'substring_scan_ms': round(scan_seconds / min(len(queries), args.scan_queries) * 1000, 4)
+        }
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+def benchmark_recall(args):
+    """
+    Measures semantic recall latency of VectorMemory at increasing store sizes.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        list: One result dictionary per store size.
+    """
+    if args.embedder == 'transformer':
+        tokenizer, model = ModelRegistry().acquire(args.model)
+        embedder = TransformerEmbedder(tokenizer, model)
+    else:
+        embedder = HashingEmbedder()
+    results = []
+    rng = random.Random(1)
+    for size in args.sizes:
+        memories, vocabulary = synthetic_memories(size, vocabulary_size=max(1000, size // 2))
+        store = VectorMemory(embedder, size)
+        start = time.perf_counter()
+        # Embed in batches, as add_memories does.
+        for offset in range(0, size, args.batch_size):
+            store.add_many(memories[offset:offset + args.batch_size])
+        insert_seconds = time.perf_counter() - start
+        queries = [" ".join(rng.choices(vocabulary, k=3)) for _ in range(args.queries)]
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            store.search(query, top_k=args.top_k)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        result = {
+            'memories': size,
+            'embedder': embedder.name,
+            'matrix_mb': round(store.nbytes / 2 ** 20, 2),
+            'insert_us': round(insert_seconds / size * 1e6, 2),
+            'recall_p50_ms': round(latencies[len(latencies) // 2] * 1000, 4),
+            'recall_p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 4)
+        }
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+def latency_percentiles(latencies):
+    """
+    Summarizes latencies as p50/p95/p99 in milliseconds.
+
+    Args:
+        latencies (list): Latencies in seconds.
+
+    Returns:
+        dict: The percentiles, or None values when there are no latencies.
+    """
+    if not latencies:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+    return {'p50_ms': round(float(p50), 2), 'p95_ms': round(float(p95), 2), 'p99_ms': round(float(p99), 2)}
+
+def benchmark_load(args):
+    """
+    Drives a running chat server (server.py) with concurrent clients.
+
+    Each client keeps its own session and sends messages back to back; 429 responses
+    are counted as rejected rather than retried, so the result shows where backpressure starts.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        dict: Throughput, status counts and latency percentiles.
+    """
+    base_url = args.url.rstrip('/')
+    per_client = max(1, args.requests // args.concurrency)
+
+    def client(index):
+        http = requests.Session()
+        session_id = http.post(f"{base_url}/sessions", json={}, timeout=args.timeout).json()['session_id']
+        outcomes = []
+        for i in range(per_client):
+            message = SAMPLE_MESSAGES[(index + i) % len(SAMPLE_MESSAGES)]
+            start = time.perf_counter()
+            try:
+                status = http.post(
+                    f"{base_url}/chat", json={'message': message, 'session_id': session_id}, timeout=args.timeout
+                ).status_code
+            except requests.RequestException:
+                status = None
+            outcomes.append((status, time.perf_counter() - start))
+        http.delete(f"{base_url}/sessions/{session_id}", timeout=args.timeout)
+        return outcomes
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        outcomes = [outcome for result in executor.map(client, range(args.concurrency)) for outcome in result]
+    elapsed = time.perf_counter() - start
+    latencies = [latency for status, latency in outcomes if status == 200]
+    result = {
+        'concurrency': args.concurrency,
+        'requests': len(outcomes),
+        'seconds': round(elapsed, 3),
+        'ok': len(latencies),
+        'rejected': sum(1 for status, _ in outcomes if status == 429),
+        'errors': sum(1 for status, _ in outcomes if status not in (200, 429)),
+        'replies_per_second': round(len(latencies) / elapsed, 2),
+        **latency_percentiles(latencies)
+    }
+    print(json.dumps(result))
+    return result
+
+STUB_ARTICLES = [
+    ("Python (programming language)", "Python is a high-level, general-purpose programming language. Its design philosophy emphasizes code readability. It was created by Guido van Rossum."),
+    ("Eiffel Tower", "The Eiffel Tower is a wrought-iron lattice tower in Paris, France. It is named after the engineer Gustave Eiffel. It was completed in 1889."),
+    ("Photosynthesis", "Photosynthesis is the process by which plants convert light into chemical energy. It produces oxygen as a by-product."),
+    ("Jupiter", "Jupiter is the fifth planet from the Sun and the largest in the Solar System. It is a gas giant."),
+    ("Mount Everest", "Mount Everest is Earth's highest mountain above sea level. It lies in the Mahalangur Himal sub-range of the Himalayas.")
+]
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers OpenWeatherMap and JokeAPI requests with deterministic data after an injected delay."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == '/weather':
+            time.sleep(self.server.latency['weather'])
+            # Derive the weather from the city name so every run sees the same values.
+            seed = zlib.crc32(params.get('q', '').lower().encode('utf-8'))
+            body = {
+                'cod': 200,
+                'main': {'temp': seed % 35, 'feels_like': seed % 35 - 1, 'humidity': seed % 100},
+                'weather': [{'description': ('clear sky', 'light rain', 'overcast clouds')[seed % 3]}],
+                'wind': {'speed': seed % 12}
+            }
+        elif url.path.startswith('/joke/'):
+            time.sleep(self.server.latency['joke'])
+            category = url.path.rsplit('/', 1)[-1]
+            amount = int(params.get('amount', 1))
+            jokes = [{'joke': f"Stub {category} joke number {i + 1}."} for i in range(amount)]
+            body = {'error': False, 'amount': amount, 'jokes': jokes} if amount > 1 else {'error': False, **jokes[0]}
+        else:
+            self.send_error(404)
+            return
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output machine-readable.
+
+class StubServices:
+    def __init__(self, weather_latency=0.1, joke_latency=0.1):
+        """
+        Starts a local HTTP server standing in for OpenWeatherMap and JokeAPI.
+
+        Args:
+            weather_latency (float): Seconds to wait before answering a weather request.
+            joke_latency (float): Seconds to wait before answering a joke request.
+        """
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.latency = {'weather': weather_latency, 'joke': joke_latency}
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, name='stub-services', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        """Stops the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+class DelayedWikiIndex:
+    def __init__(self, index, latency):
+        """
+        Wraps an offline Wikipedia index so that every lookup takes as long as a network call.
+
+        Args:
+            index (LocalWikiIndex): The index answering lookups.
+            latency (float): Seconds added to every lookup.
+        """
+        self.index = index
+        self.latency = latency
+
+    def lookup(self, query, sentences=2):
+        """
+        Looks a query up after the injected delay.
+
+        Args:
+            query (str): The user's query.
+            sentences (int): Number of summary sentences to return.
+
+        Returns:
+            str or None: The article summary, or None if nothing matches.
+        """
+        time.sleep(self.latency)
+        return self.index.lookup(query, sentences)
+
+def load_transcripts(path):
+    """
+    Reads scripted conversations from a JSONL transcript.
+
+    Each line holds one conversation: {"conversation": "<id>", "turns": ["Hi!", ...]}.
+
+    Args:
+        path (str): Path to the transcript.
+
+    Returns:
+        list: (conversation ID, list of messages) tuples.
+    """
+    with open(path, encoding='utf-8') as transcript:
+        conversations = [json.loads(line) for line in transcript if line.strip()]
+    return [(conversation['conversation'], conversation['turns']) for conversation in conversations]
+
+def benchmark_replay(args):
+    """
+    Replays scripted conversations through `AdvancedChatbot.process_message`.
+
+    Weather, jokes and Wikipedia are served by local deterministic stubs with the configured
+    latencies, and user state lives in a temporary database, so runs are repeatable and
+    their JSON results can be diffed.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        dict: Throughput and latency percentiles, overall and per route.
+    """
+    conversations = load_transcripts(args.transcript) * args.repeat
+    stubs = StubServices(weather_latency=args.weather_latency_ms / 1000, joke_latency=args.joke_latency_ms / 1000)
+    workdir = tempfile.mkdtemp(prefix='chatbot-replay-')
+    telemetry = get_telemetry()  # Enabled with TELEMETRY=on; its snapshot is added to the results.
+    http = HttpClient(telemetry=telemetry)
+    joke_pool = JokePool(http, joke_category_urls(f"{stubs.base_url}/joke"), telemetry=telemetry)
+    joke_pool.prefetch()
+    registry = ModelRegistry(profile=args.profile, scheduler_options={
+        'max_batch_size': args.max_batch_size, 'max_wait_ms': args.max_wait_ms, 'max_queue_size': 1024,
+        'telemetry': telemetry
+    })
+    memory_store = UserMemoryStore(path=os.path.join(workdir, 'memory.db'))
+    # A fresh cache per run, so results do not depend on earlier runs; 0 MB turns caching off.
+    response_cache = (
+        ResponseCache(max_bytes=int(args.response_cache_mb * 1024 * 1024), telemetry=telemetry)
+        if args.response_cache_mb > 0 else False
+    )
+    wikipedia_service = WikipediaService(
+        offline_index=DelayedWikiIndex(LocalWikiIndex(STUB_ARTICLES), args.wiki_latency_ms / 1000),
+        telemetry=telemetry
+    )
+
+    def create_chatbot(user_id):
+        return AdvancedChatbot(
+            model_name=args.model, registry=registry, user_id=user_id, memory_store=memory_store,
+            wikipedia_service=wikipedia_service,
+            weather_service=WeatherIntegration(
+                api_key='stub', http_client=http, base_url=f"{stubs.base_url}/weather",
+                cache_ttl=args.weather_cache_ttl
+            ),
+            jokes_api=JokesAPI(http_client=http, base_url=f"{stubs.base_url}/joke", pool=joke_pool),
+            draft_model_name=args.draft_model,
+            response_cache=response_cache
+        )
+
+    def replay(item):
+        index, (conversation_id, turns) = item
+        chatbot = create_chatbot(f"replay-{conversation_id}-{index}")
+        samples = []
+        for message in turns:
+            start = time.perf_counter()
+            try:
+                chatbot.process_message(message)
+                route = chatbot.last_route or 'unknown'
+            except Exception:
+                route = 'error'
+            samples.append((route, time.perf_counter() - start))
+        return samples
+
+    # Load the model and run one generation before timing anything.
+    registry.warm_up(args.model).result()
+    if args.draft_model:
+        registry.warm_up(args.draft_model).result()
+    create_chatbot('replay-warmup').process_message("How are you doing today?")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        samples = [sample for result in executor.map(replay, enumerate(conversations)) for sample in result]
+    elapsed = time.perf_counter() - start
+
+    routes = {}
+    for route, latency in samples:
+        routes.setdefault(route, []).append(latency)
+    result = {
+        'config': {
+            'transcript': args.transcript, 'model': args.model, 'draft_model': args.draft_model,
+            'response_cache_mb': args.response_cache_mb,
+            'profile': args.profile, 'concurrency': args.concurrency,
+            'conversations': len(conversations), 'pipeline_mode': get_setting('PIPELINE_MODE', 'concurrent'),
+            'wiki_latency_ms': args.wiki_latency_ms, 'weather_latency_ms': args.weather_latency_ms,
+            'joke_latency_ms': args.joke_latency_ms
+        },
+        'overall': {
+            'turns': len(samples),
+            'seconds': round(elapsed, 3),
+            'turns_per_second': round(len(samples) / elapsed, 2),
+            **latency_percentiles([latency for _, latency in samples])
+        },
+        'routes': {
+            route: {'turns': len(latencies), **latency_percentiles(latencies)}
+            for route, latencies in sorted(routes.items())
+        }
+    }
+    result['decoding'] = registry.get_scheduler(args.model).decoding_stats()
+    result['response_cache'] = response_cache.summary() if response_cache is not False else None
+    if telemetry.enabled:
+        result['telemetry'] = telemetry.snapshot()
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + "\n")
+    memory_store.flush()
+    registry.get_scheduler(args.model).shutdown()
+    stubs.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+def benchmark_telemetry(args):
+    """
+    Measures the cost of instrumenting a pipeline stage with telemetry disabled and enabled.
+
+    Each iteration does what one instrumented stage does: a span, a histogram observation
+    and a counter increment.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        dict: Nanoseconds per instrumented stage for each mode.
+    """
+    result = {'iterations': args.iterations}
+    for mode, telemetry in (('disabled', Telemetry(enabled=False)), ('enabled', Telemetry())):
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            with telemetry.span('chatbot_http_request_seconds', host='example.org'):
+                pass
+            telemetry.observe('chatbot_stage_seconds', 0.01, stage='memory')
+            telemetry.increment('chatbot_http_cache_hits_total')
+        result[f'{mode}_ns_per_stage'] = round((time.perf_counter() - start) / args.iterations * 1e9, 1)
+    print(json.dumps(result))
+    return result
+
+# Run in a fresh interpreter so that module imports are timed from a cold start.
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+chatbot = main.AdvancedChatbot(model_name=sys.argv[1])
+chatbot.process_message("Hello!")
+first_reply = time.perf_counter()
+chatbot.generate_conversational_response("How are you doing today?")
+first_generation = time.perf_counter()
+print(json.dumps({
+    'import_seconds': round(imported - start, 3),
+    'first_reply_seconds': round(first_reply - start, 3),
+    'first_generation_seconds': round(first_generation - start, 3)
+}))
+"""
+
+def benchmark_startup(args):
+    """
+    Measures import-to-first-response time with eager and background model loading.
+
+    Each run starts a new interpreter, imports the app, creates a chatbot and times the
+    first (greeting) reply and the first generated reply, both from the start of the import.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        list: One result dictionary per loading mode and run.
+    """
+    results = []
+    workdir = tempfile.mkdtemp(prefix='chatbot-startup-')
+    for mode in ('eager', 'background'):
+        for run in range(args.runs):
+            env = dict(
+                os.environ, MODEL_LOADING=mode, MODEL_WAIT_TIMEOUT='600',
+                MEMORY_DB_PATH=os.path.join(workdir, f'{mode}-{run}.db')
+            )
+            output = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT, args.model], env=env, capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+            ).stdout
+            result = {'mode': mode, 'run': run + 1, **json.loads(output.strip().splitlines()[-1])}
+            results.append(result)
+            print(json.dumps(result))
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def benchmark_profiles(args):
+    """
+    Compares inference profiles on latency, model memory and output drift against the first profile.
+
+    Replies are forced to `--max-new-tokens` tokens so that every profile does the same work;
+    drift is measured on the generated token IDs of greedy decoding.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        list: One result dictionary per profile.
+    """
+    results = []
+    baseline = None
+    for profile in args.profiles:
+        registry = ModelRegistry(profile=profile, scheduler_options={
+            'max_batch_size': 1,
+            'num_threads': args.threads or None,
+            'generate_kwargs': {'max_new_tokens': args.max_new_tokens, 'min_new_tokens': args.max_new_tokens}
+        })
+        tokenizer, _ = registry.acquire(args.model)
+        scheduler = registry.get_scheduler(args.model)
+        prompts = [tokenizer.encode(message + tokenizer.eos_token) for message in SAMPLE_MESSAGES]
+        scheduler.submit(prompts[0]).result()  # Warm up the worker thread and the model's first-call costs.
+        latencies, outputs = [], []
+        for _ in range(args.rounds):
+            for prompt in prompts:
+                start = time.perf_counter()
+                outputs.append(scheduler.submit(prompt).result())
+                latencies.append(time.perf_counter() - start)
+        result = {
+            'profile': profile,
+            'model_bytes': registry.memory_stats()['model_bytes'],
+            'tokens_per_second': round(sum(len(output) for output in outputs) / sum(latencies), 2),
+            **latency_percentiles(latencies)
+        }
+        outputs = outputs[:len(prompts)]
+        if baseline is None:
+            baseline = outputs
+        else:
+            # Greedy decoding diverges for good after the first differing token.
+            prefixes = [
+                next((i for i, (a, b) in enumerate(zip(reference, output)) if a != b), min(len(reference), len(output)))
+                / max(len(reference), 1)
+                for reference, output in zip(baseline, outputs)
+            ]
+            result['exact_match_rate'] = round(sum(reference == output for reference, output in zip(baseline, outputs)) / len(outputs), 3)
+            result['matching_prefix_ratio'] = round(sum(prefixes) / len(prefixes), 3)
+        results.append(result)
+        print(json.dumps(result))
+        scheduler.shutdown()
+    return results
+
+def benchmark_assisted(args):
+    """
+    Compares standard decoding with decoding assisted by a draft model on the same prompts.
+
+    Both modes decode greedily, so their replies should be identical; the comparison shows
+    whether the draft model's accepted tokens outweigh the cost of running it.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+
+    Returns:
+        list: One result dictionary per decoding mode.
+    """
+    registry = ModelRegistry(profile=args.profile, scheduler_options={
+        'max_batch_size': 1,
+        'num_threads': args.threads or None,
+        'generate_kwargs': {'max_new_tokens': args.max_new_tokens}
+    })
+    tokenizer, model = registry.acquire(args.model)
+    _, draft_model = registry.acquire(args.draft_model)
+    scheduler = registry.get_scheduler(args.model)
+    prompts = [tokenizer.encode(message + tokenizer.eos_token) for message in SAMPLE_MESSAGES]
+    results = []
+    baseline = None
+    for mode, overrides in (('standard', {}), ('assisted', {'assistant_model': draft_model})):
+        scheduler.submit(prompts[0], **overrides).result()  # Warm up the first-call costs of this mode.
+        before = scheduler.decoding_stats()[mode]
+        latencies, outputs = [], []
+        for _ in range(args.rounds):
+            for prompt in prompts:
+                start = time.perf_counter()
+                outputs.append(scheduler.submit(prompt, **overrides).result())
+                latencies.append(time.perf_counter() - start)
+        stats = scheduler.decoding_stats()[mode]
+        result = {
+            'mode': mode,
+            'tokens_per_second': round(sum(len(output) for output in outputs) / sum(latencies), 2),
+            **latency_percentiles(latencies)
+        }
+        if mode == 'assisted':
+            result['acceptance_rate'] = stats['acceptance_rate']
+            result['draft_tokens'] = stats['draft_tokens'] - before['draft_tokens']
+            result['speedup'] = round(result['tokens_per_second'] / baseline['tokens_per_second'], 2)
+            result['identical_replies'] = outputs == baseline['outputs']
+        else:
+            baseline = {'tokens_per_second': result['tokens_per_second'], 'outputs': outputs}
+        results.append(result)
+        print(json.dumps(result))
+    scheduler.shutdown()
+    return results
+
+def main():
+    """
+    Parses command-line arguments and runs the selected benchmark.
+    """
+    parser = argparse.ArgumentParser(description="Chatbot performance benchmarks.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    batching = subparsers.add_parser('batching', help="Scheduler throughput for batch sizes 1..N.")
+    batching.add_argument('--model', default='microsoft/DialoGPT-medium')
+    batching.add_argument('--requests', type=int, default=32)
+    batching.add_argument('--max-batch-size', type=int, default=16)
+    batching.add_argument('--max-wait-ms', type=float, default=10)
+    batching.add_argument('--max-new-tokens', type=int, default=32)
+    batching.set_defaults(func=benchmark_batching)
+
+    context = subparsers.add_parser('context', help="Per-turn latency with and without KV-cache reuse.")
+    context.add_argument('--model', default='microsoft/DialoGPT-medium')
+    context.add_argument('--turns', type=int, default=30)
+    context.add_argument('--reply-tokens', type=int, default=16)
+    context.add_argument('--max-context-tokens', type=int, default=768)
+    context.set_defaults(func=benchmark_context)
+
+    memory = subparsers.add_parser('memory', help="Memory insert and lookup latency by store size.")
+    memory.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    memory.add_argument('--queries', type=int, default=200)
+    memory.add_argument('--top-k', type=int, default=5)
+    memory.add_argument('--scan-queries', type=int, default=20, help="Queries timed for the substring-scan baseline.")
+    memory.set_defaults(func=benchmark_memory)
+
+    recall = subparsers.add_parser('recall', help="Semantic recall latency by store size.")
+    recall.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    recall.add_argument('--embedder', choices=['hashing', 'transformer'], default='hashing')
+    recall.add_argument('--model', default='microsoft/DialoGPT-medium', help="Model for the transformer embedder.")
+    recall.add_argument('--batch-size', type=int, default=256)
+    recall.add_argument('--queries', type=int, default=200)
+    recall.add_argument('--top-k', type=int, default=5)
+    recall.set_defaults(func=benchmark_recall)
+
+    transcript = subparsers.add_parser('transcript', help="Transcript window and paging cost by conversation length.")
+    transcript.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    transcript.add_argument('--cached', type=int, default=100, help="Exchanges kept in memory.")
+    transcript.add_argument('--page-size', type=int, default=20)
+    transcript.add_argument('--reruns', type=int, default=200)
+    transcript.set_defaults(func=benchmark_transcript)
+
+    intents = subparsers.add_parser('intents', help="Intent routing throughput on a synthetic message corpus.")
+    intents.add_argument('--messages', type=int, default=100000)
+    intents.set_defaults(func=benchmark_intents)
+
+    load = subparsers.add_parser('load', help="Load test a running chat server (server.py).")
+    load.add_argument('--url', default='http://127.0.0.1:8000')
+    load.add_argument('--concurrency', type=int, default=16)
+    load.add_argument('--requests', type=int, default=256)
+    load.add_argument('--timeout', type=float, default=120)
+    load.set_defaults(func=benchmark_load)
+
+    replay = subparsers.add_parser('replay', help="Replay scripted conversations against local service stubs.")
+    replay.add_argument('--transcript', default='benchmark_conversations.jsonl')
+    replay.add_argument('--model', default='microsoft/DialoGPT-medium', help="A tiny local checkpoint keeps runs fast.")
+    replay.add_argument('--profile', choices=['fp32', 'int8'], default='fp32')
+    replay.add_argument('--draft-model', default='', help="Draft model for assisted decoding, e.g. microsoft/DialoGPT-small.")
+    replay.add_argument('--response-cache-mb', type=float, default=16, help="Response cache size; 0 turns caching off.")
+    replay.add_argument('--concurrency', type=int, default=8)
+    replay.add_argument('--repeat', type=int, default=1, help="Times to replay every conversation.")
+    replay.add_argument('--wiki-latency-ms', type=float, default=150)
+    replay.add_argument('--weather-latency-ms', type=float, default=100)
+    replay.add_argument('--joke-latency-ms', type=float, default=100)
+    replay.add_argument('--weather-cache-ttl', type=float, default=600)
+    replay.add_argument('--max-batch-size', type=int, default=8)
+    replay.add_argument('--max-wait-ms', type=float, default=10)
+    replay.add_argument('--output', help="Also write the JSON results to this file.")
+    replay.set_defaults(func=benchmark_replay)
+
+    telemetry = subparsers.add_parser('telemetry', help="Instrumentation overhead with telemetry disabled and enabled.")
+    telemetry.add_argument('--iterations', type=int, default=200000)
+    telemetry.set_defaults(func=benchmark_telemetry)
+
+    startup = subparsers.add_parser('startup', help="Import-to-first-response time with eager and background loading.")
+    startup.add_argument('--model', default='microsoft/DialoGPT-medium')
+    startup.add_argument('--runs', type=int, default=3)
+    startup.set_defaults(func=benchmark_startup)
+
+    profiles = subparsers.add_parser('profiles', help="Latency, memory and output drift of fp32 vs. int8 inference.")
+    profiles.add_argument('--model', default='microsoft/DialoGPT-medium')
+    profiles.add_argument('--profiles', nargs='+', default=['fp32', 'int8'])
+    profiles.add_argument('--threads', type=int, default=0, help="Intra-op threads per worker (0: torch default).")
+    profiles.add_argument('--max-new-tokens', type=int, default=32)
+    profiles.add_argument('--rounds', type=int, default=3)
+    profiles.set_defaults(func=benchmark_profiles)
+
+    assisted = subparsers.add_parser('assisted', help="Standard vs. draft-model-assisted decoding throughput.")
+    assisted.add_argument('--model', default='microsoft/DialoGPT-medium')
+    assisted.add_argument('--draft-model', default='microsoft/DialoGPT-small')
+    assisted.add_argument('--profile', choices=['fp32', 'int8'], default='fp32')
+    assisted.add_argument('--threads', type=int, default=0, help="Intra-op threads per worker (0: torch default).")
+    assisted.add_argument('--max-new-tokens', type=int, default=32)
+    assisted.add_argument('--rounds', type=int, default=3)
+    assisted.set_defaults(func=benchmark_assisted)
+
+    args = parser.parse_args()
+    args.func(args)
+
+# Entry point for running benchmarks from the command line.
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,234 @@
 import streamlit as st
-import torch
 import re
 import random
-import wikipedia
+import contextlib
 import datetime
 import requests
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import array
+import bisect
+import hashlib
+import heapq
+import importlib
+import json
+import logging
+import math
+import numpy as np
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+import warnings
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+
+class LazyModule:
+    def __init__(self, name):
+        """
+        Stands in for a module that is only imported when one of its attributes is first used.
+
+        torch, transformers and wikipedia take seconds to import, and most replies (greetings,
+        jokes, weather, memory commands) need none of them.
+
+        Args:
+            name (str): The module to import, e.g. 'torch'.
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attribute)
+
+torch = LazyModule('torch')
+transformers = LazyModule('transformers')
+wikipedia = LazyModule('wikipedia')
+
+# Jokes served when JokeAPI cannot be reached and the local pool is empty.
+FALLBACK_JOKES = [
+    "Why do programmers prefer dark mode? Because light attracts bugs!",
+    "I told my computer I needed a break, and it said: 'No problem, I'll go to sleep.'",
+    "Why did the scarecrow win an award? Because he was outstanding in his field.",
+    "I'm reading a book about anti-gravity. It's impossible to put down."
+]
+
+def joke_category_urls(base_url='https://v2.jokeapi.dev/joke'):
+    """
+    Builds the JokeAPI endpoint of each joke category.
+
+    Args:
+        base_url (str): Root of the JokeAPI endpoints.
+
+    Returns:
+        dict: Category names mapped to their URLs.
+    """
+    return {
+        'programming': f'{base_url}/Programming',
+        'misc': f'{base_url}/Miscellaneous',
+        'dark': f'{base_url}/Dark',
+        'pun': f'{base_url}/Pun',
+        'christmas': f'{base_url}/Christmas'
+    }
+
+class JokePool:
+    def __init__(self, http_client, base_urls, pool_size=20, low_water_mark=5, batch_size=10, telemetry=None):
+        """
+        Initializes bounded per-category pools of jokes that are refilled in the background.
+
+        Taking a joke is a local deque operation. Whenever a pool drops to `low_water_mark`,
+        a background worker fetches `batch_size` jokes in one multi-joke request.
+
+        Args:
+            http_client (HttpClient): The HTTP client to use.
+            base_urls (dict): Category names mapped to their JokeAPI URLs.
+            pool_size (int): Maximum number of jokes held per category.
+            low_water_mark (int): Pool size at which a refill is triggered.
+            batch_size (int): Jokes fetched per request (JokeAPI allows up to 10).
+            telemetry (Telemetry, optional): Receives pool hit and refill counters.
+        """
+        self.http = http_client
+        self.base_urls = base_urls
+        self.low_water_mark = low_water_mark
+        self.batch_size = min(max(1, batch_size), 10)
+        self.pools = {category: deque(maxlen=pool_size) for category in base_urls}
+        self._refilling = set()  # Categories with a refill queued or running.
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='joke-prefetch')
+        self.stats = {'served': 0, 'empty': 0, 'refills': 0, 'refill_errors': 0}
+        self.telemetry = telemetry or Telemetry(enabled=False)
+
+    def prefetch(self):
+        """Starts filling every category in the background."""
+        for category in self.pools:
+            self._schedule_refill(category)
+
+    def take(self, category):
+        """
+        Takes a joke from a category's pool, scheduling a refill when it runs low.
+
+        Args:
+            category (str): The joke category.
+
+        Returns:
+            str or None: A joke, or None if the pool is empty.
+        """
+        pool = self.pools[category]
+        try:
+            joke = pool.popleft()
+        except IndexError:
+            joke = None
+        if len(pool) <= self.low_water_mark:
+            self._schedule_refill(category)
+        self.stats['served' if joke is not None else 'empty'] += 1
+        self.telemetry.increment('chatbot_joke_pool_takes_total', result='served' if joke is not None else 'empty')
+        return joke
+
+    def _schedule_refill(self, category):
+        """Queues a refill for a category unless one is already pending."""
+        with self._lock:
+            if category in self._refilling:
+                return
+            self._refilling.add(category)
+        self._executor.submit(self._refill, category)
+
+    def _refill(self, category):
+        """Fetches a batch of jokes for a category until its pool is full."""
+        pool = self.pools[category]
+        try:
+            while len(pool) < pool.maxlen:
+                amount = min(self.batch_size, pool.maxlen - len(pool))
+                status_code, data = self.http.get_json(
+                    self.base_urls[category], params={'type': 'single', 'amount': amount}
+                )
+                if status_code != 200 or data.get('error'):
+                    self.stats['refill_errors'] += 1
+                    self.telemetry.increment('chatbot_joke_pool_refill_errors_total')
+                    return
+                # JokeAPI returns a 'jokes' list for several jokes and a single 'joke' otherwise.
+                jokes = [item.get('joke') for item in data.get('jokes', [data])]
+                jokes = [joke for joke in jokes if joke]
+                if not jokes:
+                    return
+                pool.extend(jokes)
+                self.stats['refills'] += 1
+        except Exception:
+            # Upstream unreachable: keep serving what is left; the next take retries.
+            self.stats['refill_errors'] += 1
+            self.telemetry.increment('chatbot_joke_pool_refill_errors_total')
+        finally:
+            with self._lock:
+                self._refilling.discard(category)
 
 class JokesAPI:
-    def __init__(self):
+    def __init__(self, http_client=None, base_url='https://v2.jokeapi.dev/joke', pool=None, history_size=50):
+        """
+        Initializes the JokesAPI class.
+
+        Args:
+            http_client (HttpClient, optional): The HTTP client to use. Defaults to the shared client.
+            base_url (str): Root of the JokeAPI endpoints (overridable, e.g. for a local stub).
+            pool (JokePool, optional): Prefetched jokes to serve from. Defaults to a new pool
+                                       for `base_url`.
+            history_size (int): Number of jokes remembered in the joke history.
+        """
+        self.http = http_client or get_http_client()
         # Dictionary containing the base URLs for different joke categories
-        self.base_urls = {
-            'programming': 'https://v2.jokeapi.dev/joke/Programming',
-            'misc': 'https://v2.jokeapi.dev/joke/Miscellaneous',
-            'dark': 'https://v2.jokeapi.dev/joke/Dark',
-            'pun': 'https://v2.jokeapi.dev/joke/Pun',
-            'christmas': 'https://v2.jokeapi.dev/joke/Christmas'
-        }
-        # List to store the history of jokes fetched
-        self.joke_history = []
+        self.base_urls = joke_category_urls(base_url)
+        self.pool = pool or JokePool(self.http, self.base_urls)
+        # Bounded history of the jokes told, oldest first
+        self.joke_history = deque(maxlen=history_size)
     
     def get_joke(self, category='misc'):
         """
         Fetches a joke from the specified category.
+
+        Jokes come from the local pool; JokeAPI is only called directly when the pool is
+        empty, and a built-in joke is used if that fails too.
         
         Args:
             category (str): The joke category to fetch. Defaults to 'misc'.
 
         Returns:
-            str: The fetched joke or an error message.
+            str: The fetched joke.
+        """
+        if category not in self.base_urls:
+            category = 'misc'
+        joke = self.pool.take(category)
+        if joke is None:
+            joke = self._fetch_joke(category)
+        # Save the joke to the history
+        self.joke_history.append({'category': category, 'joke': joke})
+        return joke
+
+    def _fetch_joke(self, category):
+        """
+        Fetches a single joke from JokeAPI, falling back to a built-in joke.
+
+        Args:
+            category (str): The joke category to fetch.
+
+        Returns:
+            str: The joke.
         """
         try:
-            # Get the URL for the specified category, defaulting to 'misc'
-            url = self.base_urls.get(category, self.base_urls['misc'])
-            
-            # Make an HTTP GET request to the joke API
-            response = requests.get(f"{url}?type=single")
-            
-            if response.status_code == 200:
-                # Parse the JSON response and extract the joke
-                joke_data = response.json()
-                joke = joke_data.get('joke', 'No joke found.')
-                
-                # Save the joke to the history list
-                self.joke_history.append({'category': category, 'joke': joke})
-                return joke
-            else:
-                return "Sorry, couldn't fetch a joke right now."
-        
-        except Exception as e:
-            # Handle exceptions and return an error message
-            return f"Error fetching joke: {str(e)}"
+            # Make an HTTP GET request to the joke API through the shared client
+            status_code, joke_data = self.http.get_json(self.base_urls[category], params={'type': 'single'})
+            if status_code == 200 and joke_data.get('joke'):
+                return joke_data['joke']
+        except Exception:
+            pass  # Upstream unreachable; use a built-in joke below.
+        return random.choice(FALLBACK_JOKES)
     
     def get_joke_categories(self):
         """
@@ -83,21 +261,28 @@ class JokesAPI:
             list: A list of dictionaries containing joke details.
         """
         # Return the last 'limit' number of jokes from the history
-        return self.joke_history[-limit:]
+        return list(self.joke_history)[-limit:]
+
 class WeatherIntegration:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, http_client=None, base_url="http://api.openweathermap.org/data/2.5/weather",
+                 cache_ttl=600):
         """
         Initializes the WeatherIntegration class with an API key and base URL.
 
         Args:
             api_key (str): Optional. The OpenWeatherMap API key. If not provided,
                            it attempts to fetch from Streamlit secrets.
+            http_client (HttpClient, optional): The HTTP client to use. Defaults to the shared client.
+            base_url (str): The weather endpoint (overridable, e.g. for a local stub).
+            cache_ttl (float): Seconds to reuse the weather of a city.
         """
         # Retrieve API key from arguments or Streamlit secrets
-        self.api_key = api_key or st.secrets.get('OPENWEATHERMAP_API_KEY', 'bd5e378503939ddaee76f12ad7a97608')
+        self.api_key = api_key or get_setting('OPENWEATHERMAP_API_KEY', 'bd5e378503939ddaee76f12ad7a97608')
         
         # Base URL for the OpenWeatherMap API
-        self.base_url = "http://api.openweathermap.org/data/2.5/weather"
+        self.base_url = base_url
+        self.http = http_client or get_http_client()
+        self.cache_ttl = cache_ttl
     
     def get_weather(self, city):
         """
@@ -121,9 +306,13 @@ class WeatherIntegration:
         }
         
         try:
-            # Make an HTTP GET request to fetch weather data
-            response = requests.get(self.base_url, params=params)
-            data = response.json()
+            # Fetch weather data; identical concurrent requests share one call and
+            # results are cached per city for `cache_ttl` seconds.
+            _, data = self.http.get_json(
+                self.base_url, params=params,
+                cache_key=f"weather:{' '.join(city.lower().split())}", cache_ttl=self.cache_ttl,
+                cache_if=lambda status_code, data: data.get('cod') == 200
+            )
             
             if data['cod'] == 200:  # Successful response
                 # Extract key weather details from the API response
@@ -151,325 +340,3671 @@ class WeatherIntegration:
             # Handle unexpected errors during the API call
             return f"Error fetching weather: {str(e)}"
 
+# Words too common to say anything about which memory is relevant.
+STOPWORDS = frozenset({
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'do', 'for', 'from', 'i', 'in', 'is',
+    'it', 'me', 'my', 'of', 'on', 'or', 'so', 'that', 'the', 'this', 'to', 'was', 'what', 'with', 'you'
+})
+
+def tokenize(text):
+    """
+    Splits text into lowercase word tokens, dropping stopwords.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list: The remaining tokens, in order.
+    """
+    return [token for token in re.findall(r"[a-z0-9']+", text.lower()) if token not in STOPWORDS]
+
+class MemoryIndex:
+    def __init__(self, capacity, k1=1.5, b=0.75):
+        """
+        Initializes a fixed-capacity memory store with a token-level inverted index.
+
+        Memories live in a ring buffer, so the oldest one is overwritten in O(1) when the
+        store is full. The inverted index maps each token to the memories containing it and
+        is updated on every insert and eviction, so a lookup only touches the memories that
+        share a token with the query.
+
+        Args:
+            capacity (int): Maximum number of memories to keep.
+            k1 (float): BM25 term-frequency saturation.
+            b (float): BM25 document-length normalization.
+        """
+        self.capacity = max(1, int(capacity))
+        self.k1 = k1
+        self.b = b
+        self._slots = [None] * self.capacity  # Ring buffer of (text, term frequencies, length).
+        self._next_id = 0  # Sequence number of the next memory; its slot is `id % capacity`.
+        self._postings = {}  # token -> {memory id: term frequency}
+        self._total_length = 0  # Sum of token counts, for the average document length.
+
+    def __len__(self):
+        return min(self._next_id, self.capacity)
+
+    def add(self, text):
+        """
+        Stores a memory, evicting the oldest one if the store is full.
+
+        Args:
+            text (str): The memory to store.
+        """
+        memory_id = self._next_id
+        slot = memory_id % self.capacity
+        if self._slots[slot] is not None:
+            self._evict(memory_id - self.capacity, self._slots[slot])
+        tokens = tokenize(text)
+        term_freqs = {}
+        for token in tokens:
+            term_freqs[token] = term_freqs.get(token, 0) + 1
+        for token, freq in term_freqs.items():
+            self._postings.setdefault(token, {})[memory_id] = freq
+        self._slots[slot] = (text, term_freqs, len(tokens))
+        self._total_length += len(tokens)
+        self._next_id += 1
+
+    def state(self):
+        """
+        Returns the index as plain data that can be stored as JSON.
+
+        Returns:
+            dict: The parameters and the ring buffer; the inverted index is rebuilt from them.
+        """
+        return {
+            'capacity': self.capacity, 'k1': self.k1, 'b': self.b, 'next_id': self._next_id,
+            'slots': [list(entry) if entry is not None else None for entry in self._slots]
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restores an index saved with `state`, without tokenizing its memories again.
+
+        Args:
+            state (dict): The saved state.
+
+        Returns:
+            MemoryIndex: The restored index.
+        """
+        index = cls(state['capacity'], k1=state['k1'], b=state['b'])
+        index._next_id = state['next_id']
+        first = max(0, index._next_id - index.capacity)
+        for memory_id in range(first, index._next_id):
+            text, term_freqs, length = state['slots'][memory_id % index.capacity]
+            for token, freq in term_freqs.items():
+                index._postings.setdefault(token, {})[memory_id] = freq
+            index._slots[memory_id % index.capacity] = (text, term_freqs, length)
+            index._total_length += length
+        return index
+
+    def _evict(self, memory_id, entry):
+        """Removes an overwritten memory from the inverted index."""
+        _, term_freqs, length = entry
+        for token in term_freqs:
+            postings = self._postings[token]
+            del postings[memory_id]
+            if not postings:
+                del self._postings[token]
+        self._total_length -= length
+
+    def items(self):
+        """
+        Returns the stored memories, oldest first.
+
+        Returns:
+            list: The memory texts.
+        """
+        first = max(0, self._next_id - self.capacity)
+        return [self._slots[memory_id % self.capacity][0] for memory_id in range(first, self._next_id)]
+
+    def search(self, query, top_k=5):
+        """
+        Ranks the memories sharing a token with the query using BM25.
+
+        Args:
+            query (str): The search query.
+            top_k (int): Maximum number of memories to return.
+
+        Returns:
+            list: (memory, score) tuples, best first; ties go to the most recent memory.
+        """
+        count = len(self)
+        if not count:
+            return []
+        avg_length = max(self._total_length / count, 1e-9)
+        scores = {}
+        for token in set(tokenize(query)):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            # Rare tokens say more about relevance than common ones.
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for memory_id, freq in postings.items():
+                length = self._slots[memory_id % self.capacity][2]
+                norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+                scores[memory_id] = scores.get(memory_id, 0.0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: (item[1], item[0]))
+        return [(self._slots[memory_id % self.capacity][0], score) for memory_id, score in best]
+
+class HashingEmbedder:
+    def __init__(self, dim=256, ngram=3, min_similarity=0.2):
+        """
+        Initializes a dependency-free embedder based on feature hashing.
+
+        Words and their character n-grams are hashed into a fixed number of dimensions, so
+        related word forms ("pizza", "pizzas") land close together without any model. A
+        plural 's' is dropped before hashing, so "cats" recalls "my cat is called Milo".
+        Only surface forms are matched: recalling "I love pizza" from "food" takes the
+        transformer embedder.
+
+        Args:
+            dim (int): Embedding dimensionality.
+            ngram (int): Character n-gram length used for fuzzy matching.
+            min_similarity (float): Cosine similarity below which a memory is not considered
+                                    related. Unrelated texts share few features, so they score
+                                    close to zero.
+        """
+        self.dim = dim
+        self.ngram = ngram
+        self.min_similarity = min_similarity
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text):
+        """Returns the hashed features of a text: whole words plus their character n-grams."""
+        for token in tokenize(text):
+            if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+                token = token[:-1]  # Fold plurals onto the singular ("cats" -> "cat").
+            yield 'w:' + token, 1.0
+            padded = f"<{token}>"
+            for i in range(max(1, len(padded) - self.ngram + 1)):
+                yield 'c:' + padded[i:i + self.ngram], 0.5
+
+    def embed(self, texts):
+        """
+        Embeds a batch of texts.
+
+        Args:
+            texts (list): The texts to embed.
+
+        Returns:
+            numpy.ndarray: A (len(texts), dim) float32 matrix of L2-normalized rows.
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                digest = zlib.crc32(feature.encode('utf-8'))
+                # The top bit picks the sign so that collisions tend to cancel out.
+                vectors[row, digest % self.dim] += weight if digest & 0x80000000 else -weight
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+class TransformerEmbedder:
+    def __init__(self, tokenizer, model, batch_size=16, max_tokens=64, min_similarity=0.9):
+        """
+        Initializes an embedder that mean-pools the hidden states of the already-loaded model.
+
+        Args:
+            tokenizer: The shared tokenizer.
+            model: The shared language model.
+            batch_size (int): Number of texts encoded per forward pass.
+            max_tokens (int): Texts are truncated to this many tokens.
+            min_similarity (float): Cosine similarity below which a memory is not considered
+                                    related. Mean-pooled hidden states of a causal language model
+                                    point in similar directions even for unrelated texts, so
+                                    the cutoff is much higher than for the hashing embedder.
+        """
+        self.tokenizer = tokenizer
+        self.model = model
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.min_similarity = min_similarity
+        self.dim = model.config.hidden_size
+        self.name = f"transformer-{model.config.name_or_path}"
+
+    def embed(self, texts):
+        """
+        Embeds a batch of texts.
+
+        Args:
+            texts (list): The texts to embed.
+
+        Returns:
+            numpy.ndarray: A (len(texts), dim) float32 matrix of L2-normalized rows.
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        pad_id = self.tokenizer.pad_token_id
+        if pad_id is None:
+            pad_id = self.tokenizer.eos_token_id
+        for start in range(0, len(texts), self.batch_size):
+            encoded = [
+                self.tokenizer.encode(text)[:self.max_tokens] or [self.tokenizer.eos_token_id]
+                for text in texts[start:start + self.batch_size]
+            ]
+            width = max(len(ids) for ids in encoded)
+            input_ids = torch.tensor([ids + [pad_id] * (width - len(ids)) for ids in encoded])
+            attention_mask = torch.tensor([[1] * len(ids) + [0] * (width - len(ids)) for ids in encoded])
+            with torch.no_grad():  # Disable gradient computation for inference.
+                hidden = self.model(
+                    input_ids, attention_mask=attention_mask, output_hidden_states=True
+                ).hidden_states[-1]
+            # Average the hidden states of the real (non-padding) tokens.
+            mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+            vectors[start:start + len(encoded)] = pooled.float().numpy()
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+class VectorMemory:
+    def __init__(self, embedder, capacity, min_similarity=None):
+        """
+        Initializes a fixed-capacity vector store for semantic memory recall.
+
+        Embeddings are computed once when a memory is added and kept in one contiguous
+        float32 matrix, so a lookup is a single matrix-vector product.
+
+        Args:
+            embedder: An object with `dim` and an `embed(texts)` method returning normalized rows.
+            capacity (int): Maximum number of memories to keep; the oldest are overwritten first.
+            min_similarity (float, optional): Cosine similarity below which a memory is not
+                                              considered related. Defaults to the embedder's own
+                                              `min_similarity`, since each embedder's scores
+                                              spread differently.
+        """
+        self.embedder = embedder
+        self.capacity = max(1, int(capacity))
+        if min_similarity is None:
+            min_similarity = getattr(embedder, 'min_similarity', 0.2)
+        self.min_similarity = min_similarity
+        # The matrix grows by doubling up to `capacity`, so a large limit costs nothing up front.
+        self._matrix = np.zeros((min(self.capacity, 64), embedder.dim), dtype=np.float32)
+        self._texts = [None] * self.capacity  # Ring buffer of memory texts, aligned with the matrix rows.
+        self._next_id = 0
+
+    def __len__(self):
+        return min(self._next_id, self.capacity)
+
+    @property
+    def nbytes(self):
+        """int: Bytes used by the embedding matrix."""
+        return self._matrix.nbytes
+
+    def add_many(self, texts):
+        """
+        Embeds and stores a batch of memories.
+
+        Args:
+            texts (list): The memories to store.
+        """
+        if not texts:
+            return
+        texts = list(texts)[-self.capacity:]
+        embeddings = self.embedder.embed(texts)
+        for text, embedding in zip(texts, embeddings):
+            row = self._next_id % self.capacity
+            if row >= len(self._matrix):
+                grown = np.zeros((min(self.capacity, 2 * len(self._matrix)), self._matrix.shape[1]), dtype=np.float32)
+                grown[:len(self._matrix)] = self._matrix
+                self._matrix = grown
+            self._matrix[row] = embedding
+            self._texts[row] = text
+            self._next_id += 1
+
+    def search(self, query, top_k=5):
+        """
+        Finds the memories whose embeddings are most similar to the query's.
+
+        Args:
+            query (str): The search query.
+            top_k (int): Maximum number of memories to return.
+
+        Returns:
+            list: (memory, similarity) tuples, best first.
+        """
+        count = len(self)
+        if not count:
+            return []
+        query_vector = self.embedder.embed([query])[0]
+        # Rows are normalized, so the dot product is the cosine similarity.
+        similarities = self._matrix[:count] @ query_vector
+        k = min(top_k, count)
+        candidates = np.argpartition(-similarities, k - 1)[:k]
+        candidates = candidates[np.argsort(-similarities[candidates])]
+        return [
+            (self._texts[row], float(similarities[row]))
+            for row in candidates
+            if similarities[row] >= self.min_similarity
+        ]
+
 class MemoryManager:
-    def __init__(self, max_memory_size=50):
+    def __init__(self, max_memory_size=50, embedder=None):
         """
         Initializes the MemoryManager with a specified maximum memory size.
 
-        Attributes:
-            long_term_memory (list): Stores long-term memories.
-            short_term_memory (list): Stores short-term memories.
+        Every session of a user shares one MemoryManager, so reads and writes are serialized
+        by a lock of its own.
+
+        Args:
             max_memory_size (int): Maximum number of memories to store in either memory type.
+            embedder (optional): An embedder (e.g. `HashingEmbedder`) enabling semantic recall
+                                 through a vector tier. Without one, only keyword search is used.
+
+        Attributes:
+            long_term_index (MemoryIndex): Stores and indexes long-term memories.
+            short_term_index (MemoryIndex): Stores and indexes short-term memories.
+            long_term_vectors (VectorMemory or None): Embeddings of long-term memories.
+            short_term_vectors (VectorMemory or None): Embeddings of short-term memories.
         """
-        self.long_term_memory = []  # List to store long-term memories.
-        self.short_term_memory = []  # List to store short-term memories.
         self.max_memory_size = max_memory_size  # Define the memory size limit.
+        self.long_term_index = MemoryIndex(max_memory_size)  # Ring buffer of long-term memories.
+        self.short_term_index = MemoryIndex(max_memory_size)  # Ring buffer of short-term memories.
+        self.long_term_vectors = VectorMemory(embedder, max_memory_size) if embedder else None
+        self.short_term_vectors = VectorMemory(embedder, max_memory_size) if embedder else None
+        self._lock = threading.Lock()  # Guards the indexes and vectors against concurrent sessions.
+
+    @property
+    def long_term_memory(self):
+        """list: Long-term memories, oldest first."""
+        with self._lock:
+            return self.long_term_index.items()
+
+    @property
+    def short_term_memory(self):
+        """list: Short-term memories, oldest first."""
+        with self._lock:
+            return self.short_term_index.items()
 
     def add_memory(self, memory, is_long_term=False):
         """
         Adds a memory to either short-term or long-term storage.
 
+        Once a store holds `max_memory_size` memories, the oldest one is evicted.
+
         Args:
             memory (str): The memory to store.
             is_long_term (bool): If True, the memory is added to long-term storage. Otherwise, it goes to short-term.
         """
-        if is_long_term:
-            self.long_term_memory.append(memory)  # Add memory to long-term list.
-            # Ensure long-term memory doesn't exceed the max size by removing the oldest memory.
-            if len(self.long_term_memory) > self.max_memory_size:
-                self.long_term_memory.pop(0)
-        else:
-            self.short_term_memory.append(memory)  # Add memory to short-term list.
-            # Ensure short-term memory doesn't exceed the max size by removing the oldest memory.
-            if len(self.short_term_memory) > self.max_memory_size:
-                self.short_term_memory.pop(0)
+        self.add_memories([memory], is_long_term)
+
+    def add_memories(self, memories, is_long_term=False):
+        """
+        Adds a batch of memories, embedding them in a single pass when semantic recall is enabled.
+
+        Args:
+            memories (list): The memories to store, oldest first.
+            is_long_term (bool): If True, the memories go to long-term storage.
+        """
+        index = self.long_term_index if is_long_term else self.short_term_index
+        vectors = self.long_term_vectors if is_long_term else self.short_term_vectors
+        with self._lock:
+            for memory in memories:
+                index.add(memory)
+            if vectors is not None:
+                vectors.add_many(memories)
 
-    def get_relevant_memories(self, query, memory_type='both'):
+    def get_relevant_memories(self, query, memory_type='both', top_k=5):
         """
-        Retrieves memories relevant to a given query.
+        Retrieves the memories most relevant to a given query.
+
+        Keyword (BM25) matches and, when enabled, semantic matches are merged with
+        reciprocal rank fusion, so a memory ranked well by either search comes first.
 
         Args:
             query (str): The search query to match against stored memories.
             memory_type (str): Specifies which type of memory to search. 
                                Options are 'long_term', 'short_term', or 'both' (default).
+            top_k (int): Maximum number of memories to return. Defaults to 5.
 
         Returns:
-            list: A list of relevant memories matching the query.
+            list: The relevant memories, most relevant first.
         """
+        # Pick the tiers to search.
+        tiers = []
+        if memory_type in ('short_term', 'both'):
+            tiers.append((self.short_term_index, self.short_term_vectors))
+        if memory_type in ('long_term', 'both'):
+            tiers.append((self.long_term_index, self.long_term_vectors))
 
-        def find_relevant_memories(memories, query):
-            """
-            Helper function to find relevant memories in a given list.
-
-            Args:
-                memories (list): List of stored memories to search.
-                query (str): The search query.
+        rankings = []
+        with self._lock:
+            for index, vectors in tiers:
+                rankings.append(index.search(query, top_k))
+                if vectors is not None:
+                    rankings.append(vectors.search(query, top_k))
 
-            Returns:
-                list: Memories containing any keyword from the query.
-            """
-            query_lower = query.lower()  # Convert query to lowercase for case-insensitive search.
-            return [
-                memory for memory in memories 
-                if any(keyword in memory.lower() for keyword in query_lower.split())
-            ]
+        # Reciprocal rank fusion: scores from different searches are not comparable, ranks are.
+        fused = {}
+        for ranking in rankings:
+            for rank, (memory, _) in enumerate(ranking):
+                fused[memory] = fused.get(memory, 0.0) + 1.0 / (60 + rank)
+        return [memory for memory, _ in heapq.nlargest(top_k, fused.items(), key=lambda item: item[1])]
 
-        # Search only long-term memories.
-        if memory_type == 'long_term':
-            return find_relevant_memories(self.long_term_memory, query)
-        # Search only short-term memories.
-        elif memory_type == 'short_term':
-            return find_relevant_memories(self.short_term_memory, query)
-        # Search both long-term and short-term memories and combine results.
-        else:
-            return (
-                find_relevant_memories(self.short_term_memory, query) + 
-                find_relevant_memories(self.long_term_memory, query)
-            )
-class AdvancedChatbot:
-    def __init__(self, model_name='microsoft/DialoGPT-medium'):
+class Transcript:
+    def __init__(self, exchanges=(), total=None, max_cached=100, load_page=None):
         """
-        Initializes the chatbot with a language model, memory manager, and other components.
+        Holds a conversation as (user message, bot reply) pairs, keeping only the most recent in memory.
+
+        Older exchanges live in the backing store and are read back a page at a time, so
+        memory and rendering cost do not grow with the length of the conversation.
 
         Args:
-            model_name (str): The name of the language model to use for chatbot responses.
+            exchanges (iterable): The most recent exchanges, oldest first.
+            total (int, optional): Exchanges in the whole conversation, including those only in
+                                   the backing store. Defaults to the number of `exchanges`.
+            max_cached (int): Exchanges kept in memory.
+            load_page (callable, optional): Called with (offset, limit) to read older exchanges
+                                            back. Without one, older exchanges are forgotten.
         """
-        try:
-            # Load the language model and tokenizer from the specified model.
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(model_name)
-        except Exception as e:
-            # Handle errors during model initialization.
-            st.error(f"Error initializing model: {e}")
-            self.tokenizer = None
-            self.model = None
-        
-        # Initialize a memory manager for handling long-term and short-term memories.
-        self.memory_manager = MemoryManager()
-        self.chat_history = []  # Store the chat history between the user and the chatbot.
-        self.user_name = None  # Store the user's name, if provided.
-        self.weather_service = WeatherIntegration()  # Integration for fetching weather information.
+        self._recent = deque(((user, bot) for user, bot in exchanges), maxlen=max_cached)
+        self.total = len(self._recent) if total is None else total
+        self.load_page = load_page
+        self._lock = threading.Lock()
 
-        # Define intents and their associated keywords for intent recognition.
-        self.intents = {
-            'greeting': ['hello', 'hi', 'hey', 'greetings'],
-            'weather': ['weather', 'temperature', 'forecast'],
-            'time': ['time', 'current time', 'what time'],
-            'joke': ['joke', 'humor', 'funny'],
-            'help': ['help', 'assist', 'support'],
-            'memory': ['remember', 'recall', 'memory']
-        }
-        self.jokes_api = JokesAPI()  # Integration for fetching jokes.
+    def __len__(self):
+        return self.total
 
-    def recognize_intent(self, message):
+    def append(self, user_message, bot_response):
         """
-        Recognizes the intent of the user's message.
+        Records an exchange, dropping the oldest in-memory one once `max_cached` are held.
 
         Args:
-            message (str): The user's message.
+            user_message (str): What the user said.
+            bot_response (str): What the bot replied.
+        """
+        with self._lock:
+            self._recent.append((user_message, bot_response))
+            self.total += 1
+
+    def window(self, count, end=None):
+        """
+        Returns consecutive exchanges, reading those no longer in memory from the backing store.
+
+        Args:
+            count (int): Maximum number of exchanges.
+            end (int, optional): Position after the last exchange to return. Defaults to the
+                                 end of the conversation.
 
         Returns:
-            str or tuple: The recognized intent, and additional details if necessary.
+            list: (user message, bot reply) tuples, oldest first.
         """
-        message_lower = message.lower()  # Convert the message to lowercase for case-insensitive matching.
-        
-        # Enhanced joke recognition: Check for specific joke categories.
-        if 'joke' in message_lower:
-            categories = self.jokes_api.get_joke_categories()  # Fetch available joke categories.
-            for category in categories:
-                if category in message_lower:
-                    return 'joke', category  # Return the joke intent and category.
-            return 'joke'
-
-        # Special handling for weather: Extract city if mentioned.
-        if 'weather' in message_lower or 'temperature' in message_lower:
-            city_match = re.search(r'weather in (\w+)', message_lower)  # Look for "weather in [city]" pattern.
-            if city_match:
-                return 'weather', city_match.group(1)  # Return the weather intent and city name.
-        
-        # Check for other intents by matching keywords.
-        for intent, keywords in self.intents.items():
-            if any(keyword in message_lower for keyword in keywords):
-                return intent  # Return the matched intent.
-        
-        # Default intent for unrecognized messages.
-        return 'general'
+        with self._lock:
+            end = self.total if end is None else min(end, self.total)
+            start = max(end - count, 0)
+            first_cached = self.total - len(self._recent)
+            # Index from the right: recent exchanges sit at the cheap end of the deque.
+            cached = [self._recent[position - self.total] for position in range(max(start, first_cached), end)]
+        if start >= first_cached or self.load_page is None:
+            return cached
+        return [tuple(row) for row in self.load_page(start, min(end, first_cached) - start)] + cached
+
+    @property
+    def nbytes(self):
+        """int: Approximate memory held by the in-memory exchanges' text."""
+        return sum(sys.getsizeof(user) + sys.getsizeof(bot) for user, bot in list(self._recent))
 
-    def handle_predefined_intent(self, intent, city=None):
+class UserState:
+    def __init__(self, memory_manager, user_name=None, transcript=None):
         """
-        Handles predefined intents and generates appropriate responses.
+        Holds the in-memory state of one user, as loaded from a `UserMemoryStore`.
 
         Args:
-            intent (str): The recognized intent.
-            city (str, optional): The city name for weather queries.
+            memory_manager (MemoryManager): The user's memories.
+            user_name (str, optional): The user's name, if provided.
+            transcript (Transcript, optional): The user's conversation. Defaults to an empty one.
+        """
+        self.memory_manager = memory_manager
+        self.user_name = user_name
+        self.transcript = transcript if transcript is not None else Transcript()
+
+class UserMemoryStore:
+    def __init__(self, path='chatbot_memory.db', max_cached_users=256, max_memory_size=50,
+                 flush_interval=5.0, flush_batch_size=100, max_cached_exchanges=100):
+        """
+        Initializes a durable per-user store for memories, names and chat history.
+
+        Users are loaded from SQLite on first access and kept in a bounded LRU cache, so a
+        worker can serve many users without holding all of their memories in RAM. Writes
+        update the cached state immediately and are persisted in batches, either when
+        `flush_batch_size` writes are pending or every `flush_interval` seconds.
+
+        Args:
+            path (str): SQLite database file.
+            max_cached_users (int): Maximum number of users kept in memory.
+            max_memory_size (int): Memories loaded per user and tier (see `MemoryManager`).
+            flush_interval (float): Seconds between background flushes.
+            flush_batch_size (int): Pending writes that trigger an immediate flush.
+            max_cached_exchanges (int): Most recent exchanges of each user's transcript kept in
+                                        memory; older ones are read back from disk on demand.
+        """
+        self.path = path
+        self.max_cached_exchanges = max_cached_exchanges
+        self.max_cached_users = max_cached_users
+        self.max_memory_size = max_memory_size
+        self.flush_batch_size = flush_batch_size
+        self._lock = threading.RLock()  # Guards the connection, the cache and the pending writes.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')  # Let several worker processes share the file.
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                is_long_term INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS memories_by_user ON memories (user_id, is_long_term, id);
+            CREATE TABLE IF NOT EXISTS profiles (
+                user_id TEXT PRIMARY KEY,
+                user_name TEXT
+            );
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                user TEXT NOT NULL,
+                bot TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chat_history_by_user ON chat_history (user_id, id);
+        """)
+        self._cache = OrderedDict()  # user_id -> UserState, least recently used first.
+        self._pending = []  # (sql, params) writes not yet committed.
+        self._flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval,),
+                                         name='memory-store-flush', daemon=True)
+        self._flusher.start()
+
+    def get(self, user_id, embedder=None):
+        """
+        Returns a user's state, loading it from disk on first access.
+
+        Args:
+            user_id (str): The user's identifier.
+            embedder (optional): Embedder for the user's semantic memory tier, used when loading.
 
         Returns:
-            str: The chatbot's response.
+            UserState: The user's cached state.
         """
-        if intent == 'greeting':
-            # Generate a greeting message, including the user's name if available.
-            greeting = f"Hello{' ' + self.user_name if self.user_name else ''}! How can I help you today?"
-            return greeting
-        
-        elif intent == 'weather':
-            # Fetch and return weather information for the specified city.
-            if city:
-                return self.weather_service.get_weather(city)
-            return "Please specify a city. Example: 'weather in New York'"
-        
-        elif intent == 'time':
-            # Return the current time.
-            return f"The current time is {datetime.datetime.now().strftime('%I:%M %p')}."
-        
-        elif intent == 'joke':
-            # Fetch and return a random joke.
-            return self.jokes_api.get_random_joke()
-        
-        elif intent == 'help':
-            # Provide information about the chatbot's capabilities.
-            return "I can help with questions, tell jokes, or chat casually."
-        
-        return None  # Return None if the intent is unhandled.
+        with self._lock:
+            state = self._cache.get(user_id)
+            if state is not None:
+                self._cache.move_to_end(user_id)
+                return state
+            # Pending writes may belong to this user if it was recently evicted from the cache.
+            self.flush()
+            state = self._load(user_id, embedder)
+            self._cache[user_id] = state
+            while len(self._cache) > self.max_cached_users:
+                self._cache.popitem(last=False)  # Evict the least recently used user.
+            return state
 
-    def process_message(self, message):
+    def _load(self, user_id, embedder):
+        """Reads a user's most recent memories, name and history from the database."""
+        memory_manager = MemoryManager(self.max_memory_size, embedder=embedder)
+        for is_long_term in (True, False):
+            rows = self._connection.execute(
+                "SELECT text FROM memories WHERE user_id = ? AND is_long_term = ? ORDER BY id DESC LIMIT ?",
+                (user_id, int(is_long_term), self.max_memory_size)
+            ).fetchall()
+            # Insert oldest first, embedding the whole tier in one batch.
+            memory_manager.add_memories([text for (text,) in reversed(rows)], is_long_term)
+        profile = self._connection.execute(
+            "SELECT user_name FROM profiles WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        history = self._connection.execute(
+            "SELECT user, bot FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, self.max_cached_exchanges)
+        ).fetchall()
+        (total,) = self._connection.execute(
+            "SELECT COUNT(*) FROM chat_history WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        transcript = Transcript(
+            reversed(history), total=total, max_cached=self.max_cached_exchanges,
+            load_page=lambda offset, limit: self.load_exchanges(user_id, offset, limit)
+        )
+        return UserState(memory_manager, user_name=profile[0] if profile else None, transcript=transcript)
+
+    def load_exchanges(self, user_id, offset, limit):
         """
-        Processes a user message and generates an appropriate response.
+        Reads a page of a user's transcript from disk.
 
         Args:
-            message (str): The user's message.
+            user_id (str): The user's identifier.
+            offset (int): Position of the first exchange, counting from the start of the conversation.
+            limit (int): Maximum number of exchanges.
 
         Returns:
-            str: The chatbot's response.
+            list: (user message, bot reply) tuples, oldest first.
         """
-        # Check for memory-related commands (e.g., "remember", "recall").
-        if message.lower().startswith('remember '):
-            memory = message[9:]  # Extract the memory to store.
-            self.memory_manager.add_memory(memory, is_long_term=True)  # Add to long-term memory.
-            return f"I'll remember: {memory}"
-        
-        if message.lower().startswith('recall '):
-            query = message[7:]  # Extract the query for retrieving memories.
-            memories = self.memory_manager.get_relevant_memories(query)  # Search for relevant memories.
-            if memories:
-                return "Related memories:\n" + "\n".join(memories)  # Return matched memories.
-            return "No relevant memories found."
-        
-        if message.lower().startswith('my name is '):
-            self.user_name = message.split('my name is ')[1].strip()  # Extract the user's name.
-            self.memory_manager.add_memory(f"User's name is {self.user_name}", is_long_term=True)  # Store the name.
-            return f"Nice to meet you, {self.user_name}!"
-        
-        # Check for joke history requests.
-        if 'joke history' in message.lower():
-            joke_history = self.jokes_api.get_joke_history()  # Fetch joke history.
-            if joke_history:
-                return "Recent Joke History:\n" + "\n".join([
-                    f"Category: {joke['category']}, Joke: {joke['joke']}" 
-                    for joke in joke_history
-                ])
-            return "No joke history available."
-        
-        # Recognize the user's intent from the message.
-        intent_result = self.recognize_intent(message)
-        
-        # Handle predefined intents with special arguments (e.g., city for weather).
-        if isinstance(intent_result, tuple):
-            intent, city = intent_result
-            intent_response = self.handle_predefined_intent(intent, city)
-            if intent_response:
-                return intent_response
+        with self._lock:
+            self.flush()  # The page may include exchanges not written yet.
+            return self._connection.execute(
+                "SELECT user, bot FROM chat_history WHERE user_id = ? ORDER BY id LIMIT ? OFFSET ?",
+                (user_id, limit, offset)
+            ).fetchall()
+
+    def add_memories(self, user_id, memories, is_long_term=False, embedder=None):
+        """
+        Stores memories for a user.
+
+        Args:
+            user_id (str): The user's identifier.
+            memories (list): The memories to store, oldest first.
+            is_long_term (bool): If True, the memories go to long-term storage.
+            embedder (optional): Embedder used if the user has to be loaded first.
+        """
+        with self._lock:
+            self.get(user_id, embedder).memory_manager.add_memories(memories, is_long_term)
+            now = time.time()
+            self._write([
+                ("INSERT INTO memories (user_id, is_long_term, text, created_at) VALUES (?, ?, ?, ?)",
+                 (user_id, int(is_long_term), memory, now))
+                for memory in memories
+            ])
+
+    def set_user_name(self, user_id, user_name, embedder=None):
+        """
+        Stores a user's name.
+
+        Args:
+            user_id (str): The user's identifier.
+            user_name (str): The name to store.
+            embedder (optional): Embedder used if the user has to be loaded first.
+        """
+        with self._lock:
+            self.get(user_id, embedder).user_name = user_name
+            self._write([(
+                "INSERT INTO profiles (user_id, user_name) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET user_name = excluded.user_name",
+                (user_id, user_name)
+            )])
+
+    def add_exchange(self, user_id, user_message, bot_response, embedder=None):
+        """
+        Appends a user/bot exchange to a user's transcript.
+
+        Args:
+            user_id (str): The user's identifier.
+            user_message (str): What the user said.
+            bot_response (str): What the bot replied.
+            embedder (optional): Embedder used if the user has to be loaded first.
+        """
+        with self._lock:
+            self.get(user_id, embedder).transcript.append(user_message, bot_response)
+            self._write([(
+                "INSERT INTO chat_history (user_id, user, bot, created_at) VALUES (?, ?, ?, ?)",
+                (user_id, user_message, bot_response, time.time())
+            )])
+
+    def _write(self, statements):
+        """Queues writes, flushing right away once enough are pending."""
+        self._pending.extend(statements)
+        if len(self._pending) >= self.flush_batch_size:
+            self.flush()
+
+    def flush(self):
+        """Commits all pending writes in a single transaction."""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            with self._connection:  # Commits on success, rolls back on error.
+                for sql, params in pending:
+                    self._connection.execute(sql, params)
+
+    def _flush_periodically(self, interval):
+        """Background loop bounding how long a write can stay in memory only."""
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass  # Keep the loop alive; the next flush retries with newer writes.
+
+    def cached_users(self):
+        """
+        Returns how many users are currently held in memory.
+
+        Returns:
+            int: The number of cached users.
+        """
+        with self._lock:
+            return len(self._cache)
+
+def get_setting(name, default=None):
+    """
+    Reads a configuration value from the environment or Streamlit secrets.
+
+    Args:
+        name (str): The setting name, e.g. 'INFERENCE_MAX_BATCH_SIZE'.
+        default: The value to return when the setting is not configured.
+
+    Returns:
+        The configured value, or the default.
+    """
+    if name in os.environ:
+        return os.environ[name]
+    try:
+        return st.secrets.get(name, default)
+    except Exception:
+        # No secrets file is available (e.g. outside `streamlit run`).
+        return default
+
+class Span:
+    def __init__(self, telemetry, name, labels):
+        """
+        Times a block of code into a histogram of `Telemetry`.
+
+        Args:
+            telemetry (Telemetry): Where the duration is recorded.
+            name (str): The histogram, e.g. 'chatbot_http_request_seconds'.
+            labels (dict): Labels of the recorded series.
+        """
+        self.telemetry = telemetry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.telemetry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None:
+            self.telemetry.increment('chatbot_span_errors_total', span=self.name)
+        return False
+
+class LogExporter:
+    def __init__(self, logger=None):
+        """
+        Writes one JSON log line per processed message.
+
+        Args:
+            logger (logging.Logger, optional): Defaults to the 'chatbot.trace' logger, writing
+                                               to stderr unless logging is configured for it.
+        """
+        if logger is None:
+            logger = logging.getLogger('chatbot.trace')
+            if not logger.hasHandlers():
+                handler = logging.StreamHandler()
+                handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+                logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+        self.logger = logger
+
+    def export(self, trace):
+        """
+        Logs a finished trace.
+
+        Args:
+            trace (dict): The message's route and per-stage timings.
+        """
+        self.logger.info(json.dumps(trace, sort_keys=True))
+
+class Telemetry:
+    # Histogram bucket upper bounds in seconds, from sub-millisecond stages to slow generations.
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+    RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+    def __init__(self, enabled=True, exporters=None, buckets=None):
+        """
+        Collects timed spans, counters and histograms from the chatbot pipeline.
+
+        Metrics are aggregated in process and read with `snapshot` or `render_prometheus`;
+        every finished message is also handed to the exporters. When disabled every call
+        returns immediately, so instrumented code only pays for a method call.
+
+        Args:
+            enabled (bool): Whether anything is recorded.
+            exporters (list, optional): Objects with an `export(trace)` method, e.g. `LogExporter`.
+            buckets (dict, optional): Histogram names mapped to bucket upper bounds. Others use
+                                      `DEFAULT_BUCKETS`.
+        """
+        self.enabled = enabled
+        self.exporters = list(exporters or [])
+        self.buckets = {
+            'chatbot_generated_tokens_per_second': self.TOKENS_PER_SECOND_BUCKETS,
+            'chatbot_draft_acceptance_ratio': self.RATIO_BUCKETS
+        }
+        self.buckets.update(buckets or {})
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [per-bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def span(self, name, **labels):
+        """
+        Returns a context manager that records how long its block takes.
+
+        Args:
+            name (str): The histogram to record into.
+            **labels: Labels of the series, e.g. host='api.openweathermap.org'.
+
+        Returns:
+            A context manager.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, labels)
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds to a counter.
+
+        Args:
+            name (str): The counter, e.g. 'chatbot_http_cache_hits_total'.
+            value (float): The amount to add.
+            **labels: Labels of the series.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value in a histogram.
+
+        Args:
+            name (str): The histogram, e.g. 'chatbot_stage_seconds'.
+            value (float): The observed value.
+            **labels: Labels of the series.
+        """
+        if not self.enabled:
+            return
+        bounds = self.buckets.get(name, self.DEFAULT_BUCKETS)
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(bounds) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(bounds, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def export(self, trace):
+        """
+        Hands a finished message's trace to every exporter.
+
+        Args:
+            trace (dict): The message's route and per-stage timings.
+        """
+        if not self.enabled:
+            return
+        for exporter in self.exporters:
+            try:
+                exporter.export(trace)
+            except Exception:
+                self.increment('chatbot_exporter_errors_total')
+
+    def snapshot(self):
+        """
+        Returns the current value of every metric.
+
+        Returns:
+            dict: {'counters': {series: value}, 'histograms': {series: {'count', 'sum', 'p50',
+                  'p95', 'p99'}}}. Series are named as in the Prometheus format, e.g.
+                  'chatbot_stage_seconds{stage="generation"}'. Quantiles are the upper bound
+                  of the bucket they fall in.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self._histograms.items()}
+        snapshot = {'counters': {}, 'histograms': {}}
+        for (name, labels), value in sorted(counters.items()):
+            snapshot['counters'][self._series(name, labels)] = value
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            bounds = self.buckets.get(name, self.DEFAULT_BUCKETS)
+            summary = {'count': count, 'sum': total}
+            for quantile in (50, 95, 99):
+                summary[f'p{quantile}'] = self._quantile(bounds, counts, count, quantile / 100)
+            snapshot['histograms'][self._series(name, labels)] = summary
+        return snapshot
+
+    def render_prometheus(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics page.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self._histograms.items()}
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{self._series(name, labels)} {value}")
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets.get(name, self.DEFAULT_BUCKETS), counts):
+                cumulative += bucket_count
+                lines.append(f"{self._series(name + '_bucket', labels + (('le', repr(float(bound))),))} {cumulative}")
+            lines.append(f"{self._series(name + '_bucket', labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self._series(name + '_sum', labels)} {total}")
+            lines.append(f"{self._series(name + '_count', labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _series(name, labels):
+        """Formats a series name with its labels, e.g. 'name{stage="memory"}'."""
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    @staticmethod
+    def _quantile(bounds, counts, count, quantile):
+        """Estimates a quantile as the upper bound of the bucket it falls in (inf past the last bound)."""
+        if count == 0:
+            return None
+        rank = quantile * count
+        cumulative = 0
+        for bound, bucket_count in zip(bounds, counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+# Returned by disabled telemetry: entering and leaving it does nothing.
+NULL_SPAN = contextlib.nullcontext()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves `Telemetry.render_prometheus` at /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = self.server.telemetry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are frequent; don't log each one.
+
+def serve_metrics(telemetry, port, host='127.0.0.1'):
+    """
+    Serves a Prometheus-style metrics endpoint from a background thread.
+
+    Args:
+        telemetry (Telemetry): The metrics to serve.
+        port (int): The port to listen on.
+        host (str): The interface to listen on. Defaults to loopback only, like `server.py`.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.telemetry = telemetry
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+class InferenceQueueFull(RuntimeError):
+    """Raised when the inference queue has no room for another request."""
+
+class InferenceScheduler:
+    def __init__(self, tokenizer, model, max_batch_size=8, max_wait_ms=10, max_queue_size=64,
+                 generate_kwargs=None, telemetry=None, num_threads=None):
+        """
+        Initializes a scheduler that batches generation requests from all sessions.
+
+        Requests are queued and a single worker thread pads them into dynamic batches,
+        flushing when the batch is full or when the oldest request has waited `max_wait_ms`.
+
+        Args:
+            tokenizer: The shared tokenizer (used for its padding token).
+            model: The shared language model.
+            max_batch_size (int): Maximum number of requests per `model.generate` call.
+            max_wait_ms (float): Maximum time to wait for a batch to fill up.
+            max_queue_size (int): Maximum number of pending requests before rejecting new ones.
+            generate_kwargs (dict, optional): Default keyword arguments for `model.generate`.
+                                              Replies are bounded to 128 new tokens by default.
+            telemetry (Telemetry, optional): Receives `model.generate` timings and token rates.
+            num_threads (int, optional): Intra-op threads used by the worker's `generate` calls.
+                                         Defaults to torch's setting (one per core).
+        """
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.generate_kwargs = {
+            'max_new_tokens': 128,  # Maximum length of the generated response.
+            'pad_token_id': tokenizer.eos_token_id  # Use the EOS token for padding.
+        }
+        self.generate_kwargs.update(generate_kwargs or {})
+        self._queue = queue.Queue(maxsize=max(1, int(max_queue_size)))  # Pending requests.
+        self._worker = None  # Started on the first submission.
+        self._worker_lock = threading.Lock()
+        self.num_threads = num_threads
+        self.stats = {'requests': 0, 'batches': 0, 'rejected': 0}
+        # Work done per decoding mode: 'standard', or 'assisted' when a draft model proposes tokens.
+        self.decoding = {
+            mode: {'requests': 0, 'tokens': 0, 'seconds': 0.0, 'draft_tokens': 0, 'accepted_tokens': 0}
+            for mode in ('standard', 'assisted')
+        }
+        self.telemetry = telemetry or Telemetry(enabled=False)
+
+    def submit(self, input_ids, past_key_values=None, return_cache=False, streamer=None, stopping_criteria=None,
+               **generate_kwargs):
+        """
+        Queues a generation request.
+
+        Requests are batched with others unless they bring a KV cache or use assisted
+        decoding. Within a batch every request keeps its own streamer, stopping criteria and
+        returned cache.
+
+        Args:
+            input_ids (list): The prompt token IDs.
+            past_key_values (optional): A KV cache covering a prefix of `input_ids`, so that only
+                                        the uncached tokens are encoded. Such requests run as a
+                                        batch of one.
+            return_cache (bool): If True, the future also returns the request's updated KV cache.
+            streamer (optional): Receives this request's tokens as they are generated.
+            stopping_criteria (StoppingCriteriaList, optional): Ends this request's generation early.
+            **generate_kwargs: Overrides for `model.generate`. Only requests with identical
+                               overrides are batched together. An `assistant_model` (a smaller
+                               draft model sharing the tokenizer) enables assisted decoding.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the list of generated token IDs, or to a
+                                       (token IDs, cache) tuple when `return_cache` is True.
+
+        Raises:
+            InferenceQueueFull: If `max_queue_size` requests are already pending.
+        """
+        self._ensure_worker()
+        future = Future()
+        row = {
+            'past_key_values': past_key_values, 'return_cache': return_cache,
+            'streamer': streamer, 'stopping_criteria': stopping_criteria
+        }
+        if past_key_values is not None or 'assistant_model' in generate_kwargs:
+            # Input caches of different lengths cannot be padded into one batch, and assisted
+            # decoding only supports a single sequence, so these run as a batch of one.
+            batch_key = ('solo', id(future))
+        else:
+            batch_key = tuple(sorted(generate_kwargs.items()))
+            try:
+                hash(batch_key)
+            except TypeError:
+                batch_key = ('solo', id(future))  # Per-request objects in the overrides.
+        try:
+            self._queue.put_nowait((list(input_ids), generate_kwargs, batch_key, future, row))
+        except queue.Full:
+            self.stats['rejected'] += 1
+            self.telemetry.increment('chatbot_inference_rejected_total')
+            raise InferenceQueueFull("Too many pending generation requests.")
+        return future
+
+    def shutdown(self):
+        """Stops the worker thread once the requests queued so far have been served."""
+        with self._worker_lock:
+            if self._worker is not None and self._worker.is_alive():
+                self._queue.put(None)  # Sentinel telling the worker to exit.
+                self._worker.join()
+            self._worker = None
+
+    def _ensure_worker(self):
+        """Starts the background worker thread if it is not running yet."""
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        """Worker loop: collects requests into batches and runs them."""
+        if self.num_threads:
+            # Bound the cores one generate call may use, so it does not contend with the rest of the process.
+            torch.set_num_threads(self.num_threads)
+        while True:
+            request = self._queue.get()  # Block until there is work.
+            if request is None:
+                return
+            batch = [request]
+            deadline = time.monotonic() + self.max_wait
+            # Keep collecting until the batch is full or the wait window has passed.
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    # Serve what was collected, then stop.
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+            # Requests with different generation settings cannot share a `generate` call.
+            groups = {}
+            for request in batch:
+                groups.setdefault(request[2], []).append(request)
+            for group in groups.values():
+                self._generate_batch(group)
+
+    def _generate_batch(self, requests):
+        """
+        Pads a group of requests into one batch, generates, and resolves their futures.
+
+        Args:
+            requests (list): Queued (input_ids, generate_kwargs, batch_key, future, row options) tuples.
+        """
+        # Skip requests whose callers have already given up on them.
+        requests = [request for request in requests if request[3].set_running_or_notify_cancel()]
+        if not requests:
+            return
+        try:
+            pad_id = self.tokenizer.pad_token_id
+            if pad_id is None:
+                pad_id = self.tokenizer.eos_token_id
+            width = max(len(request[0]) for request in requests)
+            # Decoder-only models continue from the last position, so pad on the left.
+            input_ids = torch.tensor([[pad_id] * (width - len(request[0])) + request[0] for request in requests])
+            attention_mask = torch.tensor([[0] * (width - len(request[0])) + [1] * len(request[0]) for request in requests])
+            kwargs = dict(self.generate_kwargs)
+            kwargs.update(requests[0][1])
+            rows = [request[4] for request in requests]
+            if len(requests) == 1:
+                kwargs['past_key_values'] = rows[0]['past_key_values']
+            # Per-request streamers and stopping criteria each see only their own row.
+            if any(row['streamer'] is not None for row in rows):
+                kwargs['streamer'] = RowStreamers([row['streamer'] for row in rows])
+            if any(row['stopping_criteria'] is not None for row in rows):
+                kwargs['stopping_criteria'] = transformers.StoppingCriteriaList(
+                    [RowStoppingCriteria([row['stopping_criteria'] for row in rows])]
+                )
+            kwargs['return_dict_in_generate'] = any(row['return_cache'] for row in rows)
+            assistant_model = kwargs.get('assistant_model')
+            counter = ForwardCallCounter(self.model, assistant_model) if assistant_model is not None else NULL_SPAN
+            start = time.perf_counter()
+            with torch.no_grad(), counter:  # Disable gradient computation for inference.
+                output = self.model.generate(input_ids, attention_mask=attention_mask, **kwargs)
+            elapsed = time.perf_counter() - start
+            self.stats['batches'] += 1
+            self.stats['requests'] += len(requests)
+            sequences = output.sequences if kwargs.get('return_dict_in_generate') else output
+            # Slice out only the generated part of each row.
+            generated_rows = sequences[:, width:].tolist()
+            # Rows that finish early are padded to the longest one; only count the tokens before
+            # each row's end of sequence (padding may reuse the EOS token, so it ends the count).
+            stop_ids = {self.tokenizer.eos_token_id, pad_id}
+            generated = sum(
+                next((position for position, token in enumerate(row_ids) if token in stop_ids), len(row_ids))
+                for row_ids in generated_rows
+            )
+            self._record_decoding(
+                generated, elapsed, counter if assistant_model is not None else None, requests=len(requests)
+            )
+            for index, (row_ids, request) in enumerate(zip(generated_rows, requests)):
+                if not request[4]['return_cache']:
+                    request[3].set_result(row_ids)
+                elif len(requests) == 1:
+                    request[3].set_result((row_ids, output.past_key_values))
+                else:
+                    # Hand each conversation its own rows of the cache, without the left padding.
+                    padding = width - len(request[0])
+                    request[3].set_result((row_ids, split_cache(output.past_key_values, index, padding)))
+        except Exception as e:
+            for request in requests:
+                request[3].set_exception(e)
+
+    def _record_decoding(self, generated, elapsed, counter=None, requests=1):
+        """
+        Accounts for one `model.generate` call in the decoding statistics and telemetry.
+
+        In assisted decoding every forward call of the main model verifies the draft's
+        proposals and yields the accepted ones plus one token of its own, so the accepted
+        draft tokens are the generated tokens minus the main model's forward calls.
+
+        Args:
+            generated (int): Tokens generated by the call, excluding the padding of finished rows.
+            elapsed (float): Seconds the call took.
+            counter (ForwardCallCounter, optional): Forward calls of the main and draft model
+                                                    during an assisted call.
+            requests (int): Requests served by the call (its batch size).
+        """
+        mode = 'standard' if counter is None else 'assisted'
+        stats = self.decoding[mode]
+        stats['requests'] += requests
+        stats['tokens'] += generated
+        stats['seconds'] += elapsed
+        if counter is not None:
+            verifications, draft_tokens = counter.counts
+            accepted = min(max(generated - verifications, 0), draft_tokens)
+            stats['draft_tokens'] += draft_tokens
+            stats['accepted_tokens'] += accepted
+        if self.telemetry.enabled:
+            self.telemetry.observe('chatbot_generate_seconds', elapsed)
+            self.telemetry.increment('chatbot_generated_tokens_total', generated)
+            self.telemetry.observe('chatbot_generated_tokens_per_second', generated / max(elapsed, 1e-9), decoding=mode)
+            if counter is not None:
+                self.telemetry.increment('chatbot_draft_tokens_total', draft_tokens)
+                self.telemetry.increment('chatbot_draft_accepted_tokens_total', accepted)
+                if draft_tokens:
+                    self.telemetry.observe('chatbot_draft_acceptance_ratio', accepted / draft_tokens)
+
+    def decoding_stats(self):
+        """
+        Summarizes throughput per decoding mode and how many draft tokens were accepted.
+
+        Returns:
+            dict: For 'standard' and 'assisted': requests, tokens, tokens_per_second and, for
+                  assisted decoding, the draft tokens proposed and the acceptance_rate.
+        """
+        summary = {}
+        for mode, stats in self.decoding.items():
+            stats = dict(stats)
+            summary[mode] = {
+                'requests': stats['requests'],
+                'tokens': stats['tokens'],
+                'tokens_per_second': round(stats['tokens'] / stats['seconds'], 2) if stats['seconds'] else None
+            }
+            if mode == 'assisted':
+                summary[mode]['draft_tokens'] = stats['draft_tokens']
+                summary[mode]['acceptance_rate'] = (
+                    round(stats['accepted_tokens'] / stats['draft_tokens'], 3) if stats['draft_tokens'] else None
+                )
+        return summary
+
+def split_cache(cache, row, start):
+    """
+    Copies one row of a batched KV cache into a cache of its own.
+
+    Args:
+        cache (DynamicCache): The cache returned by a batched `model.generate` call.
+        row (int): The batch row to copy.
+        start (int): Positions to skip at the start of the row (its left padding).
+
+    Returns:
+        DynamicCache: The row's cache, as if it had been generated on its own.
+    """
+    row_cache = transformers.DynamicCache()
+    for layer_index, layer in enumerate(cache.layers):
+        row_cache.update(
+            layer.keys[row:row + 1, :, start:].clone(), layer.values[row:row + 1, :, start:].clone(), layer_index
+        )
+    return row_cache
+
+class RowStreamers:
+    def __init__(self, streamers):
+        """
+        Fans the tokens of a batched generation out to one streamer per row.
+
+        Args:
+            streamers (list): A streamer (or None) for every row of the batch.
+        """
+        self.streamers = streamers
+
+    def put(self, value):
+        # The prompt arrives as a (batch, length) tensor, each new step as a (batch,) one.
+        for row, streamer in enumerate(self.streamers):
+            if streamer is not None:
+                streamer.put(value[row:row + 1])
+
+    def end(self):
+        for streamer in self.streamers:
+            if streamer is not None:
+                streamer.end()
+
+class RowStoppingCriteria:
+    def __init__(self, criteria):
+        """
+        Applies per-request stopping criteria to their own rows of a batched generation.
+
+        Follows the `transformers.StoppingCriteria` call protocol without subclassing it.
+
+        Args:
+            criteria (list): A `StoppingCriteriaList` (or None) for every row of the batch.
+        """
+        self.criteria = criteria
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros((input_ids.shape[0],), dtype=torch.bool, device=input_ids.device)
+        for row, criteria in enumerate(self.criteria):
+            if criteria is not None:
+                done[row] = bool(criteria(
+                    input_ids[row:row + 1], scores[row:row + 1] if scores is not None else None, **kwargs
+                )[0])
+        return done
+
+class ForwardCallCounter:
+    def __init__(self, *models):
+        """
+        Counts the forward calls each model makes on the current thread while the counter is active.
+
+        Other threads may run the same shared models at the same time, so their calls are ignored.
+
+        Args:
+            *models (torch.nn.Module): The models to watch.
+        """
+        self.models = models
+        self.counts = [0] * len(models)
+        self._thread = None
+        self._handles = []
+
+    def __enter__(self):
+        self._thread = threading.get_ident()
+        self._handles = [model.register_forward_hook(self._hook(index)) for index, model in enumerate(self.models)]
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _hook(self, index):
+        def hook(module, inputs, output):
+            if threading.get_ident() == self._thread:
+                self.counts[index] += 1
+        return hook
+
+class CancelledCriteria:
+    def __init__(self, event):
+        """
+        Initializes a stopping criterion that ends generation once an event is set.
+
+        It follows the `transformers.StoppingCriteria` call protocol without subclassing it,
+        so that transformers is not imported before a model is needed.
+
+        Args:
+            event (threading.Event): Set by the caller when the reply is no longer needed.
+        """
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class PendingGeneration:
+    def __init__(self, new_ids, future, cancel_event, returns_cache=True, cache_key=None, cached=False):
+        """
+        Tracks a queued generation that its caller may still discard.
+
+        Args:
+            new_ids (list): Token IDs of the user message being answered.
+            future (concurrent.futures.Future): Resolves to (generated IDs, KV cache).
+            cancel_event (threading.Event): Stops the generation early when set.
+            returns_cache (bool): Whether the future resolves to (generated IDs, KV cache) rather
+                                  than to the IDs alone.
+            cache_key (str, optional): Where the reply is stored in the response cache once complete.
+            cached (bool): Whether the reply was served from the response cache.
+        """
+        self.new_ids = new_ids
+        self.future = future
+        self.cancel_event = cancel_event
+        self.returns_cache = returns_cache
+        self.cache_key = cache_key
+        self.cached = cached
+
+    def result(self, timeout=None):
+        """
+        Waits for the generation.
+
+        Args:
+            timeout (float, optional): Seconds to wait before giving up.
+
+        Returns:
+            tuple: (generated IDs, KV cache), where the cache is None if none was returned.
+
+        Raises:
+            concurrent.futures.TimeoutError: If the generation is not done within `timeout`.
+        """
+        result = self.future.result(timeout=timeout)
+        return result if self.returns_cache else (result, None)
+
+    def cancel(self):
+        """Drops the request if it is still queued, or stops it at the next token if it is running."""
+        self.cancel_event.set()
+        self.future.cancel()
+
+class ConversationContext:
+    def __init__(self, eos_token_id, max_context_tokens=512, low_water_ratio=0.75, idle_timeout=600):
+        """
+        Initializes the multi-turn context of one conversation.
+
+        The context keeps the token IDs of previous turns together with the model's KV cache
+        (`past_key_values`) for them, so each new turn only encodes its own tokens.
+
+        Args:
+            eos_token_id (int): Token appended after every turn, as DialoGPT expects.
+            max_context_tokens (int): Token budget for previous turns plus the new message.
+            low_water_ratio (float): When the budget is exceeded, the oldest turns are evicted until
+                                     the context fits in this fraction of the budget. Evicting a
+                                     batch of turns at once means the cache, which must be rebuilt
+                                     after the positions shift, is only recomputed every few turns.
+            idle_timeout (float): Seconds of inactivity after which the KV cache is dropped.
+        """
+        self.eos_token_id = eos_token_id
+        self.max_context_tokens = max_context_tokens
+        self.low_water_ratio = low_water_ratio
+        self.idle_timeout = idle_timeout
+        self.turns = []  # Token IDs of previous turns, oldest first, each ending with EOS.
+        self.cache = None  # KV cache covering the first `cached_length` tokens of the turns.
+        self.cached_length = 0
+        self.last_used = time.monotonic()
+        self._in_flight = None  # Future of the latest generation using the cache.
+        self._lock = threading.Lock()
+
+    def token_count(self):
+        """
+        Returns the number of tokens held in previous turns.
+
+        Returns:
+            int: The total length of all stored turns.
+        """
+        return sum(len(turn) for turn in self.turns)
+
+    def prepare(self, new_ids):
+        """
+        Builds the prompt for a new turn, evicting old turns if the budget is exceeded.
+
+        Args:
+            new_ids (list): Token IDs of the new user message (ending with EOS).
+
+        Returns:
+            tuple: (input_ids, past_key_values) for `model.generate`. The cache, if any,
+                   covers a prefix of the returned input IDs.
+        """
+        with self._lock:
+            if self._in_flight is not None:
+                # A discarded generation may still be extending the cache; let it stop first.
+                # One cancelled while still queued never touches the cache, and `wait` would
+                # not see it as done until the scheduler reaches it, so it is not waited on.
+                if not self._in_flight.cancelled():
+                    wait([self._in_flight])
+                self._in_flight = None
+            self.last_used = time.monotonic()
+            new_ids = list(new_ids)[-self.max_context_tokens:]  # A huge message keeps its tail.
+            if self.token_count() + len(new_ids) > self.max_context_tokens:
+                # Slide the window: drop the oldest turns, then rebuild the cache from scratch.
+                target = int(self.max_context_tokens * self.low_water_ratio)
+                while self.turns and self.token_count() + len(new_ids) > target:
+                    self.turns.pop(0)
+                self.drop_cache()
+            if self.cache is not None:
+                # A discarded or failed generation may have extended the cache past the committed turns.
+                excess = self.cache.get_seq_length() - self.cached_length
+                if excess > 0:
+                    self.cache.crop(-excess)
+            history = [token for turn in self.turns for token in turn]
+            return history + new_ids, self.cache
+
+    def attach(self, future):
+        """
+        Records the generation that is now using the cache returned by `prepare`.
+
+        Args:
+            future (concurrent.futures.Future): The queued generation.
+        """
+        with self._lock:
+            self._in_flight = future
+
+    def commit(self, new_ids, reply_ids, cache):
+        """
+        Records a completed turn and the KV cache produced while generating it.
+
+        Args:
+            new_ids (list): Token IDs of the user message passed to `prepare`.
+            reply_ids (list): Generated token IDs of the bot's reply.
+            cache: The KV cache returned by `model.generate`.
+        """
+        with self._lock:
+            new_ids = list(new_ids)[-self.max_context_tokens:]
+            # Strip trailing EOS/padding and close the reply with exactly one EOS.
+            reply_ids = list(reply_ids)
+            while reply_ids and reply_ids[-1] == self.eos_token_id:
+                reply_ids.pop()
+            self.turns.append(new_ids)
+            self.turns.append(reply_ids + [self.eos_token_id])
+            self.cache = cache
+            # The cache never covers the final generated token, so it is always a prefix of the turns.
+            self.cached_length = min(cache.get_seq_length(), self.token_count()) if cache is not None else 0
+            self.last_used = time.monotonic()
+
+    def drop_cache(self):
+        """Frees the KV cache; the turns are re-encoded on the next message."""
+        self.cache = None
+        self.cached_length = 0
+
+    def drop_if_idle(self, now=None):
+        """
+        Drops the KV cache if the conversation has been idle for longer than `idle_timeout`.
+
+        Args:
+            now (float, optional): The current `time.monotonic()` value.
+
+        Returns:
+            bool: True if a cache was dropped.
+        """
+        now = time.monotonic() if now is None else now
+        # Never block a conversation that is generating right now.
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if self.cache is not None and now - self.last_used > self.idle_timeout:
+                self.drop_cache()
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+def conv1d_to_linear(model):
+    """
+    Replaces GPT-2 style `Conv1D` layers with equivalent `torch.nn.Linear` layers.
+
+    DialoGPT (like GPT-2) stores its attention and MLP projections as transformers'
+    `Conv1D`, which dynamic quantization does not recognize.
+
+    Args:
+        model (torch.nn.Module): The model to convert in place.
+
+    Returns:
+        torch.nn.Module: The same model.
+    """
+    conv1d = importlib.import_module('transformers.pytorch_utils').Conv1D
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, conv1d):
+                # Conv1D computes x @ W + b with W shaped (in, out); Linear stores W transposed.
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous(), requires_grad=False)
+                linear.bias = torch.nn.Parameter(child.bias.detach(), requires_grad=False)
+                setattr(parent, name, linear)
+    return model
+
+def apply_inference_profile(model, profile):
+    """
+    Prepares a loaded model for an inference profile.
+
+    Args:
+        model (torch.nn.Module): The loaded model, in eval mode.
+        profile (str): 'fp32' keeps the model as loaded; 'int8' quantizes the weights of its
+                       linear layers to int8, with activations quantized on the fly.
+
+    Returns:
+        torch.nn.Module: The model to serve.
+
+    Raises:
+        ValueError: If the profile is unknown.
+    """
+    if profile == 'fp32':
+        return model
+    if profile != 'int8':
+        raise ValueError(f"Unknown inference profile: {profile!r}")
+    conv1d_to_linear(model)
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favour of torchao, which is not a dependency.
+        warnings.simplefilter('ignore')
+        quantization = importlib.import_module('torch.ao.quantization')
+        return quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def model_nbytes(model):
+    """
+    Returns the memory held by a model's weights, including dynamically quantized ones.
+
+    Args:
+        model (torch.nn.Module): The model.
+
+    Returns:
+        int: The size in bytes.
+    """
+    tensors = list(model.parameters()) + list(model.buffers())
+    quantized_linear = importlib.import_module('torch.ao.nn.quantized.dynamic').Linear
+    for module in model.modules():
+        if isinstance(module, quantized_linear):
+            # Quantized weights live in packed parameters rather than in `parameters()`.
+            tensors.append(module.weight())
+            if module.bias() is not None:
+                tensors.append(module.bias())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+class ModelRegistry:
+    def __init__(self, unload_when_unused=False, scheduler_options=None, profile='fp32'):
+        """
+        Initializes a process-wide registry of shared tokenizer/model pairs.
+
+        Args:
+            unload_when_unused (bool): If True, a model is dropped from memory once its
+                                       last session releases it. Defaults to False so that
+                                       new sessions never pay the cold start again.
+            scheduler_options (dict, optional): Keyword arguments for each model's `InferenceScheduler`
+                                                (max_batch_size, max_wait_ms, max_queue_size, ...).
+            profile (str): Inference profile applied to every loaded model: 'fp32' or 'int8'
+                           (see `apply_inference_profile`).
+
+        Attributes:
+            _entries (dict): Maps model names to their tokenizer, model, size and reference count.
+            _lock (threading.Lock): Guards loading and reference counting across sessions.
+        """
+        self._entries = {}  # model_name -> {'tokenizer', 'model', 'model_bytes', 'refcount'}
+        self._loading = {}  # model_name -> Future of the entry while it is being loaded.
+        self._warm_ups = {}  # model_name -> Future of its background load and warm-up.
+        self._lock = threading.Lock()  # Sessions run on separate Streamlit script threads.
+        self._loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model-loader')
+        self.unload_when_unused = unload_when_unused
+        self.scheduler_options = scheduler_options or {}
+        self.profile = profile
+        self._contexts = weakref.WeakSet()  # Conversation contexts whose KV caches we sweep.
+        self._sweeper = None  # Started when the first context is tracked.
+        self._sessions = weakref.WeakSet()  # Live sessions, including those that have not attached a model yet.
+
+    def acquire(self, model_name):
+        """
+        Returns the shared tokenizer and model for a model name, loading them on first use.
+
+        Every call increments the model's reference count and must be paired with `release`.
+
+        Args:
+            model_name (str): The Hugging Face model name to load.
+
+        Returns:
+            tuple: The shared (tokenizer, model) pair.
+        """
+        while True:
+            entry = self._load(model_name)
+            with self._lock:
+                # The model may have been unloaded again in between; then load it anew.
+                if self._entries.get(model_name) is entry:
+                    entry['refcount'] += 1
+                    return entry['tokenizer'], entry['model']
+
+    def _load(self, model_name):
+        """
+        Returns a model's entry, loading it once even if several threads ask at the same time.
+
+        The registry lock is not held while loading, so other sessions are not blocked.
+
+        Args:
+            model_name (str): The Hugging Face model name to load.
+
+        Returns:
+            dict: The model's entry.
+        """
+        with self._lock:
+            entry = self._entries.get(model_name)
+            if entry is not None:
+                return entry
+            loading = self._loading.get(model_name)
+            leader = loading is None
+            if leader:
+                loading = self._loading[model_name] = Future()
+        if not leader:
+            # Another thread is already loading this model; share its result.
+            return loading.result()
+        try:
+            # Load the pair once for the whole process.
+            tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
+            model = transformers.AutoModelForCausalLM.from_pretrained(model_name)
+            # The model is shared read-only: inference mode and no gradients.
+            model.eval()
+            model.requires_grad_(False)
+            model = apply_inference_profile(model, self.profile)
+            entry = {
+                'tokenizer': tokenizer,
+                'model': model,
+                'model_bytes': model_nbytes(model),
+                'refcount': 0,
+                'scheduler': None  # Created on the first generation request.
+            }
+        except Exception as e:
+            with self._lock:
+                del self._loading[model_name]
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            self._entries[model_name] = entry
+            del self._loading[model_name]
+        loading.set_result(entry)
+        return entry
+
+    def warm_up(self, model_name, retry_failed=False):
+        """
+        Loads a model in the background and pays its first-call costs before a user waits on them.
+
+        Args:
+            model_name (str): The Hugging Face model name to load.
+            retry_failed (bool): Start over if an earlier warm-up failed.
+
+        Returns:
+            concurrent.futures.Future: Resolves once the model is ready to generate. Repeated
+                                       calls share it.
+        """
+        with self._lock:
+            future = self._warm_ups.get(model_name)
+            if future is None or (retry_failed and future.done() and future.exception() is not None):
+                future = self._warm_ups[model_name] = self._loader.submit(self._warm_up, model_name)
+            return future
+
+    def _warm_up(self, model_name):
+        """
+        Loads a model and runs one tiny generation through it.
+
+        The first `generate` call initializes kernels, allocators and the tokenizer's caches;
+        doing it here keeps that cost off the first user's reply.
+
+        Args:
+            model_name (str): The Hugging Face model name to load.
+        """
+        entry = self._load(model_name)
+        tokenizer, model = entry['tokenizer'], entry['model']
+        input_ids = tokenizer.encode("Hello" + tokenizer.eos_token)
+        with torch.no_grad():
+            model.generate(
+                torch.tensor([input_ids]), attention_mask=torch.ones((1, len(input_ids)), dtype=torch.long),
+                max_new_tokens=2, pad_token_id=tokenizer.eos_token_id
+            )
+        tokenizer.decode(input_ids, skip_special_tokens=True)
+        self.get_scheduler(model_name)
+
+    def readiness(self, model_name):
+        """
+        Reports whether a model can generate yet.
+
+        Args:
+            model_name (str): The Hugging Face model name.
+
+        Returns:
+            str: 'not_loaded', 'loading', 'ready' or 'failed'.
+        """
+        with self._lock:
+            future = self._warm_ups.get(model_name)
+            loaded = model_name in self._entries
+        if future is None:
+            return 'ready' if loaded else 'not_loaded'
+        if not future.done():
+            return 'loading'
+        return 'failed' if future.exception() is not None else 'ready'
+
+    def get_scheduler(self, model_name):
+        """
+        Returns the batching scheduler for a loaded model, creating it on first use.
+
+        Args:
+            model_name (str): A model name previously passed to `acquire`.
+
+        Returns:
+            InferenceScheduler: The scheduler shared by every session using this model.
+        """
+        with self._lock:
+            entry = self._entries[model_name]
+            if entry['scheduler'] is None:
+                entry['scheduler'] = InferenceScheduler(entry['tokenizer'], entry['model'], **self.scheduler_options)
+            return entry['scheduler']
+
+    def track_session(self, session):
+        """
+        Counts a session towards `memory_stats` for as long as it is alive.
+
+        Args:
+            session: The session's chatbot.
+        """
+        with self._lock:
+            self._sessions.add(session)
+
+    def track_context(self, context, sweep_interval=60):
+        """
+        Registers a conversation context so its KV cache is dropped once the session goes idle.
+
+        Args:
+            context (ConversationContext): The context to watch.
+            sweep_interval (float): Seconds between idle sweeps.
+        """
+        with self._lock:
+            self._contexts.add(context)
+            if self._sweeper is None:
+                def sweep():
+                    while True:
+                        time.sleep(sweep_interval)
+                        for tracked in list(self._contexts):
+                            tracked.drop_if_idle()
+                self._sweeper = threading.Thread(target=sweep, name='context-sweeper', daemon=True)
+                self._sweeper.start()
+
+    def release(self, model_name):
+        """
+        Drops one reference to a shared model.
+
+        Args:
+            model_name (str): The model name previously passed to `acquire`.
+        """
+        with self._lock:
+            entry = self._entries.get(model_name)
+            if entry is None:
+                return
+            entry['refcount'] = max(entry['refcount'] - 1, 0)
+            # Free the weights once nobody uses them, if configured to do so.
+            if entry['refcount'] == 0 and self.unload_when_unused:
+                del self._entries[model_name]
+                if entry['scheduler'] is not None:
+                    entry['scheduler'].shutdown()
+
+    def memory_stats(self):
+        """
+        Reports how much memory the shared models use and how many sessions share them.
+
+        Returns:
+            dict: Model bytes, live sessions, model references and resident memory per session
+                  (None until a session exists).
+        """
+        with self._lock:
+            model_bytes = sum(entry['model_bytes'] for entry in self._entries.values())
+            model_references = sum(entry['refcount'] for entry in self._entries.values())
+            # Sessions loading the model in the background have not acquired it yet, but still count.
+            sessions = len(self._sessions)
+        rss_bytes = process_rss_bytes()
+        return {
+            'models_loaded': len(self._entries),
+            'model_bytes': model_bytes,
+            'sessions': sessions,
+            'model_references': model_references,
+            'process_rss_bytes': rss_bytes,
+            # Resident memory of the whole process amortized over the sessions sharing it.
+            'rss_bytes_per_session': rss_bytes // sessions if sessions and rss_bytes else None
+        }
+
+def process_rss_bytes():
+    """
+    Returns the resident set size of the current process.
+
+    Returns:
+        int or None: The resident memory in bytes, or None if it cannot be determined.
+    """
+    try:
+        # Linux exposes the current RSS (in pages) without extra dependencies.
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # Peak RSS is the best portable approximation (bytes on macOS, KiB elsewhere).
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+def estimate_size(obj, _seen=None):
+    """
+    Recursively estimates the memory footprint of plain Python containers.
+
+    Args:
+        obj: The object to measure (strings, numbers, lists, dicts, tuples, sets).
+
+    Returns:
+        int: The approximate size in bytes.
+    """
+    seen = _seen if _seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(key, seen) + estimate_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(estimate_size(item, seen) for item in obj)
+    return size
+
+def format_bytes(num_bytes):
+    """
+    Formats a byte count for display.
+
+    Args:
+        num_bytes (int or None): The number of bytes.
+
+    Returns:
+        str: A human-readable size such as '1.4 GB'.
+    """
+    if num_bytes is None:
+        return 'n/a'
+    size = float(num_bytes)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+class TTLCache:
+    def __init__(self, max_entries=1024, ttl=3600):
+        """
+        Initializes an in-process LRU cache whose entries expire after a time-to-live.
+
+        Args:
+            max_entries (int): Maximum number of entries; the least recently used are evicted first.
+            ttl (float): Default lifetime of an entry in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first.
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Looks up a key.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            tuple: (found, value). `found` distinguishes a cached None from a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] < time.monotonic():
+                del self._entries[key]  # Expired.
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value.
+
+        Args:
+            key: The cache key.
+            value: The value to store (None is a valid, cacheable value).
+            ttl (float, optional): Lifetime in seconds; defaults to the cache's TTL.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class DiskCache:
+    def __init__(self, path, namespace):
+        """
+        Initializes a persistent key/value cache with expiry, shared by every worker using the same file.
+
+        Args:
+            path (str): SQLite database file.
+            namespace (str): Separates caches stored in the same file.
+        """
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._connection.execute('PRAGMA journal_mode=WAL')  # Concurrent readers across processes.
+        with self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+            # Drop entries that expired while no worker was running.
+            self._connection.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+
+    def get(self, key):
+        """
+        Looks up a key.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            tuple: (found, value), where value is the JSON-decoded stored value.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return False, None
+        return True, json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        """
+        Stores a JSON-serializable value.
+
+        Args:
+            key (str): The cache key.
+            value: The value to store.
+            ttl (float): Lifetime in seconds.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), time.time() + ttl)
+            )
+
+class ResponseCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024, disk_cache=None, ttl=30 * 86400, telemetry=None):
+        """
+        Initializes a cache of generated replies shared by every session.
+
+        Replies are stored as compact arrays of token IDs in an in-process LRU bounded by their
+        total size and, if given, an on-disk cache that survives restarts and is shared with
+        other workers. Keys must identify the model, its generation settings and the prompt.
+
+        Args:
+            max_bytes (int): Size cap of the in-process tier; the least recently used replies
+                             are evicted first.
+            disk_cache (DiskCache, optional): Second, persistent tier.
+            ttl (float): Seconds to keep a reply on disk.
+            telemetry (Telemetry, optional): Receives lookup and eviction counters.
+        """
+        self.max_bytes = max_bytes
+        self.disk_cache = disk_cache
+        self.ttl = ttl
+        self.nbytes = 0
+        self._entries = OrderedDict()  # key -> array of token IDs, least recently used first.
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'bypassed': 0, 'evictions': 0}
+        self.telemetry = telemetry or Telemetry(enabled=False)
+
+    def get(self, key):
+        """
+        Looks up a reply.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            list or None: The reply's token IDs, or None on a miss.
+        """
+        with self._lock:
+            token_ids = self._entries.get(key)
+            if token_ids is not None:
+                self._entries.move_to_end(key)
+                self.stats['memory_hits'] += 1
+        if token_ids is not None:
+            self.telemetry.increment('chatbot_response_cache_lookups_total', result='memory_hit')
+            return token_ids.tolist()
+        if self.disk_cache is not None:
+            found, token_ids = self.disk_cache.get(key)
+            if found:
+                self.stats['disk_hits'] += 1
+                self.telemetry.increment('chatbot_response_cache_lookups_total', result='disk_hit')
+                self._store(key, token_ids)
+                return token_ids
+        self.stats['misses'] += 1
+        self.telemetry.increment('chatbot_response_cache_lookups_total', result='miss')
+        return None
+
+    def set(self, key, token_ids):
+        """
+        Stores a reply.
+
+        Args:
+            key (str): The cache key.
+            token_ids (list): The reply's generated token IDs.
+        """
+        self._store(key, token_ids)
+        if self.disk_cache is not None:
+            self.disk_cache.set(key, list(token_ids), self.ttl)
+
+    def bypass(self):
+        """Counts a reply that could not use the cache, e.g. because earlier turns condition it."""
+        self.stats['bypassed'] += 1
+        self.telemetry.increment('chatbot_response_cache_lookups_total', result='bypass')
+
+    def _store(self, key, token_ids):
+        """
+        Adds a reply to the in-process tier, evicting the least recently used ones to stay within `max_bytes`.
+
+        Args:
+            key (str): The cache key.
+            token_ids (list): The reply's token IDs.
+        """
+        token_ids = array.array('I', token_ids)  # 4 bytes per token instead of a list of ints.
+        size = len(key) + token_ids.itemsize * len(token_ids)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= len(key) + previous.itemsize * len(previous)
+            self._entries[key] = token_ids
+            self.nbytes += size
+            evicted = 0
+            while self.nbytes > self.max_bytes:
+                old_key, old_ids = self._entries.popitem(last=False)
+                self.nbytes -= len(old_key) + old_ids.itemsize * len(old_ids)
+                evicted += 1
+            self.stats['evictions'] += evicted
+        if evicted:
+            self.telemetry.increment('chatbot_response_cache_evictions_total', evicted)
+
+    def summary(self):
+        """
+        Reports the cache's size and hit rate.
+
+        Returns:
+            dict: Lookup counters, entries, bytes held and the hit rate of cacheable lookups.
+        """
+        stats = dict(self.stats)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['entries'] = len(self._entries)
+        stats['bytes'] = self.nbytes
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['disk_hits']) / lookups, 3) if lookups else None
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+def first_sentences(text, sentences=2):
+    """
+    Returns the first few sentences of a text.
+
+    Args:
+        text (str): The text to shorten.
+        sentences (int): Number of sentences to keep.
+
+    Returns:
+        str: The shortened text.
+    """
+    parts = re.split(r'(?<=[.!?])\s+', text.strip())
+    return " ".join(parts[:sentences])
+
+def normalize_query(query):
+    """
+    Normalizes a knowledge query so that trivially different phrasings share a cache entry.
+
+    Args:
+        query (str): The user's query.
+
+    Returns:
+        str: The query without leading question words, punctuation, case or extra whitespace.
+    """
+    query = re.sub(r'^(what|who|where|when|why|how)(\s+(is|are|was|were))?\s+', '', query.strip(), flags=re.IGNORECASE)
+    return " ".join(re.findall(r"[a-z0-9']+", query.lower()))
+
+class LocalWikiIndex:
+    def __init__(self, articles):
+        """
+        Initializes an offline article index from (title, summary) pairs.
+
+        Args:
+            articles (list): (title, summary) tuples.
+        """
+        self.summaries = {}  # normalized title -> summary
+        self.keywords = MemoryIndex(max(1, len(articles)))  # BM25 over titles for keyword matches.
+        self._titles = {}  # indexed title text -> normalized title
+        for title, summary in articles:
+            key = normalize_query(title)
+            self.summaries[key] = summary
+            self.keywords.add(title)
+            self._titles[title] = key
+
+    @classmethod
+    def load(cls, dump_path):
+        """
+        Loads an index for a JSONL dump of {"title": ..., "summary": ...} lines.
+
+        The built index is saved as JSON next to the dump and reused until the dump changes.
+        JSON rather than pickle, so that whoever can write that file cannot run code in the server.
+
+        Args:
+            dump_path (str): Path to the article-summary dump.
+
+        Returns:
+            LocalWikiIndex: The loaded index.
+        """
+        index_path = dump_path + '.index.json'
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(dump_path):
+            try:
+                with open(index_path, encoding='utf-8') as index_file:
+                    return cls.from_state(json.load(index_file))
+            except Exception:
+                pass  # Unreadable or written by another version of this module: rebuild it.
+        with open(dump_path, encoding='utf-8') as dump_file:
+            articles = [
+                (article['title'], article['summary'])
+                for article in (json.loads(line) for line in dump_file if line.strip())
+            ]
+        index = cls(articles)
+        try:
+            with open(index_path, 'w', encoding='utf-8') as index_file:
+                json.dump(index.state(), index_file)
+        except OSError:
+            pass  # A read-only location just means the index is rebuilt next time.
+        return index
+
+    def state(self):
+        """
+        Returns the index as plain data that can be stored as JSON.
+
+        Returns:
+            dict: The summaries, the title mapping and the keyword index.
+        """
+        return {'version': 1, 'summaries': self.summaries, 'titles': self._titles, 'keywords': self.keywords.state()}
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restores an index saved with `state`.
+
+        Args:
+            state (dict): The saved state.
+
+        Returns:
+            LocalWikiIndex: The restored index.
+
+        Raises:
+            ValueError: If the state was saved in another format.
+        """
+        if state.get('version') != 1:
+            raise ValueError(f"Unsupported index version: {state.get('version')}")
+        index = cls([])
+        index.summaries = state['summaries']
+        index._titles = state['titles']
+        index.keywords = MemoryIndex.from_state(state['keywords'])
+        return index
+
+    def lookup(self, query, sentences=2):
+        """
+        Finds the article best matching a query: an exact title first, then the best keyword match.
+
+        Args:
+            query (str): The user's query.
+            sentences (int): Number of summary sentences to return.
+
+        Returns:
+            str or None: The article summary, or None if nothing matches.
+        """
+        key = normalize_query(query)
+        summary = self.summaries.get(key)
+        if summary is None:
+            matches = self.keywords.search(key, top_k=1)
+            if not matches:
+                return None
+            summary = self.summaries[self._titles[matches[0][0]]]
+        return first_sentences(summary, sentences)
+
+class WikipediaService:
+    def __init__(self, offline_index=None, disk_cache=None, max_entries=1024, ttl=86400,
+                 negative_ttl=3600, timeout=5.0, telemetry=None):
+        """
+        Initializes Wikipedia lookups with a two-tier cache and an optional offline mode.
+
+        Results are cached in an in-process LRU and, if given, an on-disk cache shared with
+        other workers. Queries with no article are cached too (for `negative_ttl`), so misses
+        are not retried on every message.
+
+        Args:
+            offline_index (LocalWikiIndex, optional): Answer from a local dump instead of the network.
+            disk_cache (DiskCache, optional): Second cache tier shared between workers.
+            max_entries (int): Size of the in-process cache.
+            ttl (float): Seconds to keep a found summary.
+            negative_ttl (float): Seconds to remember that a query has no article.
+            timeout (float): Seconds to wait for the Wikipedia API.
+            telemetry (Telemetry, optional): Receives lookup timings and cache counters.
+        """
+        self.offline_index = offline_index
+        self.disk_cache = disk_cache
+        self.memory_cache = TTLCache(max_entries, ttl)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        # The wikipedia package has no timeout of its own, so calls run on a small pool we can stop waiting on.
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='wikipedia')
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'timeouts': 0, 'errors': 0}
+        self.telemetry = telemetry or Telemetry(enabled=False)
+
+    def search(self, query, sentences=2):
+        """
+        Returns a short Wikipedia summary for a query.
+
+        Args:
+            query (str): The user's query.
+            sentences (int): Number of summary sentences.
+
+        Returns:
+            str or None: The summary, or None if there is no article or the lookup failed.
+        """
+        # Look up exactly what the result is cached under, so every phrasing sharing a key gets the same article.
+        query = normalize_query(query)
+        key = f"{sentences}:{query}"
+        found, summary = self.memory_cache.get(key)
+        if found:
+            self.stats['memory_hits'] += 1
+            self.telemetry.increment('chatbot_wikipedia_lookups_total', result='memory_hit')
+            return summary
+        if self.disk_cache is not None:
+            found, summary = self.disk_cache.get(key)
+            if found:
+                self.stats['disk_hits'] += 1
+                self.telemetry.increment('chatbot_wikipedia_lookups_total', result='disk_hit')
+                self.memory_cache.set(key, summary, self.ttl if summary else self.negative_ttl)
+                return summary
+        self.stats['misses'] += 1
+
+        try:
+            with self.telemetry.span('chatbot_wikipedia_fetch_seconds', source='offline' if self.offline_index else 'api'):
+                summary = self._fetch(query, sentences)
+        except FutureTimeoutError:
+            self.stats['timeouts'] += 1
+            self.telemetry.increment('chatbot_wikipedia_lookups_total', result='timeout')
+            return None  # Not cached: the next message may get through.
+        except Exception:
+            self.stats['errors'] += 1
+            self.telemetry.increment('chatbot_wikipedia_lookups_total', result='error')
+            return None
+        self.telemetry.increment('chatbot_wikipedia_lookups_total', result='found' if summary else 'not_found')
+
+        # Remember misses as well, but for less time than hits.
+        ttl = self.ttl if summary else self.negative_ttl
+        self.memory_cache.set(key, summary, ttl)
+        if self.disk_cache is not None:
+            self.disk_cache.set(key, summary, ttl)
+        return summary
+
+    def warm_up(self):
+        """
+        Imports the Wikipedia client in the background so that the first lookup does not pay for it.
+        """
+        if self.offline_index is None:
+            self._executor.submit(importlib.import_module, 'wikipedia')
+
+    def _fetch(self, query, sentences):
+        """
+        Looks a query up offline or on Wikipedia.
+
+        Args:
+            query (str): The query, already normalized by `normalize_query`.
+            sentences (int): Number of summary sentences.
+
+        Returns:
+            str or None: The summary, or None if no article matches.
+
+        Raises:
+            concurrent.futures.TimeoutError: If the API does not answer within `timeout`.
+        """
+        if self.offline_index is not None:
+            return self.offline_index.lookup(query, sentences)
+        future = self._executor.submit(wikipedia.summary, query, sentences=sentences)
+        try:
+            return future.result(timeout=self.timeout)
+        except (wikipedia.exceptions.PageError, wikipedia.exceptions.DisambiguationError):
+            return None  # No single article matches: a cacheable miss.
+
+class HttpClient:
+    def __init__(self, timeout=5.0, retries=2, backoff_factor=0.3, pool_size=16, cache_entries=1024, telemetry=None):
+        """
+        Initializes a shared HTTP client for the external APIs.
+
+        Connections are kept alive in a pool, every request has a timeout, failed requests
+        are retried with exponential backoff, and identical requests that are already in
+        flight are coalesced so that one upstream call serves every waiter.
+
+        Args:
+            timeout (float): Seconds to wait for a connection or a response.
+            retries (int): Retries for connection errors and 429/5xx responses.
+            backoff_factor (float): Base of the exponential backoff between retries.
+            pool_size (int): Keep-alive connections per host.
+            cache_entries (int): Size of the response cache used by `get_json(cache_key=...)`.
+            telemetry (Telemetry, optional): Receives request timings and cache and error counters.
+        """
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET'}),
+            raise_on_status=False  # Hand the last response back instead of raising.
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = TTLCache(cache_entries)
+        self._in_flight = {}  # request key -> Future shared by every caller waiting on it.
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'coalesced': 0, 'cache_hits': 0, 'errors': 0}
+        self.telemetry = telemetry or Telemetry(enabled=False)
+
+    def get_json(self, url, params=None, cache_key=None, cache_ttl=None, cache_if=None):
+        """
+        Sends a GET request and decodes the JSON response.
+
+        Args:
+            url (str): The URL to fetch.
+            params (dict, optional): Query parameters.
+            cache_key (str, optional): If given, responses are cached under this key.
+            cache_ttl (float, optional): Seconds to cache the response.
+            cache_if (callable, optional): Called with (status_code, data); the response is only
+                                           cached if it returns True. Defaults to status 200.
+
+        Returns:
+            tuple: (status_code, data) of the response.
+
+        Raises:
+            requests.RequestException: If the request fails after all retries.
+            ValueError: If the response is not valid JSON.
+        """
+        if cache_key is not None:
+            found, cached = self.cache.get(cache_key)
+            if found:
+                self.stats['cache_hits'] += 1
+                self.telemetry.increment('chatbot_http_cache_hits_total')
+                return cached
+
+        request_key = (url, tuple(sorted((params or {}).items())))
+        with self._lock:
+            future = self._in_flight.get(request_key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[request_key] = future
+        if not leader:
+            # Someone is already fetching exactly this; wait for their answer.
+            self.stats['coalesced'] += 1
+            self.telemetry.increment('chatbot_http_coalesced_total')
+            return future.result()
+
+        host = urlparse(url).netloc
+        try:
+            self.stats['requests'] += 1
+            with self.telemetry.span('chatbot_http_request_seconds', host=host):
+                response = self.session.get(url, params=params, timeout=self.timeout)
+                result = (response.status_code, response.json())
+            # Cache before leaving the in-flight table so no caller slips through the gap.
+            if cache_key is not None and (cache_if(*result) if cache_if else result[0] == 200):
+                self.cache.set(cache_key, result, cache_ttl)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.telemetry.increment('chatbot_http_errors_total', host=host)
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[request_key]
+
+@st.cache_resource
+def get_telemetry():
+    """
+    Returns the telemetry shared by every session in this process.
+
+    Set TELEMETRY to 'on' to collect metrics or to 'log' to also log one line per message,
+    and METRICS_PORT to serve them in the Prometheus text format on METRICS_HOST.
+
+    Returns:
+        Telemetry: The process-wide telemetry (disabled by default).
+    """
+    mode = get_setting('TELEMETRY', 'off')
+    telemetry = Telemetry(enabled=mode in ('on', 'log'), exporters=[LogExporter()] if mode == 'log' else [])
+    if telemetry.enabled and get_setting('METRICS_PORT'):
+        serve_metrics(telemetry, int(get_setting('METRICS_PORT')), host=get_setting('METRICS_HOST', '127.0.0.1'))
+    return telemetry
+
+@st.cache_resource
+def get_http_client():
+    """
+    Returns the HTTP client shared by every session in this process.
+
+    Returns:
+        HttpClient: The process-wide client.
+    """
+    return HttpClient(
+        timeout=float(get_setting('HTTP_TIMEOUT', 5)),
+        retries=int(get_setting('HTTP_RETRIES', 2)),
+        telemetry=get_telemetry()
+    )
+
+@st.cache_resource
+def get_joke_pool():
+    """
+    Returns the joke pool shared by every session in this process, filling it in the background.
+
+    Returns:
+        JokePool: The process-wide pool.
+    """
+    pool = JokePool(
+        get_http_client(), joke_category_urls(),
+        pool_size=int(get_setting('JOKE_POOL_SIZE', 20)),
+        low_water_mark=int(get_setting('JOKE_POOL_LOW_WATER_MARK', 5)),
+        telemetry=get_telemetry()
+    )
+    pool.prefetch()
+    return pool
+
+@st.cache_resource
+def get_lookup_executor():
+    """
+    Returns the thread pool that runs knowledge lookups concurrently with generation.
+
+    Returns:
+        ThreadPoolExecutor: The process-wide pool.
+    """
+    return ThreadPoolExecutor(max_workers=int(get_setting('LOOKUP_WORKERS', 8)), thread_name_prefix='lookup')
+
+@st.cache_resource
+def get_wikipedia_service():
+    """
+    Returns the Wikipedia service shared by every session in this process.
+
+    Set WIKIPEDIA_MODE to 'offline' and WIKIPEDIA_DUMP_PATH to a JSONL dump of
+    {"title": ..., "summary": ...} lines to answer without network access.
+
+    Returns:
+        WikipediaService: The process-wide service.
+    """
+    offline_index = None
+    if get_setting('WIKIPEDIA_MODE', 'online') == 'offline':
+        offline_index = LocalWikiIndex.load(get_setting('WIKIPEDIA_DUMP_PATH', 'wikipedia_summaries.jsonl'))
+    service = WikipediaService(
+        offline_index=offline_index,
+        disk_cache=DiskCache(get_setting('CACHE_DB_PATH', 'chatbot_cache.db'), 'wikipedia'),
+        ttl=float(get_setting('WIKIPEDIA_CACHE_TTL', 86400)),
+        negative_ttl=float(get_setting('WIKIPEDIA_NEGATIVE_TTL', 3600)),
+        timeout=float(get_setting('WIKIPEDIA_TIMEOUT', 5)),
+        telemetry=get_telemetry()
+    )
+    service.warm_up()
+    return service
+
+@st.cache_resource
+def get_response_cache():
+    """
+    Returns the cache of generated replies shared by every session in this process.
+
+    RESPONSE_CACHE is 'memory' (the default), 'disk' to also persist replies in CACHE_DB_PATH,
+    or 'off'.
+
+    Returns:
+        ResponseCache or None: The process-wide cache, or None if it is disabled.
+    """
+    mode = get_setting('RESPONSE_CACHE', 'memory')
+    if mode == 'off':
+        return None
+    disk_cache = DiskCache(get_setting('CACHE_DB_PATH', 'chatbot_cache.db'), 'responses') if mode == 'disk' else None
+    return ResponseCache(
+        max_bytes=int(get_setting('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024)),
+        disk_cache=disk_cache,
+        ttl=float(get_setting('RESPONSE_CACHE_TTL', 30 * 86400)),
+        telemetry=get_telemetry()
+    )
+
+@st.cache_resource
+def get_memory_store():
+    """
+    Returns the persistent user memory store shared by every session in this process.
+
+    Returns:
+        UserMemoryStore: The process-wide store.
+    """
+    return UserMemoryStore(
+        path=get_setting('MEMORY_DB_PATH', 'chatbot_memory.db'),
+        max_cached_users=int(get_setting('MEMORY_MAX_CACHED_USERS', 256)),
+        max_cached_exchanges=int(get_setting('TRANSCRIPT_MAX_CACHED_EXCHANGES', 100))
+    )
+
+@st.cache_resource
+def get_model_registry():
+    """
+    Returns the model registry shared by every Streamlit session in this process.
+
+    Streamlit re-executes the script on each interaction, so the registry is kept in
+    the resource cache rather than in a module-level global.
+
+    Returns:
+        ModelRegistry: The process-wide registry.
+    """
+    threads = int(get_setting('INFERENCE_THREADS', 0))
+    return ModelRegistry(profile=get_setting('INFERENCE_PROFILE', 'fp32'), scheduler_options={
+        'max_batch_size': int(get_setting('INFERENCE_MAX_BATCH_SIZE', 8)),
+        'max_wait_ms': float(get_setting('INFERENCE_MAX_WAIT_MS', 10)),
+        'max_queue_size': int(get_setting('INFERENCE_MAX_QUEUE_SIZE', 64)),
+        'telemetry': get_telemetry(),
+        'num_threads': threads or None,
+        # Bound every reply in tokens and in wall-clock time.
+        'generate_kwargs': {
+            'max_new_tokens': int(get_setting('INFERENCE_MAX_NEW_TOKENS', 128)),
+            'max_time': float(get_setting('INFERENCE_MAX_TIME', 20))
+        }
+    })
+
+class IntentMatch:
+    def __init__(self, intent, slots=None, is_command=False):
+        """
+        Describes how a message was routed.
+
+        Args:
+            intent (str): The command ('remember', 'recall', 'set_name', 'joke_history') or intent name.
+            slots (dict, optional): Extracted values, e.g. {'city': 'London'} or {'category': 'pun'}.
+            is_command (bool): True for explicit commands, which take precedence over intents.
+        """
+        self.intent = intent
+        self.slots = slots or {}
+        self.is_command = is_command
+
+    def __repr__(self):
+        return f"IntentMatch({self.intent!r}, {self.slots!r})"
+
+class IntentRouter:
+    # Commands that take an argument, anchored at the start of the message.
+    COMMAND_PATTERN = re.compile(
+        r'^\s*(?:(?P<remember>remember)|(?P<recall>recall)|(?P<set_name>my\s+name\s+is))\s+(?P<arg>.+)',
+        re.IGNORECASE | re.DOTALL
+    )
+    # "weather in <city>": up to three words, ended by punctuation, the end of the message, a
+    # time word ("tonight", "next week") or a filler word.
+    CITY_PATTERN = re.compile(
+        r"\bweather\s+in\s+(?P<city>[^\W\d_]+(?:[ '-][^\W\d_]+){0,2}?)"
+        r"(?=\s*(?:[?.!,;]|$)|\s+(?:today|tonight|tomorrow|yesterday|now|later|soon|next|this|these|over|during|until|"
+        r"in|on|at|for|by|week|weekend|morning|afternoon|evening|night|"
+        r"please|right|like|is|was|will|be|going|looks?|and|or|then)\b)",
+        re.IGNORECASE
+    )
+    TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+    def __init__(self, intents, joke_categories):
+        """
+        Compiles an intent table into a word-level lookup table.
+
+        Every keyword, joke category and command phrase is keyed by its first word, so a
+        message is routed in one pass over its words with one dictionary lookup each, using
+        whole-word matching ("this" no longer triggers "hi"). Plurals of single-word keywords
+        and categories match too ("jokes", "puns"), except for words of two letters or fewer,
+        whose plural is usually another word ("hi", "his"). Priorities are explicit and
+        match the keyword scans they replace: commands, then the word "joke", then weather
+        with a city, then every intent keyword (including "funny") in table order.
+
+        Args:
+            intents (dict): Intent names mapped to keyword lists, in priority order.
+            joke_categories (list): Joke category names recognized as a slot of the 'joke' intent.
+        """
+        self.intents = intents
+        self.priorities = {'joke_history': 0, 'joke': 1, 'weather_city': 2}
+        self._table = {}  # first word -> [(following words, kind, name, priority)]
+
+        def add(phrase, kind, name, priority=None):
+            words = tuple(phrase.lower().split())
+            self._table.setdefault(words[0], []).append((words[1:], kind, name, priority))
+            if len(words) == 1 and len(words[0]) > 2 and not words[0].endswith('s'):
+                self._table.setdefault(words[0] + 's', []).append(((), kind, name, priority))
+
+        add('joke history', 'command', 'joke_history', self.priorities['joke_history'])
+        # Asking for a "joke" outranks other intents; other joke keywords keep their table position.
+        add('joke', 'keyword', 'joke', self.priorities['joke'])
+        for category in joke_categories:
+            add(category, 'category', category)
+        for offset, (intent, keywords) in enumerate(intents.items()):
+            for keyword in keywords:
+                add(keyword, 'keyword', intent, 3 + offset)
+
+    def route(self, message):
+        """
+        Resolves the command or intent of a message and its slots in one pass.
+
+        Args:
+            message (str): The user's message.
+
+        Returns:
+            IntentMatch: The highest-priority match, or the 'general' intent.
+        """
+        command = self.COMMAND_PATTERN.match(message)
+        if command:
+            name = next(name for name in ('remember', 'recall', 'set_name') if command.group(name))
+            return IntentMatch(name, {'text': command.group('arg').strip()}, is_command=True)
+
+        tokens = self.TOKEN_PATTERN.findall(message.lower())
+        best_priority, best_name, category, city = None, None, None, None
+        for position, token in enumerate(tokens):
+            entries = self._table.get(token)
+            if not entries:
+                continue
+            for rest, kind, name, priority in entries:
+                # Multi-word phrases must continue with the following words.
+                if rest and tuple(tokens[position + 1:position + 1 + len(rest)]) != rest:
+                    continue
+                if kind == 'category':
+                    category = category or name
+                    continue
+                if name == 'weather' and city is None:
+                    city_match = self.CITY_PATTERN.search(message)
+                    city = city_match.group('city') if city_match else ''
+                if name == 'weather' and city:
+                    priority = self.priorities['weather_city']
+                if best_priority is None or priority < best_priority:
+                    best_priority, best_name = priority, name
+
+        if best_name is None:
+            return IntentMatch('general')
+        if best_name == 'joke_history':
+            return IntentMatch(best_name, is_command=True)
+        if best_name == 'weather' and city:
+            return IntentMatch(best_name, {'city': city})
+        if best_name == 'joke' and category:
+            return IntentMatch(best_name, {'category': category})
+        return IntentMatch(best_name)
+
+class AdvancedChatbot:
+    def __init__(self, model_name='microsoft/DialoGPT-medium', registry=None, user_id=None, memory_store=None,
+                 wikipedia_service=None, weather_service=None, jokes_api=None, draft_model_name=None,
+                 response_cache=None):
+        """
+        Initializes the chatbot with a language model, memory manager, and other components.
+
+        The tokenizer and model are borrowed from a shared `ModelRegistry`, and the user's
+        memories, name and chat history live in a shared `UserMemoryStore`, so each session
+        only owns lightweight state. Unless MODEL_LOADING is 'eager', the model is loaded
+        in the background and replies that do not need it are answered in the meantime.
+
+        Args:
+            model_name (str): The name of the language model to use for chatbot responses.
+            registry (ModelRegistry, optional): The registry to borrow the model from.
+                                                Defaults to the process-wide registry.
+            user_id (str, optional): Identifies the user whose memories are used. Defaults to
+                                     a new anonymous ID.
+            memory_store (UserMemoryStore, optional): Where user state is persisted.
+                                                      Defaults to the process-wide store.
+            wikipedia_service (WikipediaService, optional): Knowledge lookups. Defaults to the
+                                                            process-wide service.
+            weather_service (WeatherIntegration, optional): Weather lookups. Defaults to one
+                                                            using the shared HTTP client.
+            jokes_api (JokesAPI, optional): Joke source. Defaults to one served from the
+                                            process-wide joke pool.
+            draft_model_name (str, optional): A smaller model sharing `model_name`'s tokenizer,
+                                              e.g. 'microsoft/DialoGPT-small', that proposes
+                                              tokens for the main model to verify (assisted
+                                              decoding). Defaults to the DRAFT_MODEL setting;
+                                              an empty name disables it.
+            response_cache (ResponseCache, optional): Replies shared across sessions. Defaults to
+                                                      the process-wide cache (see RESPONSE_CACHE);
+                                                      False disables caching for this chatbot.
+        """
+        self.model_name = model_name
+        self.registry = registry or get_model_registry()
+        self.registry.track_session(self)
+        self.tokenizer = None
+        self.model = None
+        if draft_model_name is None:
+            draft_model_name = get_setting('DRAFT_MODEL', '')
+        # A model cannot usefully draft for itself.
+        self.draft_model_name = draft_model_name if draft_model_name and draft_model_name != model_name else None
+        self.draft_model = None  # Attached once its background load has finished.
+        if response_cache is None:
+            response_cache = get_response_cache()
+        self.response_cache = None if response_cache is False else response_cache
+        self._response_cache_prefix = None  # Identifies the model and generation settings; False if sampling.
+        # Multi-turn context with a reusable KV cache (None until the model is attached).
+        self.context = None
+        # Reusing a conversation's KV cache makes its follow-up turns cheap to encode, but a
+        # request that brings a cache runs on its own; 'off' re-encodes the earlier turns
+        # instead, so that every request can share a batch with other sessions.
+        self.reuse_context_cache = get_setting('CONTEXT_KV_CACHE', 'on') == 'on'
+        # Seconds a generation request waits for a model that is still loading.
+        self.model_wait_timeout = float(get_setting('MODEL_WAIT_TIMEOUT', 0))
+        embedder_kind = get_setting('MEMORY_EMBEDDER', 'hashing')
+        # The transformer embedder needs the model up front, so it always loads eagerly.
+        if get_setting('MODEL_LOADING', 'background') == 'eager' or embedder_kind == 'transformer':
+            try:
+                self.attach_model()
+            except Exception as e:
+                # Handle errors during model initialization.
+                st.error(f"Error initializing model: {e}")
+        else:
+            # A new session gives a model that failed to load another chance.
+            self.registry.warm_up(model_name, retry_failed=True)
+        if self.draft_model_name:
+            # Queued behind the main model; replies use standard decoding until it is ready.
+            self.registry.warm_up(self.draft_model_name, retry_failed=True)
+        
+        # Memories, the user's name and chat history are loaded lazily from the shared store.
+        self.user_id = user_id or uuid.uuid4().hex
+        self.memory_store = memory_store or get_memory_store()
+        self.embedder = self.create_embedder(embedder_kind)
+        self.stream_stats = None  # Timing of the most recent streamed reply.
+        self.weather_service = weather_service or WeatherIntegration(cache_ttl=float(get_setting('WEATHER_CACHE_TTL', 600)))  # Integration for fetching weather information.
+        self.wikipedia = wikipedia_service or get_wikipedia_service()  # Cached Wikipedia lookups.
+        # Run the Wikipedia lookup and generation concurrently, each bounded by a deadline.
+        self.concurrent_lookups = get_setting('PIPELINE_MODE', 'concurrent') == 'concurrent'
+        self.knowledge_deadline = float(get_setting('KNOWLEDGE_DEADLINE', 2.0))
+        self.generation_deadline = float(get_setting('GENERATION_DEADLINE', 60.0))
+        self.last_timings = {}  # Seconds spent in each stage of the last processed message.
+        self.last_route = None  # How the last message was answered, e.g. 'weather', 'wiki' or 'generation'.
+        self.telemetry = get_telemetry()  # Per-stage spans and counters; a no-op unless TELEMETRY is set.
+
+        # Define intents and their associated keywords for intent recognition.
+        self.intents = {
+            'greeting': ['hello', 'hi', 'hey', 'greetings'],
+            'weather': ['weather', 'temperature', 'forecast'],
+            'time': ['time', 'current time', 'what time'],
+            'joke': ['joke', 'humor', 'funny'],
+            'help': ['help', 'assist', 'support'],
+            'memory': ['remember', 'recall', 'memory']
+        }
+        self.jokes_api = jokes_api or JokesAPI(pool=get_joke_pool())  # Integration for fetching jokes from a shared prefetched pool.
+        # Compile the intent table into a single-pass router.
+        self.router = IntentRouter(self.intents, self.jokes_api.get_joke_categories())
+
+    @property
+    def memory_manager(self):
+        """MemoryManager: The user's memories, loaded on first access."""
+        return self.memory_store.get(self.user_id, self.embedder).memory_manager
+
+    @property
+    def user_name(self):
+        """str or None: The user's name, if provided."""
+        return self.memory_store.get(self.user_id, self.embedder).user_name
+
+    @property
+    def transcript(self):
+        """Transcript: Every exchange with the user, shared with the UI that renders it."""
+        return self.memory_store.get(self.user_id, self.embedder).transcript
+
+    def attach_model(self):
+        """
+        Borrows the shared tokenizer and model, loading them if necessary, and sets up the conversation context.
+
+        Raises:
+            Exception: If the model cannot be loaded.
+        """
+        # Borrow the shared language model and tokenizer for the specified model.
+        tokenizer, model = self.registry.acquire(self.model_name)
+        # Hand the reference back once this session's chatbot is garbage collected.
+        self._release_model = weakref.finalize(self, self.registry.release, self.model_name)
+        self.context = ConversationContext(
+            tokenizer.eos_token_id,
+            max_context_tokens=int(get_setting('CONTEXT_MAX_TOKENS', 512)),
+            idle_timeout=float(get_setting('CONTEXT_IDLE_TIMEOUT', 600))
+        )
+        self.registry.track_context(self.context)
+        self.tokenizer, self.model = tokenizer, model
+
+    def model_ready(self, timeout=0):
+        """
+        Attaches the shared model once its background warm-up has finished.
+
+        Args:
+            timeout (float): Seconds to wait for a model that is still loading.
+
+        Returns:
+            bool: True if the model can generate.
+        """
+        if self.model is not None:
+            return True
+        try:
+            self.registry.warm_up(self.model_name).result(timeout=timeout)
+            self.attach_model()
+        except Exception:
+            return False  # Still loading, or loading failed.
+        return True
+
+    def draft_ready(self):
+        """
+        Attaches the draft model if one is configured and its background load has finished.
+
+        Never waits: until the draft is ready, replies are generated without it.
+
+        Returns:
+            bool: True if generation can be assisted by the draft model.
+        """
+        if self.draft_model is not None:
+            return True
+        if not self.draft_model_name:
+            return False
+        future = self.registry.warm_up(self.draft_model_name)
+        if not future.done() or future.exception() is not None:
+            return False
+        _, draft_model = self.registry.acquire(self.draft_model_name)
+        self._release_draft_model = weakref.finalize(self, self.registry.release, self.draft_model_name)
+        if draft_model.config.vocab_size != self.model.config.vocab_size:
+            # Assisted decoding compares token IDs, so both models must share a vocabulary.
+            logging.getLogger(__name__).warning(
+                "Draft model %s does not share %s's vocabulary; assisted decoding is disabled.",
+                self.draft_model_name, self.model_name
+            )
+            self._release_draft_model()
+            self.draft_model_name = None
+            return False
+        self.draft_model = draft_model
+        return True
+
+    def response_cache_key(self, message, input_ids, new_ids):
+        """
+        Returns the response cache key for a generation, or None if its reply may not be reused.
+
+        Greedy decoding makes the reply a function of the prompt, the model and its generation
+        settings. The key covers all three, with the message normalized for case, punctuation
+        and spacing. Replies conditioned on earlier turns, or sampled, are not cached.
+
+        Args:
+            message (str): The user's message.
+            input_ids (list): The prompt, including any earlier turns.
+            new_ids (list): Token IDs of the message alone.
+
+        Returns:
+            str or None: The key.
+        """
+        if self.response_cache is None:
+            return None
+        if self._response_cache_prefix is None:
+            generate_kwargs = self.registry.get_scheduler(self.model_name).generate_kwargs
+            if generate_kwargs.get('do_sample', self.model.generation_config.do_sample):
+                self._response_cache_prefix = False
+            else:
+                identity = json.dumps({
+                    'model': self.model_name,
+                    'profile': self.registry.profile,
+                    'generate': generate_kwargs,
+                    'max_context_tokens': self.context.max_context_tokens
+                }, sort_keys=True, default=str)
+                self._response_cache_prefix = hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+        normalized = " ".join(IntentRouter.TOKEN_PATTERN.findall(message.lower()))
+        if not self._response_cache_prefix or len(input_ids) != len(new_ids) or not normalized:
+            self.response_cache.bypass()
+            return None
+        return f"{self._response_cache_prefix}:{normalized}"
+
+    def model_unavailable_response(self):
+        """
+        Explains why a generated reply cannot be given yet.
+
+        Returns:
+            str: A placeholder while the model loads, or an apology if loading failed.
+        """
+        if self.registry.readiness(self.model_name) in ('loading', 'not_loaded'):
+            return ("I'm still warming up my language model, so give me a moment for a longer chat. "
+                    "In the meantime I can tell you a joke, the time or the weather.")
+        return "Sorry, my language model is not available right now."
+
+    def create_embedder(self, kind):
+        """
+        Creates the embedder used for semantic memory recall.
+
+        Args:
+            kind (str): 'hashing' for the local hashing embedder, 'transformer' to reuse the
+                        loaded language model, or 'none' to disable semantic recall.
+
+        MEMORY_MIN_SIMILARITY overrides the embedder's own recall cutoff.
+
+        Returns:
+            The embedder, or None if semantic recall is disabled.
+        """
+        if kind == 'none':
+            return None
+        if kind == 'transformer' and self.model is not None:
+            embedder = TransformerEmbedder(self.tokenizer, self.model)
+        else:
+            embedder = HashingEmbedder()
+        min_similarity = get_setting('MEMORY_MIN_SIMILARITY')
+        if min_similarity not in (None, ''):
+            embedder.min_similarity = float(min_similarity)
+        return embedder
+
+    def session_state_bytes(self):
+        """
+        Estimates the memory held by this session's own state (memories, transcript, name).
+
+        Returns:
+            int: The approximate size in bytes, excluding the shared model.
+        """
+        vectors = [self.memory_manager.long_term_vectors, self.memory_manager.short_term_vectors]
+        return estimate_size([
+            self.memory_manager.long_term_memory,
+            self.memory_manager.short_term_memory,
+            self.user_name
+        ]) + self.transcript.nbytes + sum(tier.nbytes for tier in vectors if tier is not None)
+
+    def recognize_intent(self, message):
+        """
+        Recognizes the intent of the user's message.
+
+        Args:
+            message (str): The user's message.
+
+        Returns:
+            str or tuple: The recognized intent, and additional details if necessary.
+        """
+        match = self.router.route(message)
+        if match.is_command:
+            # Commands are handled before intents; report the intent their keywords belong to.
+            return 'joke' if match.intent == 'joke_history' else 'memory'
+        if 'city' in match.slots:
+            return match.intent, match.slots['city']  # Return the weather intent and city name.
+        if 'category' in match.slots:
+            return match.intent, match.slots['category']  # Return the joke intent and category.
+        return match.intent
+
+    def handle_predefined_intent(self, intent, city=None, category=None):
+        """
+        Handles predefined intents and generates appropriate responses.
+
+        Args:
+            intent (str): The recognized intent.
+            city (str, optional): The city name for weather queries.
+            category (str, optional): The joke category for joke requests.
+
+        Returns:
+            str: The chatbot's response.
+        """
+        if intent == 'greeting':
+            # Generate a greeting message, including the user's name if available.
+            greeting = f"Hello{' ' + self.user_name if self.user_name else ''}! How can I help you today?"
+            return greeting
+        
+        elif intent == 'weather':
+            # Fetch and return weather information for the specified city.
+            if city:
+                return self.weather_service.get_weather(city)
+            return "Please specify a city. Example: 'weather in New York'"
+        
+        elif intent == 'time':
+            # Return the current time.
+            return f"The current time is {datetime.datetime.now().strftime('%I:%M %p')}."
+        
+        elif intent == 'joke':
+            # Fetch and return a joke from the requested category, or a random one.
+            if category:
+                return self.jokes_api.get_joke(category)
+            return self.jokes_api.get_random_joke()
+        
+        elif intent == 'help':
+            # Provide information about the chatbot's capabilities.
+            return "I can help with questions, tell jokes, or chat casually."
+        
+        return None  # Return None if the intent is unhandled.
+
+    def process_message(self, message):
+        """
+        Processes a user message and generates an appropriate response.
+
+        The exchange is appended to the user's transcript. Per-stage timings of the call are
+        left in `last_timings` and the path that answered it in `last_route`.
+
+        Args:
+            message (str): The user's message.
+
+        Returns:
+            str: The chatbot's response.
+        """
+        self.last_timings = {}
+        self.last_route = None
+        start = time.perf_counter()
+        if self.concurrent_lookups:
+            response = self._process_message_concurrently(message)
+        else:
+            # Answer directly from commands, intents, memories or Wikipedia when possible.
+            response, context = self.prepare_response(message)
+            if response is None:
+                # Generate a conversational response using the language model.
+                with self.timed_stage('generation'):
+                    pending, error_response = self.start_generation(message)
+                    if pending is not None:
+                        response = self.collect_generation(pending)
+                if pending is None:
+                    # Not a generated reply (e.g. the model is still loading): don't remember it.
+                    response = error_response
+                else:
+                    response = self.finish_generated_response(message, response, context)
+        self.last_timings['total'] = time.perf_counter() - start
+        self.record_trace()
+        self.memory_store.add_exchange(self.user_id, message, response, embedder=self.embedder)
+        return response
+
+    def _process_message_concurrently(self, message):
+        """
+        Processes a message, running the Wikipedia lookup and model generation at the same time.
+
+        The existing precedence is kept: a Wikipedia summary found within `knowledge_deadline`
+        wins and the generation is cancelled; otherwise the generated reply is used.
+
+        Args:
+            message (str): The user's message.
+
+        Returns:
+            str: The chatbot's response.
+        """
+        response, context = self.prepare_response(message, search_knowledge=False)
+        if response is not None:
+            return response
+
+        start = time.perf_counter()
+        wiki_future = get_lookup_executor().submit(self.search_wikipedia, message)
+        pending, error_response = self.start_generation(message)
+
+        wiki_response = self._await_knowledge(wiki_future, start)
+        if wiki_response:
+            if pending is not None:
+                pending.cancel()  # Wikipedia takes precedence; stop generating.
+            self.last_route = 'wiki'
+            return context + wiki_response
+        if pending is None:
+            return error_response
+
+        try:
+            with self.timed_stage('generation'):
+                remaining = self.generation_deadline - (time.perf_counter() - start)
+                response = self.collect_generation(pending, timeout=max(remaining, 0))
+        except FutureTimeoutError:
+            pending.cancel()
+            return "Sorry, that took me too long. Please try again."
+        return self.finish_generated_response(message, response, context)
+
+    def _await_knowledge(self, wiki_future, start):
+        """
+        Waits for a concurrent Wikipedia lookup until the knowledge deadline.
+
+        Args:
+            wiki_future (concurrent.futures.Future): The running lookup.
+            start (float): `time.perf_counter()` value when the lookup was started.
+
+        Returns:
+            str or None: The summary, or None if there is none or it missed the deadline.
+        """
+        try:
+            # A late lookup keeps running in the background and still fills the cache.
+            return wiki_future.result(timeout=self.knowledge_deadline)
+        except Exception:
+            return None
+        finally:
+            self.last_timings['wikipedia'] = time.perf_counter() - start
+            self.telemetry.observe('chatbot_stage_seconds', self.last_timings['wikipedia'], stage='wikipedia')
+
+    @contextlib.contextmanager
+    def timed_stage(self, stage):
+        """
+        Records how long a block takes in `last_timings`.
+
+        Args:
+            stage (str): The stage name, e.g. 'generation'.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.last_timings[stage] = time.perf_counter() - start
+            self.telemetry.observe('chatbot_stage_seconds', self.last_timings[stage], stage=stage)
+
+    def record_trace(self):
+        """
+        Reports the route and stage timings of the last message to telemetry.
+        """
+        if not self.telemetry.enabled:
+            return
+        route = self.last_route or 'unknown'
+        self.telemetry.increment('chatbot_messages_total', route=route)
+        self.telemetry.observe('chatbot_stage_seconds', self.last_timings['total'], stage='total')
+        self.telemetry.export({'user_id': self.user_id, 'route': route, 'timings': dict(self.last_timings)})
+
+    def process_message_stream(self, message):
+        """
+        Processes a user message and yields the response incrementally.
+
+        Replies that do not need the language model are yielded in one piece; generated
+        replies are yielded token by token as the model produces them. Once the reply is
+        complete, the exchange is appended to the user's transcript.
+
+        Args:
+            message (str): The user's message.
+
+        Yields:
+            str: Successive chunks of the chatbot's response.
+        """
+        chunks = []
+        for chunk in self._stream_response(message):
+            chunks.append(chunk)
+            yield chunk
+        self.memory_store.add_exchange(self.user_id, message, ''.join(chunks), embedder=self.embedder)
+
+    def _stream_response(self, message):
+        """
+        Yields the chunks of the reply to a message; see `process_message_stream`.
+
+        Args:
+            message (str): The user's message.
+
+        Yields:
+            str: Successive chunks of the chatbot's response.
+        """
+        self.last_timings = {}
+        self.last_route = None
+        start = time.perf_counter()
+        self.stream_stats = {'time_to_first_token': None, 'total_time': None}
+
+        def emit(chunk):
+            # Record when the user first sees part of the reply.
+            if self.stream_stats['time_to_first_token'] is None:
+                self.stream_stats['time_to_first_token'] = time.perf_counter() - start
+            return chunk
+
+        response, context = self.prepare_response(message, search_knowledge=not self.concurrent_lookups)
+        if response is not None:
+            yield emit(response)
+            self.stream_stats['total_time'] = self.last_timings['total'] = time.perf_counter() - start
+            self.record_trace()
+            return
+
+        if self.concurrent_lookups:
+            # Start generating while Wikipedia is searched; tokens wait in the streamer meanwhile.
+            lookup_start = time.perf_counter()
+            wiki_future = get_lookup_executor().submit(self.search_wikipedia, message)
+            streamer, pending, error_response = self.start_streamed_generation(message)
+            wiki_response = self._await_knowledge(wiki_future, lookup_start)
+            if wiki_response:
+                if pending is not None:
+                    pending.cancel()
+                self.last_route = 'wiki'
+                yield emit(context + wiki_response)
+                self.stream_stats['total_time'] = self.last_timings['total'] = time.perf_counter() - start
+                self.record_trace()
+                return
         else:
-            intent = intent_result
-            intent_response = self.handle_predefined_intent(intent)
-            if intent_response:
-                return intent_response
+            streamer, pending, error_response = self.start_streamed_generation(message)
+        if pending is None:
+            # Not a generated reply (e.g. the model is still loading): don't remember it.
+            yield emit(error_response)
+            self.stream_stats['total_time'] = self.last_timings['total'] = time.perf_counter() - start
+            self.record_trace()
+            return
+        stream = self.stream_generation(pending, streamer)
+        
+        # Hold back the first few characters so that a too-short reply can still be
+        # replaced by the fallback message, exactly as `process_message` does.
+        chunks = []
+        released = False
+        with self.timed_stage('generation'):
+            for chunk in stream:
+                chunks.append(chunk)
+                if released:
+                    yield emit(chunk)
+                elif len(''.join(chunks).strip()) >= 10:
+                    released = True
+                    yield emit(context + ''.join(chunks))  # The memory prefix leads the reply.
+        
+        response = ''.join(chunks)
+        final_response = self.finish_generated_response(message, response, context)
+        if not released:
+            # Nothing has been shown yet: emit the final reply (or the fallback) in full.
+            yield emit(final_response)
+        self.stream_stats['total_time'] = self.last_timings['total'] = time.perf_counter() - start
+        self.record_trace()
+
+    def prepare_response(self, message, search_knowledge=True):
+        """
+        Answers a message without the language model when possible.
+
+        Args:
+            message (str): The user's message.
+            search_knowledge (bool): If False, Wikipedia is not searched here (the caller
+                                     searches it concurrently with generation).
+
+        Returns:
+            tuple: (response, context). `response` is the final reply, or None if the language
+                   model must generate it; `context` is the memory prefix for a generated reply.
+        """
+        # Route the message to a command or intent in a single pass.
+        with self.timed_stage('intent'):
+            match = self.router.route(message)
+        # Memory commands and joke history are reported under the intent they belong to.
+        self.last_route = 'memory' if match.intent in ('remember', 'recall', 'set_name') else match.intent
+        if match.intent == 'joke_history':
+            self.last_route = 'joke'
+
+        # Check for memory-related commands (e.g., "remember", "recall").
+        if match.intent == 'remember':
+            memory = match.slots['text']  # Extract the memory to store.
+            self.memory_store.add_memories(self.user_id, [memory], is_long_term=True, embedder=self.embedder)  # Add to long-term memory.
+            return f"I'll remember: {memory}", ""
+        
+        if match.intent == 'recall':
+            query = match.slots['text']  # Extract the query for retrieving memories.
+            memories = self.memory_manager.get_relevant_memories(query)  # Search for relevant memories.
+            if memories:
+                return "Related memories:\n" + "\n".join(memories), ""  # Return matched memories.
+            return "No relevant memories found.", ""
+        
+        if match.intent == 'set_name':
+            user_name = match.slots['text']  # Extract the user's name.
+            self.memory_store.set_user_name(self.user_id, user_name, embedder=self.embedder)
+            self.memory_store.add_memories(self.user_id, [f"User's name is {user_name}"], is_long_term=True, embedder=self.embedder)  # Store the name.
+            return f"Nice to meet you, {user_name}!", ""
+        
+        # Check for joke history requests.
+        if match.intent == 'joke_history':
+            joke_history = self.jokes_api.get_joke_history()  # Fetch joke history.
+            if joke_history:
+                return "Recent Joke History:\n" + "\n".join([
+                    f"Category: {joke['category']}, Joke: {joke['joke']}" 
+                    for joke in joke_history
+                ]), ""
+            return "No joke history available.", ""
+        
+        # Handle predefined intents with their slots (e.g., city for weather, category for jokes).
+        intent_response = self.handle_predefined_intent(match.intent, **match.slots)
+        if intent_response:
+            return intent_response, ""
         
         # Search for relevant memories to include in the context.
-        memories = self.memory_manager.get_relevant_memories(message)
+        with self.timed_stage('memory'):
+            memories = self.memory_manager.get_relevant_memories(message)
         if memories:
             context = "Relevant memories: " + "; ".join(memories) + "\n\n"
         else:
             context = ""
         
         # Perform a Wikipedia search for additional information.
-        wiki_response = self.search_wikipedia(message)
-        if wiki_response:
-            return context + wiki_response
-        
-        # Generate a conversational response using the language model.
-        response = self.generate_conversational_response(message)
+        if search_knowledge:
+            with self.timed_stage('wikipedia'):
+                wiki_response = self.search_wikipedia(message)
+            if wiki_response:
+                self.last_route = 'wiki'
+                return context + wiki_response, context
         
+        # Leave the reply to the language model.
+        self.last_route = 'generation'
+        return None, context
+
+    def finish_generated_response(self, message, response, context=""):
+        """
+        Applies the fallback reply and records a generated response in the user's memories.
+
+        Args:
+            message (str): The user's message.
+            response (str): The text generated by the language model.
+            context (str): The memory prefix returned by `prepare_response`.
+
+        Returns:
+            str: The final reply shown to the user.
+        """
         # Fallback response if no meaningful reply is generated.
         if not response or len(response.strip()) < 10:
             return "I'm sorry, I didn't understand that."
         
-        # Add the user message and bot response to memory and chat history.
-        self.memory_manager.add_memory(message)
-        self.memory_manager.add_memory(response)
-        
-        self.chat_history.append({
-            'user': message,
-            'bot': response
-        })
+        # Add the user message and bot response to memory for later recall.
+        self.memory_store.add_memories(self.user_id, [message, response], embedder=self.embedder)
         
         return context + response
 
-def search_wikipedia(self, query):
-    """
-    Searches Wikipedia for a summary based on the provided query.
+    def search_wikipedia(self, query):
+        """
+        Searches Wikipedia for a summary based on the provided query.
 
-    Args:
-        query (str): The search query, typically from the user's input.
+        Lookups go through the shared `WikipediaService`, which caches results (including
+        misses) and can answer from a local dump in offline mode.
 
-    Returns:
-        str or None: A brief summary from Wikipedia if the query is found, or None if an error occurs.
-    """
-    try:
-        # Clean up the query by removing leading question words (e.g., "what", "who").
-        clean_query = re.sub(r'^(what|who|where|when|why|how)\s+', '', query, flags=re.IGNORECASE)
-        
-        # Fetch a two-sentence summary from Wikipedia for the cleaned query.
-        summary = wikipedia.summary(clean_query, sentences=2)
-        return summary
-    except Exception:
-        # Return None if an error occurs (e.g., no results found).
-        return None
+        Args:
+            query (str): The search query, typically from the user's input.
 
-def generate_conversational_response(self, message):
-    """
-    Generates a conversational response using the chatbot's language model.
+        Returns:
+            str or None: A brief summary from Wikipedia if the query is found, or None if an error occurs.
+        """
+        return self.wikipedia.search(query, sentences=2)
 
-    Args:
-        message (str): The user's message to which the chatbot should respond.
+    def generate_conversational_response(self, message):
+        """
+        Generates a conversational response using the chatbot's language model.
 
-    Returns:
-        str: The generated response or an error message if the model is unavailable.
-    """
-    # Check if the tokenizer and model are properly initialized.
-    if not self.tokenizer or not self.model:
-        return "Sorry, my language model is not available right now."
-    
-    # Encode the user's input into token IDs, appending the end-of-sequence token.
-    input_ids = self.tokenizer.encode(
-        message + self.tokenizer.eos_token,  # Append EOS token to indicate the end of the input.
-        return_tensors='pt'  # Return the encoded tokens as PyTorch tensors.
-    )
+        Args:
+            message (str): The user's message to which the chatbot should respond.
+
+        Returns:
+            str: The generated response or an error message if the model is unavailable.
+        """
+        pending, error_response = self.start_generation(message)
+        if pending is None:
+            return error_response
+        return self.collect_generation(pending)
+
+    def start_generation(self, message, streamer=None):
+        """
+        Queues generation of a reply without waiting for it.
+
+        Args:
+            message (str): The user's message to which the chatbot should respond.
+            streamer (TextIteratorStreamer, optional): Receives tokens as they are generated.
+
+        Returns:
+            tuple: (pending, error_response). `pending` is a `PendingGeneration`, or None when
+                   generation could not be started, in which case `error_response` explains why.
+        """
+        # Check that the model has finished loading, waiting briefly if configured to.
+        if not self.model_ready(self.model_wait_timeout):
+            return None, self.model_unavailable_response()
     
-    with torch.no_grad():  # Disable gradient computation for inference (faster and less memory-intensive).
-        # Generate a response from the model using the input tokens.
-        output = self.model.generate(
-            input_ids,  # Input tokens.
-            max_length=1000,  # Maximum length of the generated response.
-            pad_token_id=self.tokenizer.eos_token_id  # Use the EOS token for padding.
+        # Encode the user's input into token IDs, appending the end-of-sequence token.
+        with self.timed_stage('tokenize'):
+            new_ids = self.tokenizer.encode(
+                message + self.tokenizer.eos_token  # Append EOS token to indicate the end of the input.
+            )
+        # Prepend the previous turns; the cached ones are not encoded again.
+        input_ids, cache = self.context.prepare(new_ids)
+
+        cancel_event = threading.Event()
+        cache_key = self.response_cache_key(message, input_ids, new_ids)
+        if cache_key is not None:
+            reply_ids = self.response_cache.get(cache_key)
+            if reply_ids is not None:
+                # Another session already generated this reply; skip the model entirely.
+                future = Future()
+                future.set_result((reply_ids, None))
+                return PendingGeneration(new_ids, future, cancel_event, cached=True), None
+        generate_kwargs = {'stopping_criteria': transformers.StoppingCriteriaList([CancelledCriteria(cancel_event)])}
+        if streamer is not None:
+            generate_kwargs['streamer'] = streamer
+        reuse_cache = self.reuse_context_cache
+        if self.draft_ready():
+            # Let the draft model propose tokens. Assisted decoding re-encodes the prompt
+            # rather than extending a supplied KV cache, so the turns are passed without one.
+            generate_kwargs['assistant_model'] = self.draft_model
+            reuse_cache = False
+        if not reuse_cache:
+            cache = None  # Re-encode the earlier turns; the request can then join a batch.
+        try:
+            # Queue the request with the shared scheduler, which serves every session.
+            future = self.registry.get_scheduler(self.model_name).submit(
+                input_ids, past_key_values=cache, return_cache=reuse_cache, **generate_kwargs
+            )
+        except InferenceQueueFull:
+            return None, "I'm handling a lot of conversations right now. Please try again in a moment."
+        self.context.attach(future)
+        return PendingGeneration(new_ids, future, cancel_event, returns_cache=reuse_cache, cache_key=cache_key), None
+
+    def collect_generation(self, pending, timeout=None):
+        """
+        Waits for a queued generation, records the turn in the context and decodes the reply.
+
+        Args:
+            pending (PendingGeneration): The generation returned by `start_generation`.
+            timeout (float, optional): Seconds to wait before giving up.
+
+        Returns:
+            str: The generated response.
+
+        Raises:
+            concurrent.futures.TimeoutError: If the reply is not ready within `timeout`.
+        """
+        output_ids, cache = pending.result(timeout=timeout)
+        self.commit_generation(pending, output_ids, cache)
+
+        # Decode the generated tokens into a human-readable string.
+        response = self.tokenizer.decode(
+            output_ids,
+            skip_special_tokens=True  # Exclude special tokens from the decoded response.
         )
     
-    # Decode the model's output tokens into a human-readable string.
-    response = self.tokenizer.decode(
-        output[:, input_ids.shape[-1]:][0],  # Slice out only the generated part of the output.
-        skip_special_tokens=True  # Exclude special tokens from the decoded response.
-    )
-    
-    return response
+        return response
+
+    def commit_generation(self, pending, output_ids, cache):
+        """
+        Records a finished generation in the conversation context and, if complete, in the response cache.
+
+        Args:
+            pending (PendingGeneration): The generation returned by `start_generation`.
+            output_ids (list): The generated token IDs.
+            cache: The KV cache returned with them.
+        """
+        self.context.commit(pending.new_ids, output_ids, cache)
+        if pending.cache_key is not None:
+            # Only cache replies that ended on their own or used the whole token budget, never
+            # ones cut short by the time limit.
+            max_new_tokens = self.registry.get_scheduler(self.model_name).generate_kwargs.get('max_new_tokens')
+            if (output_ids and output_ids[-1] == self.tokenizer.eos_token_id) or len(output_ids) == max_new_tokens:
+                self.response_cache.set(pending.cache_key, output_ids)
+
+    def create_streamer(self):
+        """
+        Creates a streamer that hands decoded text from the scheduler's worker thread to the caller.
+
+        Returns:
+            TextIteratorStreamer: The streamer.
+        """
+        return transformers.TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=0.1)
+
+    def generate_conversational_response_stream(self, message):
+        """
+        Generates a conversational response and yields it as tokens are produced.
+
+        Args:
+            message (str): The user's message to which the chatbot should respond.
+
+        Yields:
+            str: Successive pieces of decoded text.
+        """
+        streamer, pending, error_response = self.start_streamed_generation(message)
+        if pending is None:
+            yield error_response
+            return
+        yield from self.stream_generation(pending, streamer)
+
+    def start_streamed_generation(self, message):
+        """
+        Queues generation of a reply whose tokens are streamed, once the model is ready.
+
+        Args:
+            message (str): The user's message to which the chatbot should respond.
+
+        Returns:
+            tuple: (streamer, pending, error_response), where `pending` is None when generation
+                   could not be started and `error_response` explains why.
+        """
+        if not self.model_ready(self.model_wait_timeout):
+            return None, None, self.model_unavailable_response()
+        streamer = self.create_streamer()
+        pending, error_response = self.start_generation(message, streamer=streamer)
+        return streamer, pending, error_response
+
+    def stream_generation(self, pending, streamer):
+        """
+        Yields the text of a queued generation as it arrives, then records the turn.
+
+        Args:
+            pending (PendingGeneration): The generation returned by `start_generation`.
+            streamer (TextIteratorStreamer): The streamer passed to `start_generation`.
+
+        Yields:
+            str: Successive pieces of decoded text.
+        """
+        if pending.cached:
+            # A cached reply is complete already; there is nothing to stream token by token.
+            output_ids, cache = pending.result()
+            self.commit_generation(pending, output_ids, cache)
+            yield self.tokenizer.decode(output_ids, skip_special_tokens=True)
+            return
+        chunks = iter(streamer)
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            except queue.Empty:
+                # No new token yet; stop waiting if generation failed before finishing the stream.
+                if pending.future.done() and pending.future.exception() is not None:
+                    raise pending.future.exception()
+                continue
+            if chunk:
+                yield chunk
+        output_ids, cache = pending.result()  # Surface any error raised after the stream ended.
+        self.commit_generation(pending, output_ids, cache)
+
+class RemoteChatbot:
+    def __init__(self, base_url, user_id=None, timeout=120.0, max_cached_exchanges=100):
+        """
+        Talks to a chat server (see server.py) instead of running a model in this process.
+
+        Args:
+            base_url (str): The server's address, e.g. 'http://127.0.0.1:8000'.
+            user_id (str, optional): Whose memories the server should use.
+            timeout (float): Seconds to wait for a reply.
+            max_cached_exchanges (int): Exchanges of the transcript kept for display. The server
+                                        holds the conversation itself, so older ones are dropped.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.user_id = user_id
+        self.timeout = timeout
+        self.session_id = None  # Issued by the server with the first reply.
+        self.stream_stats = None
+        self.last_timings = {}
+        self.transcript = Transcript(max_cached=max_cached_exchanges)
+
+    def process_message(self, message):
+        """
+        Sends a message to the chat server and returns its reply.
+
+        Args:
+            message (str): The user's message.
+
+        Returns:
+            str: The chatbot's response, or an explanation if the server could not answer.
+        """
+        response = self._request_reply(message)
+        self.transcript.append(message, response)
+        return response
+
+    def _request_reply(self, message):
+        """
+        Posts a message to the chat server.
+
+        Args:
+            message (str): The user's message.
+
+        Returns:
+            str: The server's reply, or an explanation if it could not answer.
+        """
+        try:
+            response = get_http_client().session.post(
+                f"{self.base_url}/chat",
+                json={'message': message, 'session_id': self.session_id, 'user_id': self.user_id},
+                timeout=self.timeout
+            )
+        except requests.RequestException:
+            return "Sorry, I couldn't reach the chat server."
+        if response.status_code == 429:
+            return "I'm handling a lot of conversations right now. Please try again in a moment."
+        if response.status_code != 200:
+            return "Sorry, the chat server couldn't answer that."
+        body = response.json()
+        self.session_id = body['session_id']
+        self.last_timings = body.get('timings', {})
+        return body['response']
+
+    def process_message_stream(self, message):
+        """
+        Yields the server's reply in one piece, matching `AdvancedChatbot.process_message_stream`.
+
+        Args:
+            message (str): The user's message.
+
+        Yields:
+            str: The chatbot's response.
+        """
+        start = time.perf_counter()
+        response = self.process_message(message)
+        elapsed = time.perf_counter() - start
+        self.stream_stats = {'time_to_first_token': elapsed, 'total_time': elapsed}
+        yield response
 
 def main():
     """
@@ -481,35 +4016,93 @@ def main():
     # Display the title of the chatbot application.
     st.title("Advanced AI Chatbot")
     
+    # Identify the user through the URL so that reloading the page keeps their memories.
+    if 'user' not in st.query_params:
+        st.query_params['user'] = uuid.uuid4().hex
+
     # Initialize the chatbot instance in the session state if it hasn't been already.
+    # Talk to a shared chat server when one is configured instead of loading a model here.
     if 'chatbot' not in st.session_state:
-        st.session_state.chatbot = AdvancedChatbot()
+        backend_url = get_setting('CHAT_BACKEND_URL')
+        if backend_url:
+            st.session_state.chatbot = RemoteChatbot(
+                backend_url, user_id=st.query_params['user'],
+                max_cached_exchanges=int(get_setting('TRANSCRIPT_MAX_CACHED_EXCHANGES', 100))
+            )
+        else:
+            st.session_state.chatbot = AdvancedChatbot(user_id=st.query_params['user'])
+    chatbot = st.session_state.chatbot
     
-    # Initialize messages in session state if they do not exist.
-    if 'messages' not in st.session_state:
-        st.session_state.messages = []  # Stores the chat history as a list of dictionaries.
+    # Only the most recent exchanges are rendered, so a rerun costs the same however long the
+    # conversation is; earlier ones are read back from the chatbot's transcript a page at a time.
+    page_size = int(get_setting('TRANSCRIPT_PAGE_SIZE', 20))
+    if 'transcript_window' not in st.session_state:
+        st.session_state.transcript_window = page_size
+    transcript = chatbot.transcript
+    window = st.session_state.transcript_window
+    if len(transcript) > window:
+        st.button(
+            f"Load earlier messages ({len(transcript) - window} more)",
+            on_click=lambda: st.session_state.update(transcript_window=window + page_size)
+        )
     
-    # Display existing chat messages stored in session state.
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):  # Use the role (user/assistant) to style the message.
-            st.markdown(message["content"])  # Display the content of the message.
+    # Display the window of earlier exchanges.
+    for user_message, bot_response in transcript.window(window):
+        with st.chat_message("user"):
+            st.markdown(user_message)
+        with st.chat_message("assistant"):
+            st.markdown(bot_response)
     
     # Handle user input in the chat input box.
     if prompt := st.chat_input("What would you like to chat about?"):
-        # Add the user's message to the session state's chat history.
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        # Go back to the most recent page once the conversation moves on.
+        st.session_state.transcript_window = page_size
         
         # Display the user's message in the chat interface.
         with st.chat_message("user"):
             st.markdown(prompt)
         
-        # Get the chatbot's response to the user's input.
+        # Stream the chatbot's response as it is generated; the chatbot records the exchange
+        # in its transcript.
         with st.chat_message("assistant"):
-            response = st.session_state.chatbot.process_message(prompt)  # Process the input to generate a response.
-            st.markdown(response)  # Display the chatbot's response in the chat interface.
-        
-        # Add the chatbot's response to the session state's chat history.
-        st.session_state.messages.append({"role": "assistant", "content": response})
+            st.write_stream(chatbot.process_message_stream(prompt))
+
+    with st.sidebar:
+        stream_stats = chatbot.stream_stats
+        if stream_stats and stream_stats['time_to_first_token'] is not None:
+            st.metric("Time to first token", f"{stream_stats['time_to_first_token'] * 1000:.0f} ms")
+        if isinstance(chatbot, RemoteChatbot):
+            st.caption(f"Served by {chatbot.base_url}")
+        else:
+            if chatbot.registry.readiness(chatbot.model_name) == 'loading':
+                st.caption("Warming up the language model…")
+            # Report how much memory each session costs now that the model is shared.
+            stats = chatbot.registry.memory_stats()
+            if stats['rss_bytes_per_session'] is not None:
+                st.metric("Resident memory per session", format_bytes(stats['rss_bytes_per_session']))
+            st.caption(
+                f"Shared model weights: {format_bytes(stats['model_bytes'])} "
+                f"across {stats['sessions']} session(s) · "
+                f"this session's state: {format_bytes(chatbot.session_state_bytes())}"
+            )
+            if chatbot.response_cache is not None:
+                cache_stats = chatbot.response_cache.summary()
+                if cache_stats['hit_rate'] is not None:
+                    st.caption(
+                        f"Response cache: {cache_stats['hit_rate']:.0%} hit rate · "
+                        f"{cache_stats['entries']} replies in {format_bytes(cache_stats['bytes'])}"
+                    )
+            if chatbot.draft_model is not None:
+                # Let operators confirm the draft model pays off on real traffic.
+                decoding = chatbot.registry.get_scheduler(chatbot.model_name).decoding_stats()
+                assisted, standard = decoding['assisted'], decoding['standard']
+                if assisted['acceptance_rate'] is not None:
+                    st.caption(
+                        f"Assisted decoding ({chatbot.draft_model_name}): "
+                        f"{assisted['acceptance_rate']:.0%} of draft tokens accepted · "
+                        f"{assisted['tokens_per_second']} tokens/s "
+                        f"(standard decoding: {standard['tokens_per_second'] or '–'} tokens/s)"
+                    )
 
 # Entry point for the Streamlit application.
 if __name__ == "__main__":
@@ -0,0 +1,327 @@
+"""
+Headless HTTP/JSON chat service.
+
+Serves `AdvancedChatbot.process_message` to any client, so the Streamlit UI (with
+CHAT_BACKEND_URL set) and load generators share one scalable backend instead of each
+browser tab owning a model. Start it with:
+
+    python server.py --model microsoft/DialoGPT-medium --port 8000 --workers 4
+
+Endpoints:
+
+    POST   /sessions             {"user_id": optional}             -> 201 {"session_id"}
+    POST   /chat                 {"message", "session_id"?, "user_id"?} -> 200 {"session_id", "response", "timings"}
+    DELETE /sessions/<session_id>                                   -> 204
+    GET    /health                                                  -> 200 service statistics
+    GET    /metrics                                                 -> 200 Prometheus text (TELEMETRY=on)
+
+Requests are run by a fixed pool of workers fed from a bounded queue; when the queue is
+full the service answers 429 with a Retry-After header instead of queuing without limit.
+"""
+import argparse
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from flask import Flask, jsonify, request
+
+from main import AdvancedChatbot, get_model_registry, get_response_cache, get_setting, get_telemetry
+
+class ServiceOverloaded(RuntimeError):
+    """Raised when the request queue has no room for another message."""
+
+class ChatSession:
+    def __init__(self, session_id, chatbot):
+        """
+        Holds one conversation served by the chat service.
+
+        Args:
+            session_id (str): The session's identifier.
+            chatbot (AdvancedChatbot): The chatbot carrying the conversation's state.
+        """
+        self.session_id = session_id
+        self.chatbot = chatbot
+        self.lock = threading.Lock()  # Messages of one session are processed one at a time, in order.
+        self.last_used = time.monotonic()
+
+class ChatService:
+    def __init__(self, chatbot_factory=None, model_name='microsoft/DialoGPT-medium', workers=4, max_queue_size=32,
+                 max_sessions=1000, session_idle_timeout=1800, draft_model_name=None):
+        """
+        Initializes a pool of workers that process chat messages for many sessions.
+
+        Args:
+            chatbot_factory (callable, optional): Called with a user ID to create a session's
+                                                  chatbot. Defaults to an `AdvancedChatbot`
+                                                  for `model_name`.
+            model_name (str): The language model served by the default chatbot factory.
+            workers (int): Messages processed concurrently. Generation requests from all
+                           workers are batched by the shared inference scheduler, except
+                           follow-up turns reusing their KV cache (see CONTEXT_KV_CACHE).
+            max_queue_size (int): Messages allowed to wait for a worker before new ones are
+                                  rejected with `ServiceOverloaded`.
+            max_sessions (int): Sessions kept at once; the least recently used is closed first.
+            session_idle_timeout (float): Seconds after which an unused session is closed.
+            draft_model_name (str, optional): Draft model for assisted decoding in the default
+                                              chatbot factory. Defaults to the DRAFT_MODEL setting.
+        """
+        self.model_name = model_name
+        self.chatbot_factory = chatbot_factory
+        if chatbot_factory is None:
+            self.chatbot_factory = lambda user_id: AdvancedChatbot(
+                model_name=model_name, user_id=user_id, draft_model_name=draft_model_name
+            )
+            # Start loading the model now; until it is ready, replies that need it get a placeholder.
+            get_model_registry().warm_up(model_name)
+        self.max_sessions = max_sessions
+        self.session_idle_timeout = session_idle_timeout
+        self._sessions = OrderedDict()  # session ID -> ChatSession, least recently used first.
+        self._sessions_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self.stats = {'requests': 0, 'completed': 0, 'rejected': 0, 'errors': 0}
+        self._stats_lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._run, name=f'chat-worker-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def open_session(self, session_id=None, user_id=None):
+        """
+        Returns an existing session or opens a new one.
+
+        Args:
+            session_id (str, optional): The session to resume. A new ID is issued when omitted.
+            user_id (str, optional): Whose memories the session uses. Defaults to the session ID,
+                                     so a resumed session keeps its memories across restarts.
+
+        Returns:
+            ChatSession: The session.
+        """
+        session_id = session_id or uuid.uuid4().hex
+        with self._sessions_lock:
+            self._close_idle_sessions()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_used = time.monotonic()
+                return session
+        # Build the chatbot outside the lock; it may have to load the model.
+        chatbot = self.chatbot_factory(user_id or session_id)
+        with self._sessions_lock:
+            # Another request may have opened the same session in the meantime.
+            session = self._sessions.setdefault(session_id, ChatSession(session_id, chatbot))
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return session
+
+    def close_session(self, session_id):
+        """
+        Closes a session, releasing its conversation state.
+
+        Args:
+            session_id (str): The session to close.
+
+        Returns:
+            bool: True if the session existed.
+        """
+        with self._sessions_lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _close_idle_sessions(self):
+        """
+        Closes sessions unused for longer than `session_idle_timeout`. Called with the sessions lock held.
+        """
+        cutoff = time.monotonic() - self.session_idle_timeout
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_used >= cutoff:
+                break
+            self._sessions.popitem(last=False)
+
+    def submit(self, session, message):
+        """
+        Queues a message for processing without waiting for the reply.
+
+        Args:
+            session (ChatSession): The session the message belongs to.
+            message (str): The user's message.
+
+        Returns:
+            Future: Resolves to a dictionary with the response and per-stage timings.
+
+        Raises:
+            ServiceOverloaded: If `max_queue_size` messages are already waiting.
+        """
+        future = Future()
+        try:
+            self._queue.put_nowait((session, message, future))
+        except queue.Full:
+            with self._stats_lock:
+                self.stats['rejected'] += 1
+            raise ServiceOverloaded("Too many pending messages.")
+        with self._stats_lock:
+            self.stats['requests'] += 1
+        return future
+
+    def _run(self):
+        """
+        Worker loop: processes queued messages until a None sentinel is received.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            session, message, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with session.lock:
+                    session.last_used = time.monotonic()
+                    response = session.chatbot.process_message(message)
+                    timings = dict(session.chatbot.last_timings)
+                future.set_result({'session_id': session.session_id, 'response': response, 'timings': timings})
+                with self._stats_lock:
+                    self.stats['completed'] += 1
+            except Exception as e:
+                with self._stats_lock:
+                    self.stats['errors'] += 1
+                future.set_exception(e)
+
+    def health(self):
+        """
+        Summarizes the service's load.
+
+        Returns:
+            dict: Request counters, queue depth, worker and session counts.
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        with self._sessions_lock:
+            stats['sessions'] = len(self._sessions)
+        stats['queued'] = self._queue.qsize()
+        stats['max_queue_size'] = self._queue.maxsize
+        stats['workers'] = len(self._workers)
+        return stats
+
+    def shutdown(self):
+        """
+        Stops the workers after the messages already queued have been processed.
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+def create_app(service=None, request_timeout=None):
+    """
+    Creates the Flask application exposing a chat service.
+
+    Args:
+        service (ChatService, optional): The service to expose. Defaults to one configured
+                                         from the SERVER_* settings.
+        request_timeout (float, optional): Seconds a request waits for its reply before 504.
+
+    Returns:
+        Flask: The application.
+    """
+    if service is None:
+        service = ChatService(
+            model_name=get_setting('SERVER_MODEL', 'microsoft/DialoGPT-medium'),
+            workers=int(get_setting('SERVER_WORKERS', 4)),
+            max_queue_size=int(get_setting('SERVER_MAX_QUEUE_SIZE', 32)),
+            max_sessions=int(get_setting('SERVER_MAX_SESSIONS', 1000)),
+            session_idle_timeout=float(get_setting('SERVER_SESSION_IDLE_TIMEOUT', 1800)),
+            draft_model_name=get_setting('SERVER_DRAFT_MODEL')
+        )
+    if request_timeout is None:
+        request_timeout = float(get_setting('SERVER_REQUEST_TIMEOUT', 120))
+    app = Flask(__name__)
+    app.config['CHAT_SERVICE'] = service
+
+    @app.post('/sessions')
+    def open_session():
+        body = request.get_json(silent=True) or {}
+        session = service.open_session(user_id=body.get('user_id'))
+        return jsonify({'session_id': session.session_id}), 201
+
+    @app.delete('/sessions/<session_id>')
+    def close_session(session_id):
+        if not service.close_session(session_id):
+            return jsonify({'error': "Unknown session."}), 404
+        return '', 204
+
+    @app.post('/chat')
+    def chat():
+        body = request.get_json(silent=True) or {}
+        message = body.get('message')
+        if not isinstance(message, str) or not message.strip():
+            return jsonify({'error': "A non-empty 'message' is required."}), 400
+        session = service.open_session(body.get('session_id'), body.get('user_id'))
+        try:
+            future = service.submit(session, message)
+        except ServiceOverloaded:
+            # Tell well-behaved clients to back off instead of piling up requests.
+            return jsonify({'error': "The server is busy.", 'session_id': session.session_id}), 429, {'Retry-After': '1'}
+        try:
+            return jsonify(future.result(timeout=request_timeout))
+        except FutureTimeoutError:
+            future.cancel()
+            return jsonify({'error': "Timed out waiting for a reply.", 'session_id': session.session_id}), 504
+
+    @app.get('/health')
+    def health():
+        stats = service.health()
+        stats['memory'] = get_model_registry().memory_stats()
+        stats['model'] = get_model_registry().readiness(service.model_name)
+        if stats['model'] == 'ready':
+            # Throughput of standard vs. assisted decoding and the draft model's acceptance rate.
+            stats['decoding'] = get_model_registry().get_scheduler(service.model_name).decoding_stats()
+        if get_response_cache() is not None:
+            stats['response_cache'] = get_response_cache().summary()
+        return jsonify(stats)
+
+    @app.get('/metrics')
+    def metrics():
+        telemetry = get_telemetry()
+        if not telemetry.enabled:
+            return "Telemetry is disabled; set TELEMETRY=on.\n", 404, {'Content-Type': 'text/plain'}
+        return telemetry.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    return app
+
+def main():
+    """
+    Parses command-line arguments and serves the chat API.
+    """
+    parser = argparse.ArgumentParser(description="Headless chat API server.")
+    parser.add_argument('--host', default=get_setting('SERVER_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(get_setting('SERVER_PORT', 8000)))
+    parser.add_argument('--model', default=get_setting('SERVER_MODEL', 'microsoft/DialoGPT-medium'))
+    parser.add_argument('--draft-model', default=get_setting('SERVER_DRAFT_MODEL'),
+                        help="Smaller model sharing the tokenizer that drafts tokens for assisted decoding.")
+    parser.add_argument('--workers', type=int, default=int(get_setting('SERVER_WORKERS', 4)))
+    parser.add_argument('--max-queue-size', type=int, default=int(get_setting('SERVER_MAX_QUEUE_SIZE', 32)))
+    args = parser.parse_args()
+
+    service = ChatService(
+        model_name=args.model,
+        workers=args.workers,
+        max_queue_size=args.max_queue_size,
+        max_sessions=int(get_setting('SERVER_MAX_SESSIONS', 1000)),
+        session_idle_timeout=float(get_setting('SERVER_SESSION_IDLE_TIMEOUT', 1800)),
+        draft_model_name=args.draft_model
+    )
+    app = create_app(service)
+    # The HTTP threads only wait on replies; the bounded worker pool does the processing.
+    app.run(host=args.host, port=args.port, threaded=True)
+
+# Entry point for running the server from the command line.
+if __name__ == "__main__":
+    main()
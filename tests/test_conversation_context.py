@@ -0,0 +1,28 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from main import ConversationContext
+
+def test_prepare_does_not_wait_for_a_generation_cancelled_while_queued():
+    context = ConversationContext(eos_token_id=0)
+    future = Future()  # Queued: the scheduler has not picked it up yet.
+    context.attach(future)
+    assert future.cancel()
+
+    start = time.monotonic()
+    input_ids, cache = context.prepare([1, 2, 0])
+    assert time.monotonic() - start < 0.5
+    assert input_ids == [1, 2, 0]
+    assert cache is None
+
+def test_prepare_waits_for_a_running_generation():
+    context = ConversationContext(eos_token_id=0)
+    future = Future()
+    assert future.set_running_or_notify_cancel()
+    context.attach(future)
+    threading.Timer(0.2, future.set_result, args=(([], None),)).start()
+
+    start = time.monotonic()
+    context.prepare([1, 0])
+    assert time.monotonic() - start >= 0.15
@@ -0,0 +1,53 @@
+from concurrent.futures import Future
+
+import pytest
+
+from main import AdvancedChatbot, UserMemoryStore
+
+class LoadingRegistry:
+    """A model registry whose model never finishes loading."""
+    def __init__(self):
+        self.loading = Future()
+
+    def track_session(self, session):
+        pass
+
+    def warm_up(self, model_name, retry_failed=False):
+        return self.loading
+
+    def readiness(self, model_name):
+        return 'loading'
+
+class NoKnowledge:
+    def search(self, query, sentences=2):
+        return None
+
+class NoJokes:
+    def get_joke_categories(self):
+        return []
+
+@pytest.fixture
+def chatbot(tmp_path, monkeypatch):
+    monkeypatch.setenv('PIPELINE_MODE', 'sequential')
+    store = UserMemoryStore(path=str(tmp_path / 'memory.db'))
+    return AdvancedChatbot(model_name='loading-model', registry=LoadingRegistry(), memory_store=store,
+                          wikipedia_service=NoKnowledge(), weather_service=object(), jokes_api=NoJokes(),
+                          draft_model_name='', response_cache=False)
+
+MESSAGE = 'What do you think about long walks on the beach?'
+
+def test_sequential_reply_while_loading_is_not_remembered(chatbot):
+    response = chatbot.process_message(MESSAGE)
+    assert response == chatbot.model_unavailable_response()
+    assert chatbot.memory_manager.short_term_memory == []
+
+def test_sequential_streamed_reply_while_loading_is_not_remembered(chatbot):
+    response = ''.join(chatbot.process_message_stream(MESSAGE))
+    assert response == chatbot.model_unavailable_response()
+    assert chatbot.memory_manager.short_term_memory == []
+
+def test_generate_conversational_response_returns_the_reply_text(chatbot):
+    assert chatbot.generate_conversational_response(MESSAGE) == chatbot.model_unavailable_response()
+
+def test_response_cache_can_be_turned_off_per_chatbot(chatbot):
+    assert chatbot.response_cache is None
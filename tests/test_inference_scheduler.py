@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+import torch
+import transformers
+
+from main import CancelledCriteria, InferenceScheduler
+
+EOS = 0
+
+class Tokenizer:
+    """The scheduler only needs a tokenizer's special token IDs."""
+    eos_token_id = EOS
+    pad_token_id = None
+
+class Streamer:
+    """Collects what a streamer receives, as `TextIteratorStreamer` would decode it."""
+    def __init__(self):
+        self.prompt = None
+        self.tokens = []
+        self.ended = False
+
+    def put(self, value):
+        assert value.shape[0] == 1  # Every streamer only ever sees its own row.
+        if self.prompt is None:
+            self.prompt = value[0].tolist()
+        else:
+            self.tokens.extend(value.tolist())
+
+    def end(self):
+        self.ended = True
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=50, n_positions=64, n_embd=32, n_layer=2, n_head=2,
+                                     bos_token_id=EOS, eos_token_id=EOS)
+    return transformers.GPT2LMHeadModel(config).eval()
+
+def create_scheduler(model):
+    # A long wait window so that requests submitted together land in one batch.
+    return InferenceScheduler(Tokenizer(), model, max_batch_size=8, max_wait_ms=200,
+                              generate_kwargs={'max_new_tokens': 6, 'min_new_tokens': 6})
+
+PROMPTS = [[5, 6, 7, 8, 9, EOS], [10, 11, EOS], [12, 13, 14, EOS]]
+
+def test_per_request_options_share_one_batch(model):
+    scheduler = create_scheduler(model)
+    solo = [scheduler.submit(prompt).result() for prompt in PROMPTS]
+    batches = scheduler.stats['batches']
+
+    streamers = [Streamer() for _ in PROMPTS]
+    futures = [
+        scheduler.submit(prompt, return_cache=True, streamer=streamer,
+                         stopping_criteria=transformers.StoppingCriteriaList([CancelledCriteria(threading.Event())]))
+        for prompt, streamer in zip(PROMPTS, streamers)
+    ]
+    results = [future.result() for future in futures]
+    scheduler.shutdown()
+
+    assert scheduler.stats['batches'] == batches + 1
+    for prompt, expected, (output_ids, cache), streamer in zip(PROMPTS, solo, results, streamers):
+        assert output_ids == expected
+        assert streamer.prompt[-len(prompt):] == prompt
+        assert streamer.tokens == output_ids
+        assert streamer.ended
+        # Each request gets its own cache, without the batch's left padding.
+        assert cache.get_seq_length() == len(prompt) + len(output_ids) - 1
+
+def test_split_cache_continues_like_a_fresh_prompt(model):
+    scheduler = create_scheduler(model)
+    futures = [scheduler.submit(prompt, return_cache=True) for prompt in PROMPTS]
+    output_ids, cache = futures[1].result()
+    for future in futures:
+        future.result()
+
+    follow_up = PROMPTS[1] + output_ids + [20, 21, EOS]
+    with_cache = scheduler.submit(follow_up, past_key_values=cache, return_cache=True).result()[0]
+    without_cache = scheduler.submit(follow_up).result()
+    scheduler.shutdown()
+    assert with_cache == without_cache
+
+def test_cancelling_one_request_stops_only_its_row(model):
+    scheduler = create_scheduler(model)
+    expected = scheduler.submit(PROMPTS[0]).result()
+    cancelled = threading.Event()
+    cancelled.set()
+    futures = [
+        scheduler.submit(PROMPTS[0], stopping_criteria=transformers.StoppingCriteriaList([CancelledCriteria(threading.Event())])),
+        scheduler.submit(PROMPTS[1], stopping_criteria=transformers.StoppingCriteriaList([CancelledCriteria(cancelled)]))
+    ]
+    kept, stopped = [future.result() for future in futures]
+    scheduler.shutdown()
+    assert kept == expected
+    assert set(stopped[1:]) <= {EOS}  # Only padding after the first step.
+    # Every request is counted, and the padding of the stopped row is not a generated token.
+    stats = scheduler.decoding_stats()['standard']
+    assert stats['requests'] == 3
+    assert stats['tokens'] == len(expected) + len(kept) + 1
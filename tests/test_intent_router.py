@@ -0,0 +1,53 @@
+import pytest
+
+from main import IntentRouter
+
+INTENTS = {
+    'greeting': ['hello', 'hi', 'hey', 'greetings'],
+    'weather': ['weather', 'temperature', 'forecast'],
+    'time': ['time', 'current time', 'what time'],
+    'joke': ['joke', 'humor', 'funny'],
+    'help': ['help', 'assist', 'support'],
+    'memory': ['remember', 'recall', 'memory']
+}
+CATEGORIES = ['programming', 'misc', 'dark', 'pun', 'christmas']
+
+@pytest.fixture(scope='module')
+def router():
+    return IntentRouter(INTENTS, CATEGORIES)
+
+@pytest.mark.parametrize('message, intent, slots', [
+    ('Tell me a joke', 'joke', {}),
+    ('tell me some jokes', 'joke', {}),
+    ('jokes please', 'joke', {}),
+    ('any jokes about christmas?', 'joke', {'category': 'christmas'}),
+    ('Got any pun jokes?', 'joke', {'category': 'pun'}),
+    ('I love puns, tell me a joke', 'joke', {'category': 'pun'}),
+    ("What's the weather in New York today?", 'weather', {'city': 'New York'}),
+    ('Any weather forecasts for the weekend?', 'weather', {}),
+    ('hi there', 'greeting', {}),
+    ('this is his book', 'general', {}),
+    ('joke history', 'joke_history', {}),
+    ('weather in Rome next week', 'weather', {'city': 'Rome'}),
+    ('weather in Paris tonight', 'weather', {'city': 'Paris'}),
+    ('What will the weather in New York be like later?', 'weather', {'city': 'New York'}),
+    ('weather in Rio de Janeiro this weekend', 'weather', {'city': 'Rio de Janeiro'}),
+    ("How's the weather in San Francisco going to be", 'weather', {'city': 'San Francisco'}),
+    ('weather in Paris in the morning', 'weather', {'city': 'Paris'}),
+    # Messages with two intents resolve as the keyword scans did.
+    ('Ha, that was funny. What is the weather in Paris?', 'weather', {'city': 'Paris'}),
+    ('hello, you are funny', 'greeting', {}),
+    ('That was funny, what time is it?', 'time', {}),
+    ('Hi! Tell me a joke about the weather in Paris', 'joke', {}),
+    ('Can you help me with the weather forecast?', 'weather', {}),
+    ('What is the weather in Paris? Also tell me a pun joke', 'joke', {'category': 'pun'}),
+])
+def test_route(router, message, intent, slots):
+    match = router.route(message)
+    assert match.intent == intent
+    assert match.slots == slots
+
+def test_commands_take_their_argument(router):
+    match = router.route('remember that I like tea')
+    assert match.is_command
+    assert match.slots == {'text': 'that I like tea'}
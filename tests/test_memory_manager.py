@@ -0,0 +1,40 @@
+import sys
+import threading
+
+from main import HashingEmbedder, MemoryManager
+
+def test_concurrent_sessions_can_recall_while_another_remembers():
+    # Two sessions of one user share a MemoryManager: one keeps adding (and evicting), others search.
+    memory_manager = MemoryManager(max_memory_size=20, embedder=HashingEmbedder())
+    stop = threading.Event()
+    errors = []
+
+    def remember():
+        count = 0
+        while not stop.is_set():
+            memory_manager.add_memories([f"memory {count} about topic{count % 7} and pizza"])
+            count += 1
+
+    def recall():
+        try:
+            for i in range(3000):
+                memory_manager.get_relevant_memories(f"pizza topic{i % 7}")
+                memory_manager.short_term_memory
+        except Exception as e:
+            errors.append(e)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # Switch threads often, so that searches overlap writes.
+    try:
+        writer = threading.Thread(target=remember)
+        readers = [threading.Thread(target=recall) for _ in range(3)]
+        writer.start()
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        stop.set()
+        writer.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from main import HashingEmbedder, MemoryManager, VectorMemory
+
+MEMORIES = ['I love pizza', 'my cat is called Milo', 'I work as a nurse in Leeds', 'My favourite colour is blue']
+
+@pytest.fixture
+def memory_manager():
+    memory_manager = MemoryManager(embedder=HashingEmbedder())
+    memory_manager.add_memories(MEMORIES, is_long_term=True)
+    return memory_manager
+
+@pytest.mark.parametrize('query, expected', [
+    ('cats', 'my cat is called Milo'),
+    ('What are my cats called?', 'my cat is called Milo'),
+    ('pizzas', 'I love pizza'),
+    ('colours', 'My favourite colour is blue'),
+    ('Leeds', 'I work as a nurse in Leeds'),
+])
+def test_hashing_embedder_recalls_related_word_forms(memory_manager, query, expected):
+    assert memory_manager.get_relevant_memories(query)[:1] == [expected]
+
+def test_hashing_embedder_does_not_recall_by_meaning(memory_manager):
+    # Topics like this need MEMORY_EMBEDDER=transformer.
+    assert memory_manager.get_relevant_memories('food') == []
+
+class FixedEmbedder:
+    """Embeds every text as the same two-dimensional direction, so all memories score alike."""
+    dim = 2
+    min_similarity = 0.99
+
+    def __init__(self, query_vector):
+        self.query_vector = np.array(query_vector, dtype=np.float32)
+
+    def embed(self, texts):
+        return np.tile(self.query_vector, (len(texts), 1))
+
+def test_vector_memory_uses_the_embedders_cutoff():
+    memory = VectorMemory(FixedEmbedder([1.0, 0.0]), capacity=4)
+    memory.add_many(['a memory'])
+    memory.embedder.query_vector = np.array([0.95, 0.312], dtype=np.float32)  # Cosine 0.95.
+    assert memory.search('a query') == []
+    assert VectorMemory(HashingEmbedder(), capacity=4).min_similarity == 0.2
+    # An explicit cutoff still wins.
+    assert VectorMemory(memory.embedder, capacity=4, min_similarity=0.5).min_similarity == 0.5
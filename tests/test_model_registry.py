@@ -0,0 +1,24 @@
+import gc
+
+from main import ModelRegistry
+
+class Session:
+    """Stands in for a chatbot session that has not attached a model yet."""
+
+def test_memory_stats_count_sessions_that_have_not_attached_a_model():
+    registry = ModelRegistry()
+    assert registry.memory_stats()['sessions'] == 0
+    assert registry.memory_stats()['rss_bytes_per_session'] is None
+
+    sessions = [Session(), Session()]
+    for session in sessions:
+        registry.track_session(session)
+    stats = registry.memory_stats()
+    assert stats['sessions'] == 2
+    assert stats['model_references'] == 0
+    if stats['process_rss_bytes']:
+        assert stats['rss_bytes_per_session'] == stats['process_rss_bytes'] // 2
+
+    del sessions, session
+    gc.collect()
+    assert registry.memory_stats()['sessions'] == 0
@@ -0,0 +1,58 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import LocalWikiIndex, WikipediaService
+
+class PageError(Exception):
+    pass
+
+class DisambiguationError(Exception):
+    pass
+
+@pytest.fixture
+def fetched(monkeypatch):
+    """Replaces the Wikipedia client with one that records the queries it is asked for."""
+    queries = []
+
+    def summary(query, sentences=2):
+        queries.append(query)
+        return f"An article about {query}."
+
+    exceptions = SimpleNamespace(PageError=PageError, DisambiguationError=DisambiguationError)
+    monkeypatch.setattr(main, 'wikipedia', SimpleNamespace(summary=summary, exceptions=exceptions))
+    return queries
+
+def test_fetches_the_query_its_result_is_cached_under(fetched):
+    service = WikipediaService()
+    first = service.search('What is the Eiffel Tower?')
+    # Normalizes to the same cache key, so it must be answered with the same article.
+    assert service.search('the eiffel tower') == first
+    assert service.search('Where is the Eiffel Tower') == first
+    assert fetched == ['the eiffel tower']
+    assert service.stats['memory_hits'] == 2
+
+ARTICLES = [
+    {'title': 'Eiffel Tower', 'summary': 'The Eiffel Tower is a tower in Paris. It was built in 1889.'},
+    {'title': 'Ada Lovelace', 'summary': 'Ada Lovelace was a mathematician. She wrote the first program.'},
+]
+
+def test_offline_index_is_saved_as_json_and_reused(tmp_path):
+    dump_path = tmp_path / 'summaries.jsonl'
+    dump_path.write_text(''.join(json.dumps(article) + '\n' for article in ARTICLES), encoding='utf-8')
+
+    built = LocalWikiIndex.load(str(dump_path))
+    with open(f'{dump_path}.index.json', encoding='utf-8') as index_file:
+        json.load(index_file)  # Plain data, not a pickle.
+    # Empty the dump but keep it older than the index: the articles can only come from the saved index.
+    mtime = os.path.getmtime(dump_path)
+    dump_path.write_text('', encoding='utf-8')
+    os.utime(dump_path, (mtime - 10, mtime - 10))
+    loaded = LocalWikiIndex.load(str(dump_path))
+
+    for query in ('What is the Eiffel Tower?', 'who was ada lovelace', 'tower', 'lovelace mathematician'):
+        assert loaded.lookup(query, sentences=1) == built.lookup(query, sentences=1)
+    assert loaded.lookup('eiffel tower', sentences=1) == 'The Eiffel Tower is a tower in Paris.'